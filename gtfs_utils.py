@@ -2,6 +2,17 @@
 '''
 
 import sys, os
+import time
+import json
+import functools
+import multiprocessing
+import hashlib
+import zipfile
+import gzip
+import shutil
+import tempfile
+import atexit
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import pandas as pd
 import shapefile
@@ -10,35 +21,758 @@ import copy
 import shapefile
 import shapely
 from shapely.geometry import Point, Polygon
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+try:
+    import pyproj
+except ImportError:
+    pyproj = None
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+try:
+    import resource
+except ImportError:
+    resource = None
 
-def HHMMSS_to_MPM(hhmmss):
-    sep = ':'
-    if sep:
-        hh, mm, ss = hhmmss.split(sep)
-    else:
-        hh = hhmmss[:2]
-        mm = hhmmss[2:4]
-        ss = hhmmss[4:]
+MISSING_TIME = -1
+EARTH_RADIUS_METERS = 6371008.8
+
+# per-file column types used by GTFSFeed.load.  ids and times in the large tables are read
+# as categoricals; ids are then re-typed to match the table that defines them (GTFS_ID_SOURCES)
+# so they still join against the small tables.  tables and columns not listed use read_csv defaults.
+GTFS_SCHEMA = {
+    'calendar':         {'monday':np.int8,'tuesday':np.int8,'wednesday':np.int8,'thursday':np.int8,
+                         'friday':np.int8,'saturday':np.int8,'sunday':np.int8},
+    'calendar_dates':   {'exception_type':np.int8},
+    'routes':           {'route_type':np.int16},
+    'shapes':           {'shape_id':'category','shape_pt_sequence':np.int32},
+    'stop_times':       {'trip_id':'category','arrival_time':'category','departure_time':'category',
+                         'stop_id':'category','stop_sequence':np.int32,'stop_headsign':'category',
+                         'pickup_type':np.float32,'drop_off_type':np.float32},
+    }
+GTFS_ID_SOURCES = {'trip_id':('trips','trip_id'),
+                   'stop_id':('stops','stop_id'),
+                   'shape_id':('trips','shape_id')}
+
+# id columns that GTFSFeed.intern_ids turns into int32 codes, by the ids they hold
+ID_COLUMNS = {'agency_id':'agency_id','fare_id':'fare_id','route_id':'route_id','service_id':'service_id',
+              'shape_id':'shape_id','stop_id':'stop_id','trip_id':'trip_id','pattern_id':'trip_id',
+              'from_stop_id':'stop_id','to_stop_id':'stop_id'}
+# id columns that merge_feeds namespaces: ID_COLUMNS plus references to them that intern_ids leaves be
+MERGE_ID_COLUMNS = dict(ID_COLUMNS, parent_station='stop_id')
+
+# the columns used by standardize, apply_time_periods and build_common_dfs, for use as
+# GTFSFeed.load(columns=PIPELINE_COLUMNS).  tables not listed are read in full.
+PIPELINE_COLUMNS = {
+    'routes':           ['route_id','agency_id','route_short_name','route_long_name','route_desc','route_type'],
+    'shapes':           ['shape_id','shape_pt_lat','shape_pt_lon','shape_pt_sequence'],
+    'stop_times':       ['trip_id','arrival_time','departure_time','stop_id','stop_sequence'],
+    'trips':            ['route_id','service_id','trip_id','trip_headsign','direction_id','shape_id'],
+    }
+# the tables those steps need, for use as GTFSFeed.load(tables=PIPELINE_TABLES)
+PIPELINE_TABLES = ['calendar','calendar_dates','routes','stops','stop_times','trips']
+
+# calendar.txt day columns, in pandas dayofweek order
+WEEKDAYS = ['monday','tuesday','wednesday','thursday','friday']
+DAYS = WEEKDAYS + ['saturday','sunday']
+
+CACHE_VERSION = 3
+CACHE_FORMATS = {'feather':'.feather','parquet':'.parquet'}
+
+LOAD_STATS_COLUMNS = ['table','rows','file_bytes','memory_bytes','seconds','cached']
+# GTFSFeed.write formats and the extension of their files.  zip is a single GTFS zip of .txt files.
+WRITE_FORMATS = {'csv':'.txt','csv.gz':'.txt.gz','parquet':'.parquet','feather':'.feather','zip':'.txt'}
+WRITE_OVERWRITE_MODES = ['error','skip','replace']
+WRITE_CHUNK_ROWS = 500000
+WRITE_STATS_COLUMNS = ['table','file','rows','file_bytes','seconds']
+
+WGS84_PRJ = 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]]'
+# time period attributes written by GTFSFeed.export_shapefiles, as (field name, route_statistics column,
+# decimals) with %s standing for the time period
+SHAPEFILE_TP_ATTRIBUTES = [('%s_trips','%s_trips',0),('%s_headway','%s_mean_headway',2)]
+
+BUILD_CACHE_VERSION = 1
+BUILD_CHANGE_COLUMNS = ['level','change','route_id','pattern_id']
+
+# the tables GTFSFeed.build_common_dfs can keep
+BUILD_TABLES = ['route_trips','stop_routes','route_patterns','trip_patterns','stop_patterns','route_statistics','stop_statistics',
+                'stop_frequencies','segments']
+BUILD_STATS_COLUMNS = ['table','rows','memory_bytes','seconds','peak_memory_mb']
+
+# one row per profiled GTFSFeed call, see GTFSFeed.get_profile
+PROFILE_COLUMNS = ['stage','depth','parent','start','wall_seconds','cpu_seconds','peak_memory_delta_mb','rows_in','rows_out']
+
+FEED_SUMMARY_COLUMNS = ['feed','path','outpath','status','error','seconds','peak_memory_mb','routes','trips','patterns','stops']
+
+def write_shapefile(filename, shape_type, fields, geometries, records, prj=WGS84_PRJ):
+    '''
+    input:  filename:       .shp file to write; the .prj is written next to it
+            shape_type:     shapefile.POLYLINE (geometries are (n,2) arrays of lon, lat) or
+                            shapefile.POINT (geometries are lon, lat pairs)
+            fields:         list of shapefile.Writer.field arguments
+            geometries:     one per feature
+            records:        list of field values per feature, None for missing
+    '''
+    writer = shapefile.Writer(shapeType=shape_type)
+    for field in fields:
+        writer.field(*field)
+    for geometry, record in itertools.izip(geometries, records):
+        if shape_type == shapefile.POINT:
+            writer.point(*geometry)
+        else:
+            writer.line([np.asarray(geometry).tolist()])
+        writer.record(*record)
+    writer.save(filename)
+    with open(os.path.splitext(filename)[0] + '.prj', 'w') as f:
+        f.write(prj)
+
+def gtfs_dates(values):
+    '''
+    input:  GTFS dates (YYYYMMDD, as ints or strings)
+    output: DatetimeIndex
+    '''
+    return pd.DatetimeIndex(pd.to_datetime(pd.Series(np.asarray(values)).astype(str), format='%Y%m%d'))
+
+def to_date(date):
+    '''
+    a GTFS date (ex. 20160704) or anything pd.Timestamp takes (ex. '2016-07-04'), as a Timestamp
+    '''
+    if isinstance(date, (int, long, np.integer)) or (isinstance(date, basestring) and len(date) == 8 and date.isdigit()):
+        return pd.Timestamp(gtfs_dates([date])[0])
+    return pd.Timestamp(date)
+
+def get_service_dates(calendar, calendar_dates):
+    '''
+    input:  calendar, calendar_dates:   GTFS tables, either can be None
+    output: bool DataFrame of service_id by date, True on the dates a service runs: its calendar days
+            of the week from start_date to end_date, plus the calendar_dates with exception_type 1 and
+            less those with exception_type 2.  None if there are neither.
+    '''
+    has_calendar = isinstance(calendar, pd.DataFrame) and len(calendar) > 0
+    has_dates = isinstance(calendar_dates, pd.DataFrame) and len(calendar_dates) > 0
+    if not has_calendar and not has_dates:
+        return None
+    service_ids, bounds = [], []
+    if has_calendar:
+        starts, ends = gtfs_dates(calendar['start_date']).values, gtfs_dates(calendar['end_date']).values
+        service_ids.append(np.asarray(calendar['service_id']))
+        bounds += [starts.min(), ends.max()]
+    if has_dates:
+        exception_dates = gtfs_dates(calendar_dates['date'])
+        service_ids.append(np.asarray(calendar_dates['service_id']))
+        bounds += [exception_dates.min(), exception_dates.max()]
+    service_ids = pd.Index(np.unique(np.concatenate(service_ids)), name='service_id')
+    dates = pd.date_range(min(bounds), max(bounds), freq='D')
+
+    active = np.zeros((len(service_ids), len(dates)), dtype=bool)
+    if has_calendar:
+        rows = service_ids.get_indexer(np.asarray(calendar['service_id']))
+        in_range = (dates.values >= starts[:,None]) & (dates.values <= ends[:,None])
+        active[rows] = calendar[DAYS].values.astype(bool)[:,dates.dayofweek] & in_range
+    if has_dates:
+        rows = service_ids.get_indexer(np.asarray(calendar_dates['service_id']))
+        cols = dates.get_indexer(exception_dates)
+        exception_types = calendar_dates['exception_type'].values
+        active[rows[exception_types == 1], cols[exception_types == 1]] = True
+        active[rows[exception_types == 2], cols[exception_types == 2]] = False
+    return pd.DataFrame(active, index=service_ids, columns=dates)
+
+def file_md5(filepath, blocksize=2**20):
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+def concat_categorical_frames(frames):
+    '''
+    concatenate frames with the same columns, keeping categorical columns categorical by
+    first giving every frame the union of their categories
+    '''
+    frames = list(frames)
+    if len(frames) == 0:
+        return pd.DataFrame()
+    for col in frames[0].columns:
+        if str(frames[0][col].dtype) != 'category':
+            continue
+        categories = frames[0][col].cat.categories
+        for frame in frames[1:]:
+            categories = categories.union(frame[col].cat.categories)
+        for i, frame in enumerate(frames):
+            frames[i] = frame.assign(**{col: frame[col].cat.set_categories(categories)})
+    return pd.concat(frames)
 
-    return 60 * int(hh) + int(mm) + float(ss)/60
+def HHMMSS_to_seconds(hhmmss):
+    '''
+    input:  hhmmss: array-like (Series, ndarray, list) of H:MM:SS / HH:MM:SS / HHH:MM:SS strings
+    output: int32 ndarray of seconds past midnight.  Hours past 24 are kept as-is.
+            Blank, NaN and malformed values are returned as MISSING_TIME.
+    '''
+    values = pd.Series(hhmmss)
+    if str(values.dtype) == 'category':
+        # parse each distinct time once
+        parsed = np.append(HHMMSS_to_seconds(values.cat.categories), MISSING_TIME).astype(np.int32)
+        return parsed[values.cat.codes.values]
+    values = values.astype(object)
+    values = values.where(pd.notnull(values), '').values
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int32)
+
+    # view the values as a fixed-width byte matrix (NUL padded on the right) and locate the
+    # end of each value, so minutes and seconds are always the five characters before it.
+    try:
+        raw = np.asarray(values, dtype='S')
+    except UnicodeError:
+        # a non-ASCII value isn't a time; replace those characters so it is malformed rather
+        # than failing the whole column
+        raw = np.asarray([v.encode('ascii', 'replace') if isinstance(v, unicode) else v for v in values], dtype='S')
+    nrows, width = len(raw), max(raw.dtype.itemsize, 1)
+    chars = raw.view(np.uint8).reshape(nrows, width).astype(np.int32)
+    digits = chars - ord('0')
+    is_digit = (digits >= 0) & (digits <= 9)
+    is_space = chars == ord(' ')
+
+    filled = (chars != 0) & ~is_space
+    end = width - np.argmax(filled[:,::-1], axis=1)
+    valid = filled.any(axis=1) & (end >= 7)
+    rows = np.arange(nrows)
+    def at(offset):
+        return np.clip(end - offset, 0, width - 1)
+
+    valid &= (chars[rows,at(6)] == ord(':')) & (chars[rows,at(3)] == ord(':'))
+    for offset in [7, 5, 4, 2, 1]:
+        valid &= is_digit[rows,at(offset)]
+    minutes = digits[rows,at(5)] * 10 + digits[rows,at(4)]
+    seconds = digits[rows,at(2)] * 10 + digits[rows,at(1)]
+    valid &= (minutes < 60) & (seconds < 60)
+
+    # hours may be one or more digits, optionally left-padded with spaces
+    hours = np.zeros(nrows, dtype=np.int32)
+    seen_digit = np.zeros(nrows, dtype=bool)
+    for col in range(width-7):
+        in_hours = col < end - 7
+        valid &= ~in_hours | is_digit[:,col] | (is_space[:,col] & ~seen_digit)
+        hours = np.where(in_hours & is_digit[:,col], hours * 10 + digits[:,col], hours)
+        seen_digit |= in_hours & is_digit[:,col]
+    hours = np.where(end - 7 >= 0, hours * 10 + digits[rows,at(7)], hours)
+
+    secs = 3600 * hours + 60 * minutes + seconds
+    return np.where(valid, secs, MISSING_TIME).astype(np.int32)
+
+def seconds_to_MPM(seconds):
+    '''
+    convert seconds past midnight to (float) minutes past midnight, with MISSING_TIME as NaN
+    '''
+    seconds = np.asarray(seconds)
+    return np.where(seconds == MISSING_TIME, np.nan, seconds / 60.0)
+
+def HHMMSS_to_MPM(hhmmss):
+    '''
+    minutes past midnight for a single HH:MM:SS string (returns float) or for an array-like
+    of them (returns float ndarray).  Missing and malformed values become NaN.
+    '''
+    if np.isscalar(hhmmss) or hhmmss is None:
+        return seconds_to_MPM(HHMMSS_to_seconds([hhmmss]))[0]
+    return seconds_to_MPM(HHMMSS_to_seconds(hhmmss))
 
 def HHMMSSpair_to_MPMpair(hhmmsspair):
-    if hhmmsspair == np.nan: return (np.nan, np.nan)
-    hhmmss1, hhmmss2 = hhmmsspair.split('-')
-    mpm1 = HHMMSS_to_MPM(hhmmss1)
-    mpm2 = HHMMSS_to_MPM(hhmmss2)
+    if pd.isnull(hhmmsspair): return (np.nan, np.nan)
+    mpm1, mpm2 = HHMMSS_to_MPM(hhmmsspair.split('-'))
     if mpm2 < mpm1: mpm2 += 24*60
     return (mpm1,mpm2)
 
+def get_time_period_breakpoints(time_periods):
+    '''
+    input:  time_periods: dict of timeperiod key to time range (in str format: hh:mm:ss-hh:mm:ss)
+    output: (starts, ends, labels) sorted by start, as half-open [start, end) intervals in seconds
+            past midnight on a single 24-hour clock.  Periods that wrap past midnight are split in two.
+    raises ValueError for malformed, empty, longer-than-a-day or overlapping periods.
+    '''
+    day = 24*3600
+    starts, ends, labels = [], [], []
+    for key, value in time_periods.iteritems():
+        try:
+            tp_start, tp_end = HHMMSS_to_seconds(value.split('-'))
+        except (AttributeError, ValueError):
+            raise ValueError("time period %s: %r is not a HH:MM:SS-HH:MM:SS pair" % (key, value))
+        if tp_start == MISSING_TIME or tp_end == MISSING_TIME:
+            raise ValueError("time period %s: %r is not a HH:MM:SS-HH:MM:SS pair" % (key, value))
+        if tp_end < tp_start: tp_end += day
+        # the pair is inclusive of its end second
+        length = tp_end - tp_start + 1
+        if length > day:
+            raise ValueError("time period %s: %r is longer than 24 hours" % (key, value))
+        tp_start = tp_start % day
+        tp_end = tp_start + length
+        if tp_end > day:
+            starts += [tp_start, 0]
+            ends += [day, tp_end - day]
+            labels += [key, key]
+        else:
+            starts.append(tp_start)
+            ends.append(tp_end)
+            labels.append(key)
+
+    order = np.argsort(starts, kind='mergesort')
+    starts = np.asarray(starts, dtype=np.int64)[order]
+    ends = np.asarray(ends, dtype=np.int64)[order]
+    labels = [labels[i] for i in order]
+    overlaps = np.nonzero(starts[1:] < ends[:-1])[0]
+    if len(overlaps) > 0:
+        i = overlaps[0]
+        raise ValueError("time periods %s and %s overlap" % (labels[i], labels[i+1]))
+    return starts, ends, labels
+
+def assign_time_periods(seconds, time_periods, other='other'):
+    '''
+    input:  seconds:      array-like of seconds past midnight (MISSING_TIME for missing)
+            time_periods: dict of timeperiod key to time range (in str format: hh:mm:ss-hh:mm:ss)
+    output: Categorical of time period keys, with `other` for times not covered by any period.
+            Times past 24:00:00 are matched against the period they fall in on the next day.
+    '''
+    starts, ends, labels = get_time_period_breakpoints(time_periods)
+    categories = sorted(time_periods.keys())
+    if other not in categories: categories.append(other)
+    label_codes = np.array([categories.index(label) for label in labels] + [categories.index(other)], dtype=np.int32)
+
+    seconds = np.asarray(seconds)
+    clock = seconds % (24*3600)
+    interval = np.searchsorted(starts, clock, side='right') - 1
+    matched = (seconds != MISSING_TIME) & (interval >= 0)
+    if len(ends) > 0:
+        matched &= clock < ends[np.clip(interval, 0, len(ends)-1)]
+    else:
+        matched[:] = False
+    interval = np.where(matched, interval, len(labels))
+    return pd.Categorical.from_codes(label_codes[interval], categories)
+
+def _mix_stop_positions(stop_codes, positions, seed):
+    # splitmix-style 64-bit mix of (stop code, position in trip).  everything stays uint64 so
+    # numpy doesn't promote to float, and overflow just wraps.
+    x = stop_codes.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    x ^= (positions.astype(np.uint64) + np.uint64(seed)) * np.uint64(0xC2B2AE3D27D4EB4F)
+    x ^= x >> np.uint64(31)
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(29)
+    return x
+
+def get_trip_patterns(trip_ids, stop_sequences, stop_ids):
+    '''
+    input:  trip_ids, stop_sequences, stop_ids: array-likes, one entry per stop_time
+    output: DataFrame of trip_id, num_stops, pattern_id with one row per trip, sorted by trip_id.
+            Trips that visit the same stop_ids in the same order share a pattern, and the pattern_id
+            is the first trip_id of the pattern.
+    '''
+    return assign_pattern_ids(get_trip_pattern_hashes(trip_ids, stop_sequences, stop_ids))
+
+def get_trip_pattern_hashes(trip_ids, stop_sequences, stop_ids):
+    '''
+    input:  trip_ids, stop_sequences, stop_ids: array-likes, one entry per stop_time, with all the
+            stop_times of each trip
+    output: DataFrame of trip_id, num_stops, hash1, hash2 with one row per trip, sorted by trip_id.
+    Each trip's ordered stop list is reduced to its length plus two independent 64-bit sums of
+    hashed (stop, position) pairs in one pass over the sorted stop_times, so no trips x stop_sequence
+    frame is built and gaps in the stop_sequence numbering don't matter.  Stops are hashed by their
+    ids, so trips hashed in separate calls (ex. out of core partitions) can be compared.
+    '''
+    trip_codes, trip_uniques = pd.factorize(np.asarray(trip_ids), sort=True)
+    stop_codes, stop_uniques = pd.factorize(np.asarray(stop_ids))
+    order = np.lexsort((np.asarray(stop_sequences), trip_codes))
+    trip_codes = trip_codes[order]
+    stop_codes = np.r_[hash_strings(stop_uniques), np.uint64(0)][stop_codes[order]]
+
+    if len(trip_codes) == 0:
+        return pd.DataFrame(columns=['trip_id','num_stops','hash1','hash2'])
+    starts = np.flatnonzero(np.r_[True, trip_codes[1:] != trip_codes[:-1]])
+    num_stops = np.diff(np.r_[starts, len(trip_codes)])
+    positions = np.arange(len(trip_codes)) - np.repeat(starts, num_stops)
+
+    return pd.DataFrame({'trip_id':trip_uniques.take(trip_codes[starts]),
+                         'num_stops':num_stops,
+                         'hash1':np.add.reduceat(_mix_stop_positions(stop_codes, positions, 1), starts).view(np.int64),
+                         'hash2':np.add.reduceat(_mix_stop_positions(stop_codes, positions, 2), starts).view(np.int64)},
+                        columns=['trip_id','num_stops','hash1','hash2'])
+
+def assign_pattern_ids(patterns):
+    '''
+    input:  patterns:   get_trip_pattern_hashes output, or several of them concatenated and sorted by
+                        trip_id
+    output: DataFrame of trip_id, num_stops, pattern_id (see get_trip_patterns)
+    '''
+    patterns = patterns.copy()
+    patterns['pattern_id'] = patterns.groupby(['num_stops','hash1','hash2'])['trip_id'].transform('first')
+    return pd.DataFrame(patterns, columns=['trip_id','num_stops','pattern_id'])
+
+def hash_rows(df, columns=None, ids=None):
+    '''
+    input:  df, columns (defaults to all of df's, in sorted order)
+            ids:    optional dict of column to the Index of values its int codes stand for (-1 for
+                    missing), so coded columns hash like the values themselves (see GTFSFeed.intern_ids)
+    output: uint64 array with a 64-bit hash of each row.  Values are hashed by column name and repr
+            rather than by categorical code, so hashes can be compared between feeds and builds.
+            Rows hash differently when values move between them, so sums of row hashes can stand
+            in for a hash of a set of rows.
+    '''
+    columns = sorted(df.columns) if columns is None else columns
+    row_hash = np.zeros(len(df), dtype=np.uint64)
+    for col in columns:
+        if ids != None and col in ids:
+            codes, uniques = df[col].values, ids[col]
+        else:
+            codes, uniques = category_codes(df[col])
+        seed = np.frombuffer(hashlib.md5(str(col)).digest()[:8], dtype=np.uint64)[0]
+        # the extra zero at the end is the hash of missing values (code -1)
+        row_hash += np.r_[hash_strings(uniques, seed), np.uint64(0)][codes]
+    return _mix_stop_positions(row_hash, np.zeros(len(df), dtype=np.uint64), 3)
+
+def hash_strings(values, seed=0):
+    '''
+    input:  values: array-like, hashed as their strings
+            seed:   uint64 starting value, ex. to hash the same values differently per column
+    output: uint64 array of 64-bit FNV-1a hashes, one byte position at a time across all values
+    '''
+    values = np.asarray(values)
+    try:
+        values = values.astype(str)
+    except UnicodeEncodeError:
+        values = values.astype(unicode)
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    chars = values.view(np.uint8).reshape(len(values), -1)
+    h = np.empty(len(values), dtype=np.uint64)
+    h[:] = np.uint64(0xCBF29CE484222325) ^ np.uint64(seed)
+    for i in xrange(chars.shape[1]):
+        h ^= chars[:,i]
+        h *= np.uint64(0x100000001B3)
+    return h
+
+def _sum_hashes(codes, hashes, n):
+    # wrapping uint64 sum of hashes by code.  groupby().sum() would go through float.
+    sums = np.zeros(n, dtype=np.uint64)
+    np.add.at(sums, codes, hashes)
+    return sums
+
+def grouped_quantile(headways, q):
+    '''
+    input:  headways: DataFrame from GTFSFeed._get_headways, sorted by group and then headway
+            q:        quantile, 0 <= q <= 1
+    output: float ndarray with the q-th quantile of each row's group (linear interpolation, as
+            Series.quantile does)
+    '''
+    values = headways['headway'].values
+    position = headways['group_position'].values
+    size = headways['group_size'].values
+    start = np.arange(len(values)) - position
+    h = (size - 1) * q
+    lo = np.floor(h).astype(np.int64)
+    hi = np.minimum(lo + 1, size - 1)
+    return values[start+lo] + (h - lo) * (values[start+hi] - values[start+lo])
+
+def headway_outliers_mean(headways, multiple=2.0):
+    '''
+    flag headways more than `multiple` times their group's mean headway, where the mean leaves out
+    the group's smallest and largest headway (groups with fewer than three headways have no outliers)
+    '''
+    trimmed = headways['trimmed'].values
+    group = headways['group'].values
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(group, weights=np.where(trimmed, headways['headway'].values, 0)) / np.bincount(group, weights=trimmed)
+        return headways['headway'].values > multiple * mean[group]
+
+def headway_outliers_iqr(headways, k=1.5):
+    '''
+    flag headways more than k interquartile ranges above their group's third quartile
+    '''
+    q1 = grouped_quantile(headways, 0.25)
+    q3 = grouped_quantile(headways, 0.75)
+    return headways['headway'].values > q3 + k * (q3 - q1)
+
+def headway_outliers_percentile(headways, percentile=95):
+    '''
+    flag headways above the given percentile of their group's headways
+    '''
+    return headways['headway'].values > grouped_quantile(headways, percentile / 100.0)
+
+# outlier_rule names accepted by GTFSFeed.get_route_statistics.  a rule takes the headways frame
+# (see GTFSFeed._get_headways) plus keyword options, and returns a boolean array of outliers.
+HEADWAY_OUTLIER_RULES = {'mean':         headway_outliers_mean,
+                         'iqr':          headway_outliers_iqr,
+                         'percentile':   headway_outliers_percentile}
+
+def count_common_stops(a, b, method='lcs'):
+    '''
+    input:  a, b:   int arrays of shape (pairs, length) of stop codes, padded on the right with -1
+            method: 'lcs' counts the stops of the longest common subsequence, so order matters
+                    'set' counts the distinct stops of a that b also visits
+    output: int array with the number of shared stops of each pair
+    '''
+    a = np.asarray(a, dtype=np.int64)
+    b = np.asarray(b, dtype=np.int64)
+    if len(a) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if method == 'lcs':
+        # row by row LCS table for all pairs at once.  within a row,
+        #   lcs[j+1] = max(prev[j+1], lcs[j], prev[j] + match[j])
+        # which is a running max, so only the rows of a are looped over.
+        lcs = np.zeros((len(a), b.shape[1]+1), dtype=np.int64)
+        for i in range(a.shape[1]):
+            match = (a[:,i:i+1] == b) & (a[:,i:i+1] >= 0)
+            lcs[:,1:] = np.maximum.accumulate(np.maximum(lcs[:,1:], lcs[:,:-1] + match), axis=1)
+        return lcs[:,-1]
+    if method == 'set':
+        width = max(a.max(), b.max()) + 1
+        pairs = np.arange(len(a), dtype=np.int64)[:,None] * width
+        a_keys = np.unique((pairs + a)[a >= 0])
+        b_keys = np.unique((pairs + b)[b >= 0])
+        common = a_keys[np.in1d(a_keys, b_keys, assume_unique=True)]
+        return np.bincount(common // width, minlength=len(a))
+    raise ValueError("method must be 'lcs' or 'set', not %r" % (method,))
+
+def count_stops(a, method='lcs'):
+    '''
+    the number of stops of each row of a that count_common_stops compares against
+    '''
+    if method == 'set':
+        return count_common_stops(a, a, 'set')
+    return (np.asarray(a) >= 0).sum(axis=1)
+
+def category_codes(values):
+    '''
+    input:  values: Series, categorical or not
+    output: int codes (-1 for missing) and the values they index, without turning a categorical's
+            values into an array
+    '''
+    if str(values.dtype) == 'category':
+        return values.cat.codes.values, values.cat.categories
+    return pd.factorize(values.values)
+
+def writable_columns(df):
+    '''
+    input:  df as read by pyarrow, whose columns (and a categorical's codes and categories) may share
+            the arrow buffers and be read-only
+    output: df with those columns copied into writable arrays, as pandas' hashtables (ex. in
+            Index.get_indexer) can't take read-only buffers
+    '''
+    for col in df.columns:
+        values = df[col].values
+        if str(df[col].dtype) == 'category':
+            codes, categories = values.codes, values.categories
+            if not codes.flags.writeable or not categories.values.flags.writeable:
+                df[col] = pd.Categorical.from_codes(codes.copy(), pd.Index(categories.values.copy()), ordered=values.ordered)
+        elif not values.flags.writeable:
+            df[col] = values.copy()
+    return df
+
+def decode_id_codes(ids, codes):
+    '''
+    input:  ids:    Index of ids
+            codes:  array of positions in ids, -1 or NaN for missing
+    output: array of the ids, with NaN where missing
+    '''
+    codes = np.asarray(codes)
+    missing = pd.isnull(codes)
+    missing[~missing] = codes[~missing] < 0
+    if len(ids) == 0:
+        # ex. a feed without shapes, whose shape_ids are all missing (read as float NaN)
+        return np.full(len(codes), np.nan)
+    values = pd.Series(np.asarray(ids).take(np.where(missing, 0, codes).astype(np.int64)))
+    return values.where(~missing).values if missing.any() else values.values
+
+def peak_memory_mb():
+    '''
+    peak memory of this process in MB, or None where the resource module is missing (Windows)
+    '''
+    if resource == None:
+        return None
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def cpu_seconds():
+    '''
+    user plus system CPU seconds used by this process
+    '''
+    user, system = os.times()[:2]
+    return user + system
+
+def _count_rows(values):
+    # rows of the DataFrames and Series in values, None if there are none
+    rows = [len(value) for value in values if isinstance(value, (pd.DataFrame, pd.Series))]
+    return sum(rows) if rows else None
+
+def profiled(table=None):
+    '''
+    decorator for GTFSFeed methods that records a row of PROFILE_COLUMNS for every call while the
+    feed's profiling is on (see GTFSFeed.get_profile).
+    input:  table:  rows_in are the rows of self.<table> before the call, and rows_out its rows after
+                    the call unless the method returns a DataFrame.  without a table rows_in are the
+                    rows of the DataFrame arguments.  rows_out of a method returning a DataFrame or
+                    Series are the rows of the result.
+    With profiling off the method is called straight through.
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not self.profiling:
+                return method(self, *args, **kwargs)
+            return self._profile_call(method, table, args, kwargs)
+        return wrapper
+    return decorator
+
+def group_codes(df, cols):
+    '''
+    input:  df, cols
+    output: int ndarray numbering the distinct combinations of cols in df (NaN is its own value)
+    '''
+    codes = np.zeros(len(df), dtype=np.int64)
+    for col in cols:
+        col_codes, uniques = pd.factorize(df[col].fillna(-1))
+        codes, _ = pd.factorize(codes * len(uniques) + col_codes)
+    return codes
+
+def project_lonlat(lon, lat, projection=None):
+    '''
+    input:  lon, lat:   array-likes of WGS 84 degrees
+            projection: pyproj.Proj (or its init string, ex. '+init=EPSG:2227') to project to in one call,
+                        or None for a local equirectangular approximation in meters, which is fine for
+                        the short distances used to match stops
+    output: (x, y) float ndarrays
+    '''
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    if projection is None:
+        lat0 = np.radians(np.nanmean(lat)) if len(lat) else 0
+        return (EARTH_RADIUS_METERS * np.radians(lon) * np.cos(lat0),
+                EARTH_RADIUS_METERS * np.radians(lat))
+    if pyproj is None:
+        raise ImportError("projecting stops requires pyproj")
+    if not isinstance(projection, pyproj.Proj):
+        projection = pyproj.Proj(projection)
+    x, y = pyproj.transform(pyproj.Proj('+init=EPSG:4326'), projection, lon, lat)
+    return np.asarray(x), np.asarray(y)
+
+def match_points(left_xy, right_xy, k=4, threshold=None):
+    '''
+    input:  left_xy, right_xy:  (n,2) arrays of projected coordinates
+            k:                  number of nearest right points to keep for each left point
+            threshold:          maximum distance, or None for no limit
+    output: (left index, right index, rank, distance) ndarrays, one entry per match, sorted by left
+            index and rank (1 is the nearest).  Uses a KD-tree when scipy is installed and otherwise a
+            grid of threshold-sized cells, so one of the two is required.
+    '''
+    left_xy = np.asarray(left_xy, dtype=np.float64).reshape(-1, 2)
+    right_xy = np.asarray(right_xy, dtype=np.float64).reshape(-1, 2)
+    if len(left_xy) == 0 or len(right_xy) == 0 or k < 1:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, np.zeros(0)
+
+    if cKDTree != None:
+        k_query = min(k, len(right_xy))
+        bound = np.inf if threshold is None else threshold * (1 + 1e-12)
+        distances, right_idx = cKDTree(right_xy).query(left_xy, k=k_query, distance_upper_bound=bound)
+        distances = distances.reshape(len(left_xy), k_query)
+        right_idx = right_idx.reshape(len(left_xy), k_query)
+        left_idx = np.repeat(np.arange(len(left_xy)), k_query).reshape(len(left_xy), k_query)
+        found = right_idx < len(right_xy)
+        if threshold != None:
+            found &= distances <= threshold
+        left_idx, right_idx, distances = left_idx[found], right_idx[found], distances[found]
+    elif threshold != None:
+        # bucket the right points in threshold-sized cells, then only compare each left point to the
+        # 3x3 block of cells around it
+        right_cells = np.floor(right_xy / threshold).astype(np.int64)
+        left_cells = np.floor(left_xy / threshold).astype(np.int64)
+        offset = min(right_cells.min(), left_cells.min()) - 1
+        span = max(right_cells.max(), left_cells.max()) - offset + 2
+        right_keys = (right_cells[:,0] - offset) * span + (right_cells[:,1] - offset)
+        order = np.argsort(right_keys, kind='mergesort')
+        right_keys = right_keys[order]
+        pairs = []
+        for dx in [-1, 0, 1]:
+            for dy in [-1, 0, 1]:
+                keys = (left_cells[:,0] + dx - offset) * span + (left_cells[:,1] + dy - offset)
+                lo = np.searchsorted(right_keys, keys, side='left')
+                counts = np.searchsorted(right_keys, keys, side='right') - lo
+                left_idx = np.repeat(np.arange(len(left_xy)), counts)
+                within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+                pairs.append((left_idx, order[np.repeat(lo, counts) + within]))
+        left_idx = np.concatenate([pair[0] for pair in pairs])
+        right_idx = np.concatenate([pair[1] for pair in pairs])
+        distances = np.hypot(*(left_xy[left_idx] - right_xy[right_idx]).T)
+        found = distances <= threshold
+        left_idx, right_idx, distances = left_idx[found], right_idx[found], distances[found]
+    else:
+        raise ImportError("matching points without a threshold requires scipy")
+
+    order = np.lexsort((right_idx, distances, left_idx))
+    left_idx, right_idx, distances = left_idx[order], right_idx[order], distances[order]
+    starts = np.flatnonzero(np.r_[True, left_idx[1:] != left_idx[:-1]]) if len(left_idx) else np.zeros(0, dtype=np.int64)
+    rank = np.arange(len(left_idx)) - np.repeat(starts, np.diff(np.r_[starts, len(left_idx)])) + 1
+    keep = rank <= k
+    return left_idx[keep], right_idx[keep], rank[keep], distances[keep]
+
+class LazyTable(object):
+    '''
+    GTFSFeed attribute that is read (or derived) the first time it is accessed after GTFSFeed.load(lazy=True)
+    '''
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, feed, owner):
+        if feed is None:
+            return self
+        if self.name in feed._pending:
+            feed._materialize(self.name)
+        return feed._tables.get(self.name)
+
+    def __set__(self, feed, value):
+        feed._pending.discard(self.name)
+        feed._tables[self.name] = value
+
 class GTFSFeed(object):
+    # GTFS tables, and what load derives from them
+    agency              = LazyTable('agency')
+    calendar            = LazyTable('calendar')
+    calendar_dates      = LazyTable('calendar_dates')
+    fare_attributes     = LazyTable('fare_attributes')
+    fare_rules          = LazyTable('fare_rules')
+    routes              = LazyTable('routes')
+    shapes              = LazyTable('shapes')
+    stop_times          = LazyTable('stop_times')
+    stops               = LazyTable('stops')
+    trips               = LazyTable('trips')
+    service_dates       = LazyTable('service_dates')
+    weekday_service_ids = LazyTable('weekday_service_ids')
+    stop_sequence_cols  = LazyTable('stop_sequence_cols')
+    used_stops          = LazyTable('used_stops')
+
     def __init__(self, path='.',agency='agency.txt',calendar='calendar.txt',calendar_dates='calendar_dates.txt',fare_attributes='fare_attributes.txt',
                  fare_rules='fare_rules.txt',routes='routes.txt',shapes='shapes.txt',stop_times='stop_times.txt',stops='stops.txt',
-                 trips='trips.txt',weekday_only=True, segment_by_service_id=True):
-        # GTFS files
+                 trips='trips.txt',weekday_only=True, segment_by_service_id=True, tables=None, service_period=None,
+                 profiling=False):
+        # GTFS files, either in a directory or a zip archive at path
         self.path           = path
+        self.is_zip         = os.path.isfile(path) and zipfile.is_zipfile(path)
+        self._zip_members   = None
 
         self.all_files = [agency, calendar, calendar_dates, fare_attributes, fare_rules, routes, shapes, stop_times, stops, trips]
         self.all_names = ['agency','calendar','calendar_dates','fare_attributes','fare_rules','routes','shapes','stop_times','stops','trips']
+        self._gtfs_names = list(self.all_names)
+        self._gtfs_files = dict(itertools.izip(self.all_names, self.all_files))
+        self._derived_names = ['service_dates','weekday_service_ids','stop_sequence_cols','used_stops']
+
+        # table storage behind the LazyTable attributes
+        self._tables        = {}
+        self._pending       = set()
+        self._load_options  = {}
+        self._cache         = None
+        # out of core stop_times, see load partition_rows
+        self._partitions    = None
         
         self.agency         = None
         self.calendar       = None
@@ -54,19 +788,39 @@ class GTFSFeed(object):
         # settings
         self.has_time_periods       = False
         self.weekday_only           = weekday_only
+        # (start, end) dates that weekday_only and get_typical_service_ids look at, defaults to all
+        # the dates in calendar and calendar_dates
+        self.service_period         = service_period
         self.segment_by_service_id  = segment_by_service_id
+        self.required_tables        = tables
+        # record the time, memory and rows of each @profiled call, see get_profile
+        self.profiling              = profiling
+        self._profile               = []
+        self._profile_stack         = []
+        self._profile_start         = None
 
         # initialize other vars
         self.time_periods           = None
         self.stop_sequence_cols     = None
+        self.service_dates          = None
         self.weekday_service_ids    = None
         self.used_stops             = None
+        self.load_stats             = None
+        self.build_stats            = None
+        self.write_stats            = None
+        self.ids                    = None
 
+        self.trip_times             = None
         self.route_trips            = None
         self.route_patterns         = None
         self.patterns               = None
         self.route_statistics       = None
         self.stop_statistics        = None
+        self.stop_frequencies       = None
+        self.segments               = None
+        self.build_changes          = None
+        # stops merged into another feed's stop by merge_feeds
+        self.merged_stops           = None
         self.route_stops            = None
         #self.stop_route             = None
 
@@ -77,92 +831,710 @@ class GTFSFeed(object):
         self._tp_idx_cols           = []
         self._route_pattern_info_cols = []
 
-    def load(self, encoding=None):
-        for name, file in itertools.izip(self.all_names, self.all_files):
-            try:
-                self.__dict__[name] = pd.read_csv(os.path.join(self.path,file),encoding=encoding)
-            except:
-                print "%s not found in %s" % (file, self.path)
-                
+    @profiled('stop_times')
+    def load(self, encoding=None, columns=None, chunksize=None, cache_dir=None, cache_format='feather', tables=None, lazy=False,
+             intern_ids=False, partition_rows=None, work_dir=None):
+        '''
+        input:  encoding:   passed on to read_csv
+                tables:     optional list of table names to read (ex. without 'shapes' or the fare
+                            tables when they aren't needed); the others are left as None.  defaults to
+                            the tables given to GTFSFeed(), or all of them.
+                columns:    optional dict of table name to the columns to read (ex. PIPELINE_COLUMNS).
+                            tables not in the dict are read in full.
+                chunksize:  optional number of stop_times rows to read at a time.  with weekday_only,
+                            rows for trips on non-weekday service_ids are dropped from each chunk as it
+                            is read, so they are never held in memory.
+                cache_dir:  optional directory for a binary copy of the loaded tables (plus
+                            weekday_service_ids, stop_sequence_cols and used_stops).  when the cache
+                            matches the source files and load options it is read instead of the csvs;
+                            otherwise the csvs are parsed and the cache is rebuilt.  requires pyarrow.
+                cache_format: 'feather' or 'parquet'
+                lazy:       if True, only check which files exist; each table (and service_dates,
+                            weekday_service_ids, stop_sequence_cols and used_stops) is read the first
+                            time it is accessed.
+                            a stale cache is still rebuilt up front.
+                intern_ids: if True, replace the id columns with int32 codes once loaded (see
+                            intern_ids).  this reads every table, so it overrides lazy.
+                partition_rows: out of core mode for stop_times too large for memory.  stop_times is
+                            read partition_rows at a time and split into csvs in work_dir of about
+                            partition_rows rows each, once by trip_id and once by stop_id, and is never
+                            held whole.  apply_time_periods, standardize, build_common_dfs,
+                            get_stop_frequencies and write then go through the files one at a time
+                            and give the same results (stop_routes and stop_frequencies rows may come
+                            in another order).  self.stop_times is None until build_common_dfs, and
+                            then holds just the pattern trips.  can't be used with cache_dir.
+                work_dir:   directory for the partitions, defaults to a temporary directory that is
+                            removed at exit
+        output:
+            self.<name>:        each GTFS table, typed per GTFS_SCHEMA
+            self.service_dates: see get_service_dates.  with weekday_only, trips are limited to the
+                                weekday_service_ids (see get_typical_service_ids).
+            self.load_stats:    rows, bytes on disk, bytes in memory and seconds for each file read so far
+        '''
+        columns = columns if columns != None else {}
+        tables = tables if tables != None else self.required_tables
+        if partition_rows != None and cache_dir != None:
+            raise ValueError("partition_rows can't be used with cache_dir")
+        self._load_options = {'encoding':encoding, 'columns':columns, 'chunksize':chunksize,
+                              'partition_rows':partition_rows, 'work_dir':work_dir}
+        self._cache = None
+        self._partitions = None
+        self._load_stats = []
+        self.load_stats = pd.DataFrame(self._load_stats, columns=LOAD_STATS_COLUMNS)
+        self.ids = None
+        for name in self._gtfs_files.keys() + self._derived_names:
+            setattr(self, name, None)
+
+        if cache_dir != None:
+            cache_options = {'path':os.path.abspath(self.path),
+                             'files':self._gtfs_files,
+                             'columns':columns,
+                             'weekday_only':self.weekday_only,
+                             'service_period':[str(to_date(date)) for date in self.service_period] if self.service_period else None,
+                             'encoding':encoding,
+                             'tables':tables}
+            manifest = self._read_cache_manifest(cache_dir, cache_options)
+            if manifest != None:
+                self._cache = (cache_dir, manifest)
+                self._pending = set(manifest['tables'].keys() + ['service_dates'])
+                self.weekday_service_ids = manifest['weekday_service_ids']
+                self.stop_sequence_cols = manifest['stop_sequence_cols']
+                if not lazy:
+                    self._materialize_all()
+                    print "loaded %d tables from cache at %s in %.2f s" % (len(self.load_stats), cache_dir, self.load_stats['seconds'].sum())
+                if intern_ids:
+                    self.intern_ids()
+                return
+
+        for name in self._gtfs_names:
+            if tables != None and name not in tables:
+                continue
+            if not self._has_file(self._gtfs_files[name]):
+                print "%s not found in %s" % (self._gtfs_files[name], self.path)
+                continue
+            self._pending.add(name)
+        self._pending.update(self._derived_names)
+
+        if not lazy or cache_dir != None:
+            self._materialize_all()
+        if cache_dir != None:
+            self._write_cache(cache_dir, cache_options, cache_format)
+        if intern_ids:
+            # after the cache is written, so it keeps the ids themselves
+            self.intern_ids()
+
+    @profiled('stop_times')
+    def intern_ids(self):
+        '''
+        Replace the id columns (ID_COLUMNS) of every table with int32 codes, so joins and groupbys
+        run on integers and each id string is kept once.  Pending tables are read first.
+        output: self.ids:   dict of id name (ex. 'stop_id') to an Index of the feed's ids, sorted, so
+                            codes sort, group and pick "first" trips as the ids would.  a code is the
+                            position of the id in the Index, -1 for a missing id.
+        Call it after load and before the other steps.  decode_ids turns a table's codes back into
+        ids, and write does that on export.
+        '''
+        if self.ids != None:
+            return
+        self._materialize_all()
+        names = [name for name in self._gtfs_names + ['service_dates','used_stops','trip_times'] if isinstance(getattr(self, name), pd.DataFrame)]
+        self.ids = self._collect_ids(names)
+        for name in names:
+            setattr(self, name, self.encode_ids(getattr(self, name)))
+        if self.weekday_service_ids != None and 'service_id' in self.ids:
+            self.weekday_service_ids = self._encode_id_values('service_id', pd.Series(self.weekday_service_ids)).tolist()
+
+    def _collect_ids(self, names):
+        # dict of id name to a sorted Index of the ids in the ID_COLUMNS of tables names
+        values = {}
+        for name in names:
+            df = getattr(self, name)
+            for col in df.columns:
+                if col in ID_COLUMNS:
+                    values.setdefault(ID_COLUMNS[col], []).append(np.asarray(category_codes(df[col])[1]))
+            if df.index.name in ID_COLUMNS:
+                values.setdefault(ID_COLUMNS[df.index.name], []).append(np.asarray(df.index))
+        if self._partitions != None:
+            # out of core stop_times are encoded as they are read
+            for kind, ids in self._partitions['ids'].iteritems():
+                values.setdefault(kind, []).append(np.asarray(ids))
+        return dict((kind, pd.Index(np.unique(np.concatenate(uniques)))) for kind, uniques in values.iteritems())
+
+    def encode_ids(self, df):
+        '''
+        input:  df with id columns (ID_COLUMNS, or an index named like one) holding ids
+        output: df with the ids as self.ids codes (-1 for ids the feed doesn't have), or df itself if
+                the ids weren't interned
+        '''
+        if self.ids is None:
+            return df
+        df = df.copy()
+        for col in df.columns:
+            if col in ID_COLUMNS and ID_COLUMNS[col] in self.ids:
+                df[col] = self._encode_id_values(ID_COLUMNS[col], df[col])
+        if df.index.name in ID_COLUMNS and ID_COLUMNS[df.index.name] in self.ids:
+            df.index = pd.Index(self._encode_id_values(ID_COLUMNS[df.index.name], pd.Series(df.index)), name=df.index.name)
+        return df
+
+    def decode_ids(self, df):
+        '''
+        input:  df with id columns (ID_COLUMNS, or an index named like one) holding self.ids codes
+        output: a copy of df with the ids themselves, or df itself if the ids weren't interned
+        '''
+        if self.ids is None:
+            return df
+        df = df.copy()
+        for col in df.columns:
+            if col in ID_COLUMNS and ID_COLUMNS[col] in self.ids:
+                df[col] = decode_id_codes(self.ids[ID_COLUMNS[col]], df[col].values)
+        if df.index.name in ID_COLUMNS and ID_COLUMNS[df.index.name] in self.ids:
+            df.index = pd.Index(decode_id_codes(self.ids[ID_COLUMNS[df.index.name]], df.index.values), name=df.index.name)
+        return df
+
+    def _encode_id_values(self, kind, values):
+        codes, uniques = category_codes(values)
+        return np.r_[self.ids[kind].get_indexer(uniques), -1][codes].astype(np.int32)
+
+    def get_pending_tables(self):
+        '''
+        names of the tables that will be read when first accessed
+        '''
+        return [name for name in self._gtfs_names + self._derived_names if name in self._pending]
+
+    def _materialize_all(self):
+        # read the large tables last so their ids can be typed (and filtered) against the small ones
+        for name in sorted(self._gtfs_names, key=lambda x: x in ['shapes','stop_times']) + self._derived_names:
+            getattr(self, name)
+
+    def _materialize(self, name):
+        # clear first, so a table that is still being read looks unloaded to anything it triggers
+        self._pending.discard(name)
+        self._tables[name] = None
+        if self._cache != None and name in self._cache[1]['tables']:
+            self._tables[name] = self._read_cached_table(name)
+        elif name in self._gtfs_files:
+            if self._cache is None:
+                self._tables[name] = self._load_table(name)
+        elif name == 'service_dates':
+            self._tables[name] = get_service_dates(self.calendar, self.calendar_dates)
+        elif name == 'weekday_service_ids':
+            if isinstance(self.service_dates, pd.DataFrame):
+                self._tables[name] = self._get_weekday_service_ids()
+        elif name == 'stop_sequence_cols':
+            if self._partitions != None:
+                self._tables[name] = list(self._partitions['stop_sequences'])
+            elif isinstance(self.stop_times, pd.DataFrame):
+                self._tables[name] = self._get_stop_sequence_cols()
+        elif name == 'used_stops':
+            if (self._partitions != None or isinstance(self.stop_times, pd.DataFrame)) and isinstance(self.stops, pd.DataFrame):
+                self._tables[name] = self._get_used_stops()
+
+    def _record_load_stats(self, name, df, file_bytes, seconds, cached):
+        self._load_stats.append({'table':name,'rows':len(df),'file_bytes':file_bytes,
+                                 'memory_bytes':df.memory_usage(index=True, deep=True).sum(),
+                                 'seconds':seconds,'cached':cached})
+        self.load_stats = pd.DataFrame(self._load_stats, columns=LOAD_STATS_COLUMNS)
+        if not cached:
+            print "loaded %-16s %10d rows %10.1f MB on disk %10.1f MB in memory %8.2f s" % (name, len(df),
+                                                                                          file_bytes/1e6,
+                                                                                          self._load_stats[-1]['memory_bytes']/1e6,
+                                                                                          seconds)
+
+    def _load_table(self, name):
+        start = time.time()
+        file = self._gtfs_files[name]
+        if name == 'stop_times' and self._load_options.get('partition_rows') != None:
+            self._partition_stop_times(file)
+            return None
+        chunksize = self._load_options['chunksize'] if name == 'stop_times' else None
+        trip_ids = None
+        if name == 'stop_times' and chunksize != None and self.weekday_only and isinstance(self.trips, pd.DataFrame):
+            trip_ids = self.trips['trip_id']
+        df = self._read_table(name, file, encoding=self._load_options['encoding'],
+                              usecols=self._load_options['columns'].get(name),
+                              chunksize=chunksize, trip_ids=trip_ids)
+
         # Useful GTFS manipulations
-        self.weekday_service_ids= self._get_weekday_service_ids()
-        if self.weekday_only:
-            self.trips = self.trips[self.trips['service_id'].isin(self.weekday_service_ids)]
-            self.stop_times = self.stop_times[self.stop_times['trip_id'].isin(self.trips['trip_id'].tolist())]
-        
-        self.stop_sequence_cols = self._get_stop_sequence_cols()
-        self.used_stops         = self._get_used_stops()
+        if self.weekday_only and name == 'trips' and self.weekday_service_ids != None:
+            df = df[df['service_id'].isin(self.weekday_service_ids)]
+        if self.weekday_only and name == 'stop_times' and isinstance(self.trips, pd.DataFrame):
+            df = df[df['trip_id'].isin(self.trips['trip_id'].tolist())]
+            for col in df.columns:
+                if str(df[col].dtype) == 'category':
+                    df[col] = df[col].cat.remove_unused_categories()
+
+        self._record_load_stats(name, df, self._get_file_size(file), time.time()-start, False)
+        return df
+
+    def _get_zip_members(self):
+        # map each GTFS file name to its archive member, which may sit in a subdirectory
+        if self._zip_members == None:
+            archive = zipfile.ZipFile(self.path)
+            self._zip_members = {}
+            for info in archive.infolist():
+                self._zip_members.setdefault(os.path.basename(info.filename), info)
+            archive.close()
+        return self._zip_members
+
+    def _has_file(self, file):
+        if self.is_zip:
+            return file in self._get_zip_members()
+        return os.path.exists(os.path.join(self.path, file))
+
+    def _open_file(self, file):
+        # members are decompressed as they are read, never extracted
+        if self.is_zip:
+            return zipfile.ZipFile(self.path).open(self._get_zip_members()[file])
+        return open(os.path.join(self.path, file), 'rb')
 
-    def write(self, path='.', ext=None):
-        for name, file in itertools.izip(self.all_names, self.all_files):
+    def _get_file_size(self, file):
+        if self.is_zip:
+            return self._get_zip_members()[file].compress_size
+        return os.path.getsize(os.path.join(self.path, file))
+
+    def _get_source_signature(self, file, previous=None):
+        if not self._has_file(file):
+            return None
+        if self.is_zip:
+            # the archive already stores a checksum for every member
+            info = self._get_zip_members()[file]
+            return {'size':info.file_size, 'mtime':list(info.date_time), 'hash':'%08x' % info.CRC}
+        filepath = os.path.join(self.path, file)
+        signature = {'size':os.path.getsize(filepath), 'mtime':os.path.getmtime(filepath)}
+        if previous != None and previous['size'] == signature['size'] and previous['mtime'] == signature['mtime']:
+            signature['hash'] = previous['hash']
+        else:
+            # only hash when size/mtime can't vouch for the file
+            signature['hash'] = file_md5(filepath)
+        return signature
+
+    def _read_cache_manifest(self, cache_dir, options):
+        manifest_file = os.path.join(cache_dir, 'manifest.json')
+        if pyarrow == None or not os.path.exists(manifest_file):
+            return None
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if manifest.get('version') != CACHE_VERSION or manifest['options'] != json.loads(json.dumps(options)):
+            print "cache at %s was built with different options, rebuilding" % cache_dir
+            return None
+        for file, previous in manifest['sources'].iteritems():
+            current = self._get_source_signature(file, previous)
+            if (current == None) != (previous == None) or (current != None and current['hash'] != previous['hash']):
+                print "%s has changed since cache at %s was built, rebuilding" % (file, cache_dir)
+                return None
+        return manifest
+
+    def _read_cached_table(self, name):
+        cache_dir, manifest = self._cache
+        if name not in manifest['tables']:
+            return None
+        start = time.time()
+        cache_file = os.path.join(cache_dir, name + CACHE_FORMATS[manifest['format']])
+        if manifest['format'] == 'feather':
+            df = pyarrow.feather.read_feather(cache_file)
+        else:
+            df = pyarrow.parquet.read_table(cache_file).to_pandas()
+        df = writable_columns(df)
+        for col, dtype in manifest['tables'][name].iteritems():
+            if dtype == 'category' and str(df[col].dtype) != 'category':
+                df[col] = df[col].astype('category')
+        self._record_load_stats(name, df, os.path.getsize(cache_file), time.time()-start, True)
+        return df
+
+    def _write_cache(self, cache_dir, options, cache_format='feather'):
+        if pyarrow == None:
+            print "pyarrow is not installed, not writing cache to %s" % cache_dir
+            return
+        if cache_format not in CACHE_FORMATS:
+            raise ValueError("cache_format must be one of %s" % ', '.join(CACHE_FORMATS.keys()))
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        manifest_file = os.path.join(cache_dir, 'manifest.json')
+        if os.path.exists(manifest_file):
+            # invalidate the old cache before overwriting any of its tables
+            os.remove(manifest_file)
+
+        # service_dates isn't cached, it is rebuilt from the cached calendar and calendar_dates
+        names = [name for name in self._gtfs_files.keys()+['used_stops'] if isinstance(getattr(self, name), pd.DataFrame)]
+        tables = {}
+        for name in names:
+            cache_file = os.path.join(cache_dir, name + CACHE_FORMATS[cache_format])
+            df = getattr(self, name).reset_index(drop=True)
             try:
-                if isinstance(ext, str):
-                    if ext[0] != '.': ext = '.' + ext
-                    file = file.replace('.txt',ext)
-                if not os.path.exists(path):
-                    os.mkdir(path)
-                if os.path.exists(os.path.join(path,file)):
-                    response = raw_input("(y/n) overwrite file at %s" % os.path.join(path, file))
-                    if not response.lower() in ['y','yes']: continue
-                self.__dict__[name].to_csv(os.path.join(path,file), index=False)
+                if cache_format == 'feather':
+                    pyarrow.feather.write_feather(df, cache_file)
+                else:
+                    pyarrow.parquet.write_table(pyarrow.Table.from_pandas(df, preserve_index=False), cache_file)
             except Exception as e:
-                print 'error writing file %s to path %s: %s' % (file, path, e)
-
-##    def export_shapefiles(path='.', routes='routes.shp', stops='stops.shp'):
-##        shape_writer = shapefile.Writer(shapeType=shapefile.POLYLINE)
-##        shape_writer.field('route_id',          'N',    10, 0)
-##        shape_writer.field('route_short_name',  'C',    10, 0)
-##        shape_writer.field('route_long_name',   'C',    50, 0)
-##        shape_writer.field('direction_id',      'N',    1,  0)
-##        shape_writer.field('shape_id',          'N',    10, 0)
-##        if isinstance(self.shapes, pd.DataFrame):
-##            for i, shape in self.shapes.iterrows():
-##                if shape_id == None:
-##                    route_id = shape['route_id']
-##                    route_short_name =  shape['route_short_name']
-##                    route_long_name = shape['route_long_name']
-##                    direction_id = shape['direction_id']
-##                    shape_id = shape['shape_id']
-##                    points = []
-##                if shape_id != shape['shape_id']:
-##                    shape_writer.line([points])
-##                    shape_writer.record(route_id, route_short_name, route_long_name, direction_id, shape_id)
-##                    route_id = shape['route_id']
-##                    route_short_name =  shape['route_short_name']
-##                    route_long_name = shape['route_long_name']
-##                    direction_id = shape['direction_id']
-##                    shape_id = shape['shape_id']
-##                    points = []
-##                point = [shape['shape_pt_lon'],shape['shape_pt_lat']]
-##                points.append(point)
-##            shape_writer.line([points])
-##            shape_writer.record(shape['route_id'], shape['route_short_name'],
-##                                shape['route_long_name'], shape['direction_id'], shape['shape_id'])
-##            shape_writer.save(os.path.join(path,routes))
-##        elif isinstance(self.route_stops, pd.DataFrame):
-##            for i, route in self.routes.iterrows():
-##                if route_id == None:
-##                    route_id = route['route_id']
-##                    route_short_name =  route['route_short_name']
-##                    route_long_name = route['route_long_name']
-##                    direction_id = route['direction_id']
-##                    points = []
-##                if route_id != route['route_id']:
-##                    route_writer.line([points])
-##                    route_writer.record(route_id, route_short_name, route_long_name, direction_id, route_id)
-##                    route_id = route['route_id']
-##                    route_short_name =  route['route_short_name']
-##                    route_long_name = route['route_long_name']
-##                    direction_id = route['direction_id']
-##    
-##                    points = []
-##                point = [route['shape_pt_lon'],shape['shape_pt_lat']]
-##                points.append(point)
-##            shape_writer.line([points])
-##            shape_writer.record(shape['route_id'], shape['route_short_name'],
-##                                shape['route_long_name'], shape['direction_id'], shape['shape_id'])
-##            shape_writer.save(os.path.join(path,routes))
-            
+                print 'error caching table %s to %s, cache not written: %s' % (name, cache_dir, e)
+                return
+            tables[name] = dict((col, str(dtype)) for col, dtype in df.dtypes.iteritems())
+
+        manifest = {'version':CACHE_VERSION,
+                    'format':cache_format,
+                    'options':options,
+                    'sources':dict((file, self._get_source_signature(file))
+                                   for file in self._gtfs_files.values()),
+                    'tables':tables,
+                    'weekday_service_ids':np.asarray(self.weekday_service_ids).tolist(),
+                    'stop_sequence_cols':np.asarray(self.stop_sequence_cols).tolist()}
+        with open(manifest_file, 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    def _read_table(self, name, file, encoding=None, usecols=None, chunksize=None, trip_ids=None):
+        with self._open_file(file) as f:
+            header = pd.read_csv(f, encoding=encoding, nrows=0).columns.tolist()
+        if usecols != None:
+            header = [col for col in header if col in usecols]
+        dtype = dict((col, t) for col, t in GTFS_SCHEMA.get(name, {}).iteritems() if col in header)
+        if chunksize == None:
+            with self._open_file(file) as f:
+                return self._align_id_categories(pd.read_csv(f, encoding=encoding, usecols=header, dtype=dtype))
+        return concat_categorical_frames(self._read_chunks(file, header, dtype, encoding, chunksize, trip_ids))
+
+    def _read_chunks(self, file, header, dtype, encoding, chunksize, trip_ids=None):
+        # chunks of file, keeping only the rows of trip_ids if given
+        with self._open_file(file) as f:
+            for chunk in pd.read_csv(f, encoding=encoding, usecols=header, dtype=dtype, chunksize=chunksize):
+                chunk = self._align_id_categories(chunk)
+                if trip_ids is not None:
+                    chunk = chunk[chunk['trip_id'].isin(trip_ids)]
+                yield chunk
+
+    def _partition_stop_times(self, file):
+        '''
+        Out of core load of stop_times (see load partition_rows): read it partition_rows rows at a time
+        and append each row to the csv picked by a hash of its trip_id, and to the one picked by its
+        stop_id.  Only the ids and stop_sequences seen are kept.
+        output: self._partitions, dict of
+                    trip_id, stop_id:   lists of the partition files by each
+                    ids:                dict of trip_id and stop_id to an Index of the ids in stop_times
+                    stop_sequences:     the stop_sequence values in stop_times
+                    drop_untimed:       set by standardize, see _iter_stop_times
+        '''
+        start = time.time()
+        rows = self._load_options['partition_rows']
+        encoding = self._load_options['encoding']
+        work_dir = self._load_options['work_dir']
+        if work_dir is None:
+            work_dir = tempfile.mkdtemp(prefix='gtfs_stop_times_')
+            atexit.register(shutil.rmtree, work_dir, True)
+        elif not os.path.exists(work_dir):
+            os.makedirs(work_dir)
+
+        # about partition_rows rows per file, going by the size of the first rows
+        with self._open_file(file) as f:
+            sample = f.read(2**20)
+        file_bytes = self._get_zip_members()[file].file_size if self.is_zip else self._get_file_size(file)
+        n = max(1, int(np.ceil(file_bytes / (len(sample) / float(max(sample.count('\n'), 1))) / rows)))
+        partitions = {'trip_id':[os.path.join(work_dir, 'stop_times_trip_%04d.txt' % i) for i in range(n)],
+                      'stop_id':[os.path.join(work_dir, 'stop_times_stop_%04d.txt' % i) for i in range(n)],
+                      'drop_untimed':False}
+
+        with self._open_file(file) as f:
+            header = pd.read_csv(f, encoding=encoding, nrows=0).columns.tolist()
+        usecols = self._load_options['columns'].get('stop_times')
+        if usecols != None:
+            header = [col for col in header if col in usecols]
+        dtype = dict((col, t) for col, t in GTFS_SCHEMA['stop_times'].iteritems() if col in header)
+        trip_ids = self.trips['trip_id'] if self.weekday_only and isinstance(self.trips, pd.DataFrame) else None
+        ids = {'trip_id':[], 'stop_id':[]}
+        stop_sequences = set()
+        total = 0
+        for i, chunk in enumerate(self._read_chunks(file, header, dtype, encoding, rows, trip_ids)):
+            for by in ['trip_id','stop_id']:
+                codes, uniques = category_codes(chunk[by])
+                ids[by].append(np.asarray(uniques.take(np.unique(codes[codes >= 0]))))
+                part = np.r_[hash_strings(uniques) % np.uint64(n), np.uint64(0)][codes].astype(np.int64)
+                order = np.argsort(part, kind='mergesort')
+                bounds = np.searchsorted(part[order], np.arange(n + 1))
+                for k, filename in enumerate(partitions[by]):
+                    chunk.iloc[order[bounds[k]:bounds[k+1]]].to_csv(filename, mode='a' if i else 'w', header=i == 0,
+                                                                     index=False, encoding=encoding)
+            stop_sequences.update(np.unique(chunk['stop_sequence']).tolist())
+            total += len(chunk)
+        partitions['ids'] = dict((by, pd.Index(np.unique(np.concatenate(values)) if values else [])) for by, values in ids.iteritems())
+        partitions['stop_sequences'] = sorted(stop_sequences)
+        self._partitions = partitions
+
+        seconds = time.time() - start
+        self._load_stats.append({'table':'stop_times','rows':total,'file_bytes':self._get_file_size(file),
+                                 'memory_bytes':0,'seconds':seconds,'cached':False})
+        self.load_stats = pd.DataFrame(self._load_stats, columns=LOAD_STATS_COLUMNS)
+        print "partitioned stop_times %10d rows %10.1f MB on disk into 2 x %d files in %s %8.2f s" % (total, self._get_file_size(file)/1e6,
+                                                                                                    n, work_dir, seconds)
+
+    def _read_partition(self, filename):
+        # a stop_times partition, typed as load types stop_times
+        encoding = self._load_options['encoding']
+        with open(filename, 'rb') as f:
+            header = pd.read_csv(f, encoding=encoding, nrows=0).columns.tolist()
+        dtype = dict((col, t) for col, t in GTFS_SCHEMA['stop_times'].iteritems() if col in header)
+        with open(filename, 'rb') as f:
+            return self._align_id_categories(pd.read_csv(f, encoding=encoding, dtype=dtype))
+
+    def _iter_stop_times(self, by='trip_id'):
+        '''
+        input:  by:     'trip_id' or 'stop_id', for out of core stop_times the partitioning to go through
+        output: generator of stop_times: just self.stop_times, or out of core (see load partition_rows)
+                each partition with all the rows of its trips (or stops) in turn, with the columns and
+                ids the in memory stop_times would have by now (time periods, interned ids, untimed
+                stops dropped by standardize).  empty partitions are left out.
+        '''
+        if self._partitions is None:
+            yield self.stop_times
+            return
+        stop_times, yielded = None, False
+        for filename in self._partitions[by]:
+            # in the order load, apply_time_periods and standardize do them
+            stop_times = self._read_partition(filename)
+            if self.ids != None:
+                stop_times = self.encode_ids(stop_times)
+            if self.has_time_periods:
+                self._add_stop_time_periods(stop_times)
+            if self._partitions['drop_untimed']:
+                stop_times = stop_times[(pd.isnull(stop_times['arrival_time']) != True)
+                                        & (pd.isnull(stop_times['departure_time']) != True)]
+            if len(stop_times) > 0:
+                yielded = True
+                yield stop_times
+        if not yielded and stop_times is not None:
+            # every partition is empty, give one so there's a frame to work with
+            yield stop_times
+
+    def _align_id_categories(self, df):
+        # read_csv always parses categories as strings; give them the dtype of the defining table
+        for col, (source, source_col) in GTFS_ID_SOURCES.iteritems():
+            if col not in df.columns or str(df[col].dtype) != 'category':
+                continue
+            if self.ids != None and ID_COLUMNS[col] in self.ids:
+                # interned tables hold codes, the ids (ex. of out of core partitions) are typed like
+                # the intern table so encode_ids finds them
+                ref_dtype = self.ids[ID_COLUMNS[col]].dtype
+            else:
+                reference = getattr(self, source)
+                if not isinstance(reference, pd.DataFrame) or source_col not in reference.columns:
+                    continue
+                ref_dtype = reference[source_col].dtype
+            if ref_dtype == object or str(ref_dtype) == 'category':
+                continue
+            try:
+                df[col] = df[col].cat.rename_categories(df[col].cat.categories.astype(ref_dtype))
+            except ValueError as e:
+                print "could not convert %s to %s, leaving as strings: %s" % (col, ref_dtype, e)
+        return df
+
+    @profiled()
+    def write(self, path='.', ext=None, tables=None, format='csv', overwrite='error', threads=None, chunk_rows=WRITE_CHUNK_ROWS):
+        '''
+        input:  path:       output directory, or for format 'zip' the zip file
+                ext:        extension for format 'csv' files instead of .txt (ex. '.csv')
+                tables:     names of the tables to write, defaults to self.all_names.  tables that aren't
+                            loaded or built are left out.
+                format:     a key of WRITE_FORMATS.  csv.gz is gzipped csv, parquet and feather need pyarrow,
+                            and zip writes a single GTFS zip of .txt files at path.
+                overwrite:  for files that are already there, 'error' raises an IOError before anything is
+                            written, 'skip' leaves them as they are and 'replace' writes over them
+                threads:    number of tables to write at once, in threads so the tables aren't copied
+                chunk_rows: rows of a table decoded (see decode_ids) and written at a time, so writing an
+                            interned table doesn't hold a decoded copy of all of it.  feather files are
+                            written whole.  out of core stop_times (see load) are written from the
+                            partitions.
+        output: self.write_stats, a DataFrame of WRITE_STATS_COLUMNS
+        '''
+        if format not in WRITE_FORMATS:
+            raise ValueError("format must be one of %s" % ', '.join(sorted(WRITE_FORMATS.keys())))
+        if overwrite not in WRITE_OVERWRITE_MODES:
+            raise ValueError("overwrite must be one of %s" % ', '.join(WRITE_OVERWRITE_MODES))
+        if format in CACHE_FORMATS and pyarrow == None:
+            raise ImportError("writing %s files needs pyarrow" % format)
+        if isinstance(ext, str) and ext[0] != '.':
+            ext = '.' + ext
+        files = dict(itertools.izip(self.all_names, self.all_files))
+        names = [name for name in (tables if tables != None else self.all_names)
+                 if name in files and (isinstance(getattr(self, name), pd.DataFrame) or (name == 'stop_times' and self._partitions != None))]
+        if format == 'feather' and 'stop_times' in names and self._partitions != None:
+            raise ValueError("out of core stop_times can't be written as feather, which is written whole")
+
+        def table_file(name):
+            file = os.path.splitext(files[name])[0] + WRITE_FORMATS[format]
+            return file.replace('.txt', ext) if format == 'csv' and isinstance(ext, str) else file
+
+        targets = [path] if format == 'zip' else [os.path.join(path, table_file(name)) for name in names]
+        existing = [target for target in targets if os.path.exists(target)]
+        if existing and overwrite == 'error':
+            raise IOError("%s already exist%s, use overwrite='replace' or 'skip'" % (', '.join(existing), 's' if len(existing) == 1 else ''))
+        if existing and overwrite == 'skip':
+            if format == 'zip':
+                names = []
+            else:
+                names = [name for name, target in itertools.izip(names, targets) if target not in existing]
+
+        if format == 'zip':
+            # the tables go to a scratch directory next to the zip and are then added to it
+            directory = os.path.dirname(os.path.abspath(path))
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            out_dir = tempfile.mkdtemp(dir=directory)
+        else:
+            out_dir = path
+            if not os.path.exists(path):
+                os.makedirs(path)
+        jobs = [(name, os.path.join(out_dir, table_file(name)), 'csv' if format == 'zip' else format, chunk_rows) for name in names]
+        try:
+            if threads != None and threads > 1 and len(jobs) > 1:
+                pool = ThreadPool(threads)
+                try:
+                    stats = pool.map(self._write_table_job, jobs)
+                finally:
+                    pool.close()
+            else:
+                stats = [self._write_table_job(job) for job in jobs]
+            if format == 'zip' and names:
+                with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as z:
+                    for stat in stats:
+                        z.write(stat['file'], os.path.basename(stat['file']))
+                        stat['file'] = '%s/%s' % (path, os.path.basename(stat['file']))
+        finally:
+            if format == 'zip':
+                shutil.rmtree(out_dir)
+
+        self.write_stats = pd.DataFrame(stats, columns=WRITE_STATS_COLUMNS)
+        for stat in stats:
+            print "wrote  %-16s %10d rows %10.1f MB on disk %8.2f s" % (stat['table'], stat['rows'], stat['file_bytes']/1e6, stat['seconds'])
+        return self.write_stats
+
+    def _write_table_job(self, args):
+        # write one table for write, returning its row of WRITE_STATS_COLUMNS
+        name, filename, format, chunk_rows = args
+        start = time.time()
+        frames = self._iter_stop_times() if name == 'stop_times' and self._partitions != None else [getattr(self, name)]
+        rows = 0
+        if format == 'feather':
+            df = getattr(self, name)
+            pyarrow.feather.write_feather(self.decode_ids(df).reset_index(drop=True), filename)
+            rows = len(df)
+        elif format == 'parquet':
+            rows = self._write_parquet_chunks(frames, filename, chunk_rows)
+        else:
+            with (gzip.open(filename, 'wb') if format == 'csv.gz' else open(filename, 'wb')) as f:
+                for df in frames:
+                    for i in range(0, max(len(df), 1), chunk_rows):
+                        self.decode_ids(df.iloc[i:i+chunk_rows]).to_csv(f, index=False, header=rows == 0 and i == 0)
+                    rows += len(df)
+        return {'table':name, 'file':filename, 'rows':rows, 'file_bytes':os.path.getsize(filename),
+                'seconds':time.time() - start}
+
+    def _write_parquet_chunks(self, frames, filename, chunk_rows):
+        # every chunk has to have the same arrow schema, so categorical columns are written as their
+        # values, as floats if the column has missing values anywhere in the frame.  returns the rows.
+        writer, rows = None, 0
+        try:
+            for df in frames:
+                categoricals = [col for col in df.columns if str(df[col].dtype) == 'category']
+                has_missing = dict((col, (df[col].cat.codes.values < 0).any()) for col in categoricals)
+                for i in range(0, max(len(df), 1), chunk_rows):
+                    chunk = self.decode_ids(df.iloc[i:i+chunk_rows]).reset_index(drop=True)
+                    for col in categoricals:
+                        values = np.asarray(chunk[col])
+                        if has_missing[col] and values.dtype.kind in 'iu':
+                            values = values.astype(np.float64)
+                        chunk[col] = values
+                    table = pyarrow.Table.from_pandas(chunk, preserve_index=False)
+                    if writer is None:
+                        writer = pyarrow.parquet.ParquetWriter(filename, table.schema)
+                    writer.write_table(table)
+                rows += len(df)
+        finally:
+            if writer != None:
+                writer.close()
+        return rows
+
+    @profiled()
+    def export_shapefiles(self, path='.', tag='gtfs', lines=True, stops=False, by_route=False, time_periods=None,
+                          tp_attributes=SHAPEFILE_TP_ATTRIBUTES):
+        '''
+        input:  path, tag:      files are written to path as <tag>_lines.shp and <tag>_stops.shp, or
+                                with by_route, <tag>_<route_id>_<route_short_name>_<direction_id>_lines.shp etc.
+                lines:          write a polyline (from shapes.txt) per route pattern, with its route_statistics
+                stops:          write a point per stop and route direction (from stop_routes)
+                by_route:       one shapefile per route direction rather than one for the feed
+                time_periods:   time period keys in field order, defaults to the sorted self.time_periods keys
+                tp_attributes:  time period fields of the lines, see SHAPEFILE_TP_ATTRIBUTES
+        output: list of the .shp files written
+        requires build_common_dfs
+        '''
+        route_cols = ['route_id','route_short_name','route_long_name','direction_id']
+        route_fields = [('route_id','C',10,0),('route_short_name','C',10,0),('route_long_name','C',50,0),('direction_id','C',15,0)]
+        layers = []
+        if lines:
+            if time_periods is None:
+                time_periods = sorted((self.time_periods or {}).keys())
+            features, geometries = self._get_line_features(time_periods, tp_attributes)
+            fields = route_fields + [('service_id','C',20,0),('pattern_id','C',20,0),('shape_id','C',20,0)]
+            for field, stat, decimals in tp_attributes:
+                fields += [(field % tp,'N',10,decimals) for tp in time_periods]
+            layers.append(('lines', shapefile.POLYLINE, fields, features, geometries))
+        if stops:
+            features = self.stop_routes
+            geometries = np.column_stack([features['stop_lon'].values, features['stop_lat'].values])
+            layers.append(('stops', shapefile.POINT, route_fields + [('stop_id','C',20,0)],
+                           pd.DataFrame(features, columns=route_cols+['stop_id']), geometries))
+
+        written = []
+        for layer, shape_type, fields, features, geometries in layers:
+            features = self.decode_ids(features)
+            records = features[[field[0] for field in fields]].astype(object)
+            records = records.where(pd.notnull(records), None).values.tolist()
+            if not by_route:
+                filename = os.path.join(path, '%s_%s.shp' % (tag, layer))
+                write_shapefile(filename, shape_type, fields, geometries, records)
+                written.append(filename)
+                continue
+            route_codes = group_codes(features, route_cols)
+            order = np.argsort(route_codes, kind='mergesort')
+            bounds = np.flatnonzero(np.diff(route_codes[order])) + 1
+            for rows in np.split(order, bounds):
+                if len(rows) == 0:
+                    continue
+                route = features.iloc[rows[0]]
+                filename = os.path.join(path, '%s_%s_%s_%s_%s.shp' % (tag, route['route_id'], route['route_short_name'], route['direction_id'], layer))
+                write_shapefile(filename, shape_type, fields, [geometries[i] for i in rows], [records[i] for i in rows])
+                written.append(filename)
+        return written
+
+    def _get_line_features(self, time_periods, tp_attributes=SHAPEFILE_TP_ATTRIBUTES):
+        '''
+        output: (DataFrame of route patterns that have a shape, with their route_statistics,
+                 list of (n,2) arrays of shape point lon, lat for each of them)
+        '''
+        idx_cols = self._route_dir_idx_cols+['service_id','pattern_id']
+        stat_cols = [stat % tp for field, stat, decimals in tp_attributes for tp in time_periods]
+        features = pd.DataFrame(self.route_patterns, columns=idx_cols+['shape_id'])
+        # route_statistics has the missing route columns filled with -1
+        for col in self._route_dir_idx_cols:
+            features[col] = features[col].fillna(-1)
+        stats = pd.DataFrame(self.route_statistics, columns=idx_cols+stat_cols)
+        features = pd.merge(features, stats, how='left', on=idx_cols)
+        for col in self._route_dir_idx_cols:
+            features[col] = features[col].replace(-1, np.nan)
+        for field, stat, decimals in tp_attributes:
+            for tp in time_periods:
+                features[field % tp] = features[stat % tp].round(decimals)
+
+        # one sort of the shape points, then split them into a coordinate array per shape
+        shapes = self.shapes[self.shapes['shape_id'].isin(features['shape_id'].dropna().unique())]
+        shape_codes, shape_ids = pd.factorize(np.asarray(shapes['shape_id']))
+        order = np.lexsort((np.asarray(shapes['shape_pt_sequence']), shape_codes))
+        coords = np.column_stack([shapes['shape_pt_lon'].values, shapes['shape_pt_lat'].values])[order]
+        bounds = np.flatnonzero(np.diff(shape_codes[order])) + 1
+        shape_rows = pd.Index(shape_ids).get_indexer(features['shape_id'].values)
+        features = features[shape_rows >= 0].reset_index(drop=True)
+        shape_coords = np.split(coords, bounds)
+        # shape_codes are numbered in order of appearance, so after sorting they index the split parts
+        return features, [shape_coords[i] for i in shape_rows[shape_rows >= 0]]
+
+    @profiled('trips')
     def standardize(self, dir_col='trip_headsign'):
         self._drop_stops_no_times()
         if 'direction_id' not in self.trips.columns.tolist():
@@ -174,97 +1546,550 @@ class GTFSFeed(object):
                 self.trips['direction_id'] = 0 
         #self._assign_direction()
     
-    def build_common_dfs(self):
+    @profiled('stop_times')
+    def build_common_dfs(self, outlier_rule='mean', similarity_method='lcs', processes=None, build_cache=None, keep=None):
+        '''
+        input:  outlier_rule:       see get_route_statistics
+                similarity_method:  see _get_similarity_index
+                processes:          if given, split the per-route work (pattern similarity and route
+                                    statistics) by route_id across this many worker processes
+                build_cache:        optional directory holding route_patterns and route_statistics from
+                                    an earlier build (ex. last week's feed) with a hash of each route's
+                                    routes, trips and stop_times rows.  routes whose hash matches are
+                                    taken from it and only the others are recomputed; the cache is then
+                                    updated with this build.  it is ignored if it was built with other
+                                    time periods, outlier_rule or similarity_method.
+                keep:               optional list of the BUILD_TABLES to keep on self, defaults to all.
+                                    route_trips, route_patterns and route_statistics are always built
+                                    (each needs the one before) and the ones not kept are dropped at the
+                                    end; stop_routes, stop_frequencies, stop_statistics, trip_patterns,
+                                    stop_patterns and segments are only built when they, or a table
+                                    built from them, are kept.  segments are cached with route_statistics
+                                    in build_cache.
+        output: self.<table> for each table kept, the others are None
+                self.build_changes: with a build_cache, a DataFrame of BUILD_CHANGE_COLUMNS listing the
+                                    routes (level 'route') and the patterns of changed routes (level
+                                    'pattern') that were 'added', 'removed' or 'modified' since the
+                                    cached build.  if there was no usable cache, everything is 'added'.
+                self.build_stats:   rows, bytes in memory and seconds for each table built, and the
+                                    peak memory of the process once it was built
+        '''
+        keep = BUILD_TABLES if keep is None else keep
+        unknown = [name for name in keep if name not in BUILD_TABLES]
+        if unknown:
+            raise ValueError("can't keep %s, keep must be a list of %s" % (', '.join(unknown), ', '.join(BUILD_TABLES)))
+        self._build_stats = []
+        self._build_start = time.time()
+        for name in BUILD_TABLES:
+            setattr(self, name, None)
+
         # common groupings
         #   route_trips routes->trips
         self.route_trips        = pd.merge(self.routes,self.trips,on=['route_id'])
+        self._record_build_stats('route_trips', self.route_trips)
         #   stop_routes used_stops->stop_times->trips->routes, keep only stop and route columns
-        self.stop_routes        = pd.merge(self.used_stops, self.stop_times, on=['stop_id'])
-        self.stop_routes        = pd.merge(self.stop_routes, self.trips, on=['trip_id'])
-        self.stop_routes        = pd.merge(self.stop_routes, self.routes, on=['route_id'])
-        self.stop_routes        = pd.DataFrame(self.stop_routes,columns=self.stops.columns.tolist()+self.routes.columns.tolist()+['direction_id'])
-        self.stop_routes        = self.stop_routes.drop_duplicates()
-        
-        self.route_patterns     = self._get_route_patterns()
-        self.route_patterns     = self._get_similarity_index(self.route_patterns, idx_cols=['route_id','direction_id'])
-        non_stop_seq_cols = [x for x in self.route_patterns.columns if x not in self.stop_sequence_cols]
-        self.route_patterns = pd.DataFrame(self.route_patterns, columns=non_stop_seq_cols+self.stop_sequence_cols)
-        pattern_ids = self.route_patterns['pattern_id'].drop_duplicates().tolist()
-        self.trip_patterns      = self.trips[self.trips['trip_id'].isin(pattern_ids)]
-        self.stop_patterns      = self.stop_times[self.stop_times['trip_id'].isin(pattern_ids)]
-        self.stop_patterns      = pd.merge(self.stop_patterns, self.stops, on='stop_id')
-        self.stop_patterns      = self.stop_patterns.sort(['trip_id','stop_sequence'])
-
-        ##if self.has_time_periods == False:
-        sp1 = self.stop_patterns.pivot(index='trip_id',columns='stop_sequence',values='stop_id').reset_index()
-        for col in self.stop_sequence_cols:
-            if col not in sp1.columns.tolist():
-                sp1[col] = np.nan
-
-        sp1 = sp1.fillna(-1).set_index(self.stop_sequence_cols)
-        sp2 = self.stop_times.pivot(index='trip_id',columns='stop_sequence',values='stop_id').reset_index()
-        for col in self.stop_sequence_cols:
-            if col not in sp2.columns.tolist():
-                sp2[col] = np.nan
-                           
-        sp2 = sp2.fillna(-1).set_index(self.stop_sequence_cols)
-
-        sp2['pattern_id'] = sp1['trip_id']
-        sp2 = sp2.reset_index().set_index(['trip_id'])
+        if 'stop_routes' in keep or 'stop_statistics' in keep:
+            self.stop_routes    = self._get_stop_routes()
+            self._record_build_stats('stop_routes', self.stop_routes)
+        if 'stop_frequencies' in keep or 'stop_statistics' in keep:
+            self.stop_frequencies = self.get_stop_frequencies()
+            self._record_build_stats('stop_frequencies', self.stop_frequencies)
+        if 'stop_statistics' in keep:
+            self.stop_statistics = self._get_stop_statistics() # # lines by route, departures
+            self._record_build_stats('stop_statistics', self.stop_statistics)
+
+        trip_pattern_ids        = self._get_trip_id_to_pattern_id()
+        if self._partitions != None:
+            # out of core, stop_times holds just the pattern trips from here on
+            pattern_ids = trip_pattern_ids['pattern_id'].unique()
+            self.stop_times = concat_categorical_frames([stop_times[stop_times['trip_id'].isin(pattern_ids)]
+                                                         for stop_times in self._iter_stop_times()])
+        stats_args = {'outlier_rule':outlier_rule}
+        build_options = {'time_periods':self.time_periods if self.has_time_periods else None,
+                         'outlier_rule':outlier_rule, 'similarity_method':similarity_method}
+        build, self.build_changes = None, None
+        if build_cache != None:
+            route_hashes, pattern_hashes = self._get_build_hashes(trip_pattern_ids)
+            build = self._read_build_cache(build_cache, build_options)
+        if build != None:
+            self.build_changes = self._get_build_changes(build['route_hashes'], build['pattern_hashes'], route_hashes, pattern_hashes)
+            changes = self.build_changes[self.build_changes['level'] == 'route']
+            changed_route_ids = self.encode_ids(changes[changes['change'] != 'removed'])['route_id']
+            changed_trip_ids = self.trips.loc[self.trips['route_id'].isin(changed_route_ids), 'trip_id']
+            self.route_patterns = self._get_route_patterns(trip_pattern_ids[trip_pattern_ids['trip_id'].isin(changed_trip_ids)])
+        else:
+            if build_cache != None:
+                self.build_changes = self._get_build_changes(route_hashes.iloc[:0], pattern_hashes.iloc[:0], route_hashes, pattern_hashes)
+            self.route_patterns = self._get_route_patterns(trip_pattern_ids)
+
         self.route_trips = self.route_trips.set_index(['trip_id'])
-        self.route_trips['pattern_id'] = sp2['pattern_id']
-        trips_with_departure = self.get_trip_departure_times(self.trips, self.stop_times)
-        trips_with_departure = trips_with_departure.set_index(['trip_id'])
-        self.route_trips['trip_departure_time'] = trips_with_departure['trip_departure_time']
-        self.route_trips['trip_departure_mpm'] = trips_with_departure['trip_departure_mpm']
+        self.route_trips['pattern_id'] = trip_pattern_ids.set_index('trip_id')['pattern_id']
         self.route_trips = self.route_trips.reset_index()
+        # shared with apply_time_periods, computed here if time periods weren't applied
+        if self.trip_times is None:
+            self.trip_times = self._get_all_trip_times()
+        self.route_trips = self._attach_trip_times(self.route_trips, self.trip_times)
     
         #self.route_trips.to_csv('route_trips.csv')
         # statistics
-        self.route_statistics   = self._get_route_statistics() # frequency by route
-        self.stop_statistics    = self._get_stop_statistics() # # lines by route,
+        if build != None:
+            self._splice_route_tables(build, changes['route_id'], similarity_method, stats_args, processes)
+        else:
+            self._set_route_tables(similarity_method, stats_args, processes) # frequency by route
+        self._record_build_stats('route_patterns', self.route_patterns)
+        self._record_build_stats('route_statistics', self.route_statistics)
+        if 'segments' in keep:
+            if build != None and build['segments'] is not None:
+                self.segments = self._splice_segments(build['segments'], changes['route_id'])
+            else:
+                self.segments = self.get_segments()
+            self._record_build_stats('segments', self.segments)
+        if build_cache != None:
+            self._write_build_cache(build_cache, build_options, route_hashes, pattern_hashes)
+
+        pattern_ids = self.route_patterns['pattern_id'].drop_duplicates()
+        if 'trip_patterns' in keep:
+            self.trip_patterns  = self.trips[self.trips['trip_id'].isin(pattern_ids)]
+            self._record_build_stats('trip_patterns', self.trip_patterns)
+        if 'stop_patterns' in keep:
+            self.stop_patterns  = self.stop_times[self.stop_times['trip_id'].isin(pattern_ids)]
+            self.stop_patterns  = pd.merge(self.stop_patterns, self.stops, on='stop_id')
+            self.stop_patterns  = self.stop_patterns.sort_values(['trip_id','stop_sequence'])
+            self._record_build_stats('stop_patterns', self.stop_patterns)
 
-        self.all_files += ['route_trips.txt', 'stop_routes.txt', 'route_patterns.txt', 'trip_patterns.txt', 'stop_patterns.txt', 'route_statistics.txt', 'stop_statistics.txt']
-        self.all_names += ['route_trips', 'stop_routes', 'route_patterns', 'trip_patterns', 'stop_patterns', 'route_statistics', 'stop_statistics']
+        for name in BUILD_TABLES:
+            if name not in keep:
+                setattr(self, name, None)
+            elif name not in self.all_names:
+                self.all_files.append(name + '.txt')
+                self.all_names.append(name)
+        peak = peak_memory_mb()
+        print "built %d tables in %.2f s, peak memory %s MB" % (len(self.build_stats), time.time()-self._build_start,
+                                                               '%.1f' % peak if peak != None else 'unknown')
 
-    def get_route_statistics(self, pivot_timeperiods=True):
-        self.route_statistics = self._get_route_statistics(pivot_timeperiods)
+    def _record_build_stats(self, name, df):
+        # seconds are since the previous table
+        now = time.time()
+        previous = self._build_stats[-1]['end'] if self._build_stats else self._build_start
+        self._build_stats.append({'table':name,'rows':len(df),
+                                  'memory_bytes':df.memory_usage(index=True, deep=True).sum(),
+                                  'seconds':now-previous,'peak_memory_mb':peak_memory_mb(),'end':now})
+        self.build_stats = pd.DataFrame(self._build_stats, columns=BUILD_STATS_COLUMNS)
+
+    @profiled('stop_times')
+    def _get_stop_routes(self):
+        '''
+        output: DataFrame of the stops and routes columns and direction_id, with a row for each stop,
+                route and direction with a stop_time at the stop
+        The stop, route and direction of every stop_time are reduced to unique codes before anything
+        is merged, so nothing stop_times long or stop_times wide is built.
+        '''
+        route_dirs = group_codes(self.trips, ['route_id','direction_id'])
+        _, route_dir_trips = np.unique(route_dirs, return_index=True)
+        trip_index = pd.Index(np.asarray(self.trips['trip_id']))
+        stop_route_dirs = []
+        for stop_times in self._iter_stop_times('stop_id'):
+            stop_codes, stop_ids = category_codes(stop_times['stop_id'])
+            trip_codes, trip_ids = category_codes(stop_times['trip_id'])
+            # route and direction of each stop_time, -1 for trips that aren't in trips
+            trip_route_dirs = np.r_[route_dirs, -1][trip_index.get_indexer(trip_ids)]
+            stop_time_route_dirs = np.r_[trip_route_dirs, -1][trip_codes]
+            valid = (stop_time_route_dirs >= 0) & (stop_codes >= 0)
+            keys = np.unique(stop_codes[valid].astype(np.int64) * len(route_dir_trips) + stop_time_route_dirs[valid])
+            stop_route_dirs.append(pd.DataFrame({'stop_id':np.asarray(stop_ids.take(keys // len(route_dir_trips))),
+                                                 'route_dir':keys % len(route_dir_trips)}))
+        # out of core, every stop is in one partition so there are no duplicates to drop
+        stop_route_dirs = stop_route_dirs[0] if len(stop_route_dirs) == 1 else pd.concat(stop_route_dirs, ignore_index=True)
+
+        trips = self.trips.iloc[route_dir_trips[stop_route_dirs['route_dir'].values]]
+        stop_routes = pd.DataFrame({'stop_id':stop_route_dirs['stop_id'].values,
+                                    'route_id':trips['route_id'].values,
+                                    'direction_id':trips['direction_id'].values})
+        stop_routes = pd.merge(self.used_stops, stop_routes, on=['stop_id'])
+        stop_routes = pd.merge(stop_routes, self.routes, on=['route_id'])
+        stop_routes = pd.DataFrame(stop_routes,columns=self.stops.columns.tolist()+self.routes.columns.tolist()+['direction_id'])
+        return stop_routes.drop_duplicates()
+
+    @profiled('route_trips')
+    def _set_route_tables(self, similarity_method=None, stats_args=None, processes=None):
+        '''
+        input:  similarity_method:  if not None, add the similarity index to self.route_patterns
+                stats_args:         if not None, set self.route_statistics with these _get_route_statistics
+                                    arguments
+                processes:          None to do the work here, or a number of worker processes to split
+                                    it across by route_id
+        Both steps only compare trips and patterns within a route, so each partition is sent only its
+        routes' route_trips, route_patterns and pattern stop_times, and the results are the same as the
+        serial ones.
+        '''
+        if processes is None:
+            if similarity_method != None:
+                self.route_patterns = self._get_similarity_index(self.route_patterns, idx_cols=['route_id','direction_id'], method=similarity_method)
+            if stats_args != None:
+                self.route_statistics = self._get_route_statistics(**stats_args)
+            return
+
+        # contiguous ranges of the sorted route_ids, so the partitions come back in the serial order,
+        # with about the same number of trips in each
+        route_ids = np.unique(np.r_[self.route_patterns['route_id'].values, self.route_trips['route_id'].values])
+        trips_per_route = self.route_trips.groupby('route_id').size().reindex(route_ids).fillna(0).values
+        cum_trips = np.cumsum(trips_per_route)
+        partitions = min(processes * 4, len(route_ids))
+        bounds = np.searchsorted(cum_trips, np.linspace(0, cum_trips[-1] if len(cum_trips) else 0, partitions+1)[1:-1], side='right')
+        jobs = []
+        for partition_route_ids in np.split(route_ids, np.unique(bounds)):
+            if len(partition_route_ids) > 0:
+                jobs.append((self._get_route_state(partition_route_ids), similarity_method, stats_args))
+
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_route_partition_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        route_patterns = pd.concat([result[0] for result in results])
+        # back to the serial row order
+        order = np.argsort(self.route_patterns.index.get_indexer(route_patterns.index), kind='mergesort')
+        self.route_patterns = route_patterns.iloc[order]
+        self._route_pattern_info_cols = results[0][2]
+        if stats_args != None:
+            route_statistics = pd.concat([result[1] for result in results], ignore_index=True)
+            if stats_args.get('pivot_timeperiods', True) and self.has_time_periods:
+                # one row per route_patterns row
+                route_statistics = route_statistics.iloc[order].reset_index(drop=True)
+            self.route_statistics = route_statistics
+
+    def _get_route_state(self, route_ids=None):
+        # the attributes _route_partition_job needs, for route_ids (all routes if None).  ids are plain
+        # values so the categoricals' full category lists aren't sent with every partition.
+        route_trips, route_patterns = self.route_trips, self.route_patterns
+        if route_ids is not None:
+            route_trips = route_trips[route_trips['route_id'].isin(route_ids)]
+            route_patterns = route_patterns[route_patterns['route_id'].isin(route_ids)]
+        stop_times = self.stop_times[self.stop_times['trip_id'].isin(route_patterns['pattern_id'].unique())]
+        stop_times = pd.DataFrame({'trip_id':np.asarray(stop_times['trip_id']),
+                                   'stop_sequence':np.asarray(stop_times['stop_sequence']),
+                                   'stop_id':np.asarray(stop_times['stop_id'])})
+        state = {'route_trips':route_trips, 'route_patterns':route_patterns, 'stop_times':stop_times}
+        for name in ['time_periods','has_time_periods','_tp_idx_cols','_route_dir_idx_cols','_route_pattern_info_cols']:
+            state[name] = getattr(self, name)
+        return state
+
+    @profiled('route_trips')
+    def get_route_statistics(self, pivot_timeperiods=True, outlier_rule='mean', processes=None, **outlier_args):
+        '''
+        input:  pivot_timeperiods:  one row per pattern with per-time period columns, rather than one
+                                    row per pattern and time period
+                outlier_rule:       headways to leave out of the headway statistics, a key of
+                                    HEADWAY_OUTLIER_RULES or a function like those
+                processes:          if given, split the work by route_id across this many worker
+                                    processes (outlier_rule functions must then be picklable)
+                outlier_args:       passed to the outlier rule, ex. multiple=3 for 'mean'
+        output: self.route_statistics
+        '''
+        stats_args = dict(outlier_args, pivot_timeperiods=pivot_timeperiods, outlier_rule=outlier_rule)
+        self._set_route_tables(None, stats_args, processes)
         return self.route_statistics
     
-    def spatial_match_stops(self, left, right):
-        pass
+    @profiled('stop_times')
+    def _get_build_hashes(self, trip_pattern_ids):
+        '''
+        input:  trip_pattern_ids (see _get_trip_id_to_pattern_id)
+        output: route_hashes:   Series of uint64 indexed by route_id, a hash of the route's routes row
+                                and its trips' trips rows, stop_times rows and pattern_ids
+                pattern_hashes: DataFrame of route_id, pattern_id, hash of the pattern's trips within
+                                the route
+        pattern_ids are included because a pattern shared between routes takes its id from whichever
+        route has the first trip, so a route can change without any of its own rows changing.
+        '''
+        trip_ids = pd.Index(np.asarray(self.trips['trip_id']))
+        trip_hashes = hash_rows(self.trips, ids=self._get_id_columns(self.trips))
+        for df in itertools.chain(self._iter_stop_times(), [trip_pattern_ids[['trip_id','pattern_id']]]):
+            codes = trip_ids.get_indexer(np.asarray(df['trip_id']))
+            trip_hashes += _sum_hashes(codes[codes >= 0], hash_rows(df, ids=self._get_id_columns(df))[codes >= 0], len(trip_ids))
+        trip_hashes = _mix_stop_positions(trip_hashes, np.zeros(len(trip_ids), dtype=np.uint64), 4)
+
+        route_ids = pd.Index(np.asarray(self.routes['route_id']))
+        codes = route_ids.get_indexer(np.asarray(self.trips['route_id']))
+        route_hashes = hash_rows(self.routes, ids=self._get_id_columns(self.routes)) + _sum_hashes(codes[codes >= 0], trip_hashes[codes >= 0], len(route_ids))
+        route_hashes = pd.Series(route_hashes, index=route_ids)
+
+        trips = pd.DataFrame({'route_id':np.asarray(self.trips['route_id']),
+                              'pattern_id':trip_pattern_ids.set_index('trip_id')['pattern_id'].reindex(trip_ids).values})
+        has_pattern = trips['pattern_id'].notnull().values & (codes >= 0)
+        trips = trips[has_pattern]
+        codes = group_codes(trips, ['route_id','pattern_id'])
+        _, first = np.unique(codes, return_index=True)
+        pattern_hashes = trips.iloc[first].reset_index(drop=True)
+        pattern_hashes['hash'] = _sum_hashes(codes, trip_hashes[has_pattern], len(first))
+        # by the ids themselves, so builds compare whether or not their ids were interned
+        if self.ids != None:
+            route_hashes.index = pd.Index(decode_id_codes(self.ids['route_id'], route_hashes.index.values))
+        return route_hashes, self.decode_ids(pd.DataFrame(pattern_hashes, columns=['route_id','pattern_id','hash']))
+
+    def _get_id_columns(self, df):
+        # the interned id columns of df, for hash_rows
+        if self.ids is None:
+            return None
+        return dict((col, self.ids[ID_COLUMNS[col]]) for col in df.columns if col in ID_COLUMNS and ID_COLUMNS[col] in self.ids)
+
+    def _get_build_changes(self, old_route_hashes, old_pattern_hashes, route_hashes, pattern_hashes):
+        # routes added, removed or modified between two sets of _get_build_hashes, and the
+        # patterns added, removed or modified within them
+        both = route_hashes.index.intersection(old_route_hashes.index)
+        modified = both[route_hashes.reindex(both).values != old_route_hashes.reindex(both).values]
+        changes = []
+        for change, route_ids in [('added', route_hashes.index.difference(old_route_hashes.index)),
+                                  ('removed', old_route_hashes.index.difference(route_hashes.index)),
+                                  ('modified', modified)]:
+            changes.append(pd.DataFrame({'level':'route', 'change':change, 'route_id':np.asarray(route_ids)}))
+        changes = pd.concat(changes, ignore_index=True)
+
+        patterns = pd.merge(old_pattern_hashes, pattern_hashes, how='outer', on=['route_id','pattern_id'], indicator=True)
+        patterns = patterns[patterns['route_id'].isin(changes['route_id'])]
+        patterns['change'] = patterns['_merge'].map({'left_only':'removed','right_only':'added','both':'modified'})
+        patterns = patterns[(patterns['change'] != 'modified') | (patterns['hash_x'] != patterns['hash_y'])]
+        patterns['level'] = 'pattern'
+        # keeps integer pattern_ids from turning into floats next to the route rows' NaNs
+        patterns['pattern_id'] = patterns['pattern_id'].astype(object)
+        changes = pd.concat([changes, patterns], ignore_index=True)
+        changes = changes.sort_values(['level','route_id'], ascending=[False,True], kind='mergesort')
+        return pd.DataFrame(changes, columns=BUILD_CHANGE_COLUMNS).reset_index(drop=True)
+
+    def _read_build_cache(self, build_cache, options):
+        manifest_file = os.path.join(build_cache, 'manifest.json')
+        if not os.path.exists(manifest_file):
+            return None
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        try:
+            options = json.loads(json.dumps(options))
+        except TypeError:
+            print "build options can't be compared with the cache at %s (ex. a function outlier_rule), rebuilding" % build_cache
+            return None
+        if manifest.get('version') != BUILD_CACHE_VERSION or manifest['options'] != options:
+            print "build cache at %s was built with different options, rebuilding" % build_cache
+            return None
+        build = {'route_pattern_info_cols':manifest['route_pattern_info_cols']}
+        for name in ['route_hashes','pattern_hashes','route_patterns','route_statistics']:
+            build[name] = pd.read_pickle(os.path.join(build_cache, name + '.pkl'))
+        # builds that didn't keep segments don't cache them
+        build['segments'] = pd.read_pickle(os.path.join(build_cache, 'segments.pkl')) if manifest.get('segments') else None
+        return build
+
+    def _write_build_cache(self, build_cache, options, route_hashes, pattern_hashes):
+        try:
+            options = json.loads(json.dumps(options))
+        except TypeError:
+            print "build options can't be saved (ex. a function outlier_rule), not writing build cache to %s" % build_cache
+            return
+        if not os.path.exists(build_cache):
+            os.makedirs(build_cache)
+        manifest_file = os.path.join(build_cache, 'manifest.json')
+        if os.path.exists(manifest_file):
+            # invalidate the old build before overwriting any of its tables
+            os.remove(manifest_file)
+        tables = [('route_hashes',route_hashes), ('pattern_hashes',pattern_hashes),
+                  ('route_patterns',self.decode_ids(self.route_patterns)),
+                  ('route_statistics',self.decode_ids(self.route_statistics))]
+        if isinstance(self.segments, pd.DataFrame):
+            tables.append(('segments',self.decode_ids(self.segments)))
+        for name, df in tables:
+            df.to_pickle(os.path.join(build_cache, name + '.pkl'))
+        manifest = {'version':BUILD_CACHE_VERSION,
+                    'options':options,
+                    'route_pattern_info_cols':self._route_pattern_info_cols,
+                    'segments':isinstance(self.segments, pd.DataFrame)}
+        with open(manifest_file, 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    @profiled('route_trips')
+    def _splice_route_tables(self, build, route_ids, similarity_method, stats_args, processes=None):
+        '''
+        input:  build:      see _read_build_cache
+                route_ids:  routes added, removed or modified since the build (ids, not codes).
+                            self.route_patterns holds the patterns of the ones still in the feed.
+        output: self.route_patterns and self.route_statistics, the build's with the rows of route_ids
+                replaced by ones computed here (see _set_route_tables)
+        '''
+        # the build is cached with ids rather than codes
+        route_patterns = self.encode_ids(build['route_patterns'][~build['route_patterns']['route_id'].isin(route_ids)])
+        route_statistics = self.encode_ids(build['route_statistics'][~build['route_statistics']['route_id'].isin(route_ids)])
+        self._route_pattern_info_cols = build['route_pattern_info_cols']
+        route_ids = self.encode_ids(pd.DataFrame({'route_id':route_ids}))['route_id']
+        changed = pd.Index(route_ids).intersection(pd.Index(self.route_trips['route_id'].unique()))
+        if len(changed) > 0:
+            feed = _feed_from_route_state(self._get_route_state(changed))
+            feed._set_route_tables(similarity_method, stats_args, processes)
+            route_patterns = pd.concat([route_patterns, feed.route_patterns])
+            route_statistics = pd.concat([route_statistics, feed.route_statistics])
+            self._route_pattern_info_cols = feed._route_pattern_info_cols
+        # a full build is sorted by route_id first, and keeps each route's rows in order
+        order = np.argsort(route_patterns['route_id'].values, kind='mergesort')
+        self.route_patterns = route_patterns.iloc[order].reset_index(drop=True)
+        order = np.argsort(route_statistics['route_id'].values, kind='mergesort')
+        self.route_statistics = route_statistics.iloc[order].reset_index(drop=True)
+
+    def _splice_segments(self, segments, route_ids):
+        '''
+        input:  segments:   the cached build's (see _read_build_cache)
+                route_ids:  routes added, removed or modified since the build (ids, not codes)
+        output: segments with the rows of route_ids replaced by get_segments of them
+        '''
+        segments = self.encode_ids(segments[~segments['route_id'].isin(route_ids)])
+        route_ids = self.encode_ids(pd.DataFrame({'route_id':route_ids}))['route_id']
+        changed = pd.Index(route_ids).intersection(pd.Index(self.route_trips['route_id'].unique()))
+        if len(changed) > 0:
+            segments = concat_categorical_frames([segments, self.get_segments(changed)])
+        # get_segments is sorted by route_id first, and keeps each route's rows in order
+        order = np.argsort(segments['route_id'].values, kind='mergesort')
+        return segments.iloc[order].reset_index(drop=True)
+
+    def spatial_match_stops(self, left, right, k=4, threshold=50, projection=None, keep_unmatched=True):
+        '''
+        input:  left, right:    GTFSFeeds (their used_stops are matched) or DataFrames of stops with
+                                stop_id, stop_lat and stop_lon.  Repeated stop_ids are matched once.
+                k:              number of nearest right stops to keep for each left stop
+                threshold:      maximum distance, in the units of the projection (None for no limit)
+                projection:     see project_lonlat; the default measures distances in meters
+                keep_unmatched: include left stops without any right stop within threshold, with an
+                                empty match
+        output: DataFrame of stop_id (left), match_stop_id (right), rank (1 is the nearest) and distance
+        '''
+        stops = []
+        for side in [left, right]:
+            if isinstance(side, GTFSFeed):
+                side = side.used_stops
+            stops.append(side.drop_duplicates(subset=['stop_id']))
+        left, right = stops
+        # one projection call for both sides, so they share the same reference latitude
+        xy = np.column_stack(project_lonlat(np.r_[left['stop_lon'].values, right['stop_lon'].values],
+                                            np.r_[left['stop_lat'].values, right['stop_lat'].values], projection))
+        left_idx, right_idx, rank, distance = match_points(xy[:len(left)], xy[len(left):], k, threshold)
+
+        matches = pd.DataFrame({'stop_id':left['stop_id'].values.take(left_idx),
+                                'match_stop_id':right['stop_id'].values.take(right_idx),
+                                'rank':rank,
+                                'distance':distance}, columns=['stop_id','match_stop_id','rank','distance'])
+        unmatched = np.setdiff1d(np.arange(len(left)), left_idx)
+        if keep_unmatched and len(unmatched) > 0:
+            unmatched = pd.DataFrame({'stop_id':left['stop_id'].values.take(unmatched)}, columns=matches.columns)
+            matches = pd.concat([matches, unmatched], ignore_index=True)
+        return matches
         
     def _drop_stops_no_times(self):
+        if self._partitions != None:
+            # dropped from each partition as it is read
+            self._partitions['drop_untimed'] = True
+            return
         self.stop_times = self.stop_times[(pd.isnull(self.stop_times['arrival_time']) != True)
                                           & (pd.isnull(self.stop_times['departure_time']) != True)]
 
+    @profiled('trips')
     def drop_weekend(self):
         self.weekday_only = True
         self.trips = self.trips[self.trips['service_id'].isin(self.weekday_service_ids)]
         self.route_statistics = self.route_statistics[self.route_statistics['service_id'].isin(self.weekday_service_ids)]
         self.route_patterns = self.route_patterns[self.route_patterns['service_id'].isin(self.weekday_service_ids)]
         
+    @profiled('trips')
     def drop_days(self, days=['saturday','sunday']):
-        service_ids = []
-        for day in days:
-            service_ids += self.get_service_ids_by_day(day)
+        # services that typically run on any of the days
+        service_ids = self.get_typical_service_ids(days)
         self.trips = self.trips[self.trips['service_id'].isin(service_ids) != True]
         self.route_statistics = self.route_statistics[self.route_statistics['service_id'].isin(service_ids) != True]
         self.route_patterns = self.route_patterns[self.route_patterns['service_id'].isin(service_ids) != True]
         
     def get_service_ids_by_day(self, day='monday'):
-        service_ids = self.calendar[self.calendar[day] == 1]['service_id'].tolist()
-        return list(set(service_ids))
+        return self.get_typical_service_ids([day])
     
-    def _get_weekday_service_ids(self, weekdays=['monday','tuesday','wednesday','thursday','friday']):
-        weekday_service_ids = []
-        for day in weekdays:
-            weekday_service_ids += self.calendar[self.calendar[day] == 1]['service_id'].tolist()
-        weekday_service_ids = list(set(weekday_service_ids))
-        return weekday_service_ids
+    def _get_weekday_service_ids(self, weekdays=WEEKDAYS):
+        return self.get_typical_service_ids(weekdays)
+
+    def get_typical_service_ids(self, days=WEEKDAYS, start=None, end=None, min_share=0.5):
+        '''
+        input:  days:       calendar.txt day names (see DAYS)
+                start, end: dates to look at (see to_date), defaulting to self.service_period and then
+                            to the first and last dates of self.service_dates
+                min_share:  share of a day's dates that a service has to run on to count for that day.
+                            each service is measured over its own dates within start to end: its
+                            calendar.txt start_date to end_date, or for a service only given in
+                            calendar_dates its first to last date if that spans at least a week.
+        output: list of the service_ids that typically run on any of days
+        Unlike the calendar.txt day flags alone, this leaves out services that have ended or not yet
+        started, holiday-only services, and includes services only given in calendar_dates.  As each
+        service is measured over its own dates, feeds with back to back service periods (ex. a
+        calendar row per season) keep the services of every period.
+        '''
+        if self.service_dates is None:
+            return []
+        shares = self._get_day_shares(start, end)
+        return shares.index[(shares[days].values >= min_share).any(axis=1)].tolist()
+
+    def _get_day_shares(self, start=None, end=None):
+        # DataFrame of service_id by day name, the share of the day's dates in the service's own
+        # window (see get_typical_service_ids) from start to end that the service runs on
+        period = self.service_period or (None, None)
+        start = to_date(start if start != None else period[0]) if start != None or period[0] != None else None
+        end = to_date(end if end != None else period[1]) if end != None or period[1] != None else None
+        dates = self.service_dates.columns
+        active = self.service_dates.values
+        window = self._get_service_windows()
+        if start != None:
+            window &= dates.values >= start
+        if end != None:
+            window &= dates.values <= end
+        day_of_week = dates.dayofweek
+        shares = np.zeros((len(self.service_dates), len(DAYS)))
+        for i in range(len(DAYS)):
+            days = window & (day_of_week == i)
+            counts = days.sum(axis=1)
+            shares[:,i] = np.where(counts > 0, (active & days).sum(axis=1) / np.maximum(counts, 1).astype(float), 0)
+        return pd.DataFrame(shares, index=self.service_dates.index, columns=DAYS)
+
+    def _get_service_windows(self):
+        # bool array like service_dates, True on the dates from each service's calendar.txt
+        # start_date to end_date.  services only in calendar_dates get their first to last date if
+        # that spans at least a week, and otherwise (ex. a holiday service) every date.
+        dates = self.service_dates.columns
+        active = self.service_dates.values
+        positions = np.arange(len(dates))
+        first = active.argmax(axis=1)
+        last = len(dates) - 1 - active[:,::-1].argmax(axis=1)
+        spans = active.any(axis=1) & (last - first >= 6)
+        window = np.ones(active.shape, dtype=bool)
+        window[spans] = (positions >= first[spans,None]) & (positions <= last[spans,None])
+        if isinstance(self.calendar, pd.DataFrame) and len(self.calendar) > 0:
+            rows = self.service_dates.index.get_indexer(np.asarray(self.calendar['service_id']))
+            starts = gtfs_dates(self.calendar['start_date']).values[rows >= 0]
+            ends = gtfs_dates(self.calendar['end_date']).values[rows >= 0]
+            window[rows[rows >= 0]] = (dates.values >= starts[:,None]) & (dates.values <= ends[:,None])
+        return window
+
+    def get_active_service_ids(self, date):
+        '''
+        input:  date (see to_date)
+        output: list of the service_ids that run on the date
+        '''
+        date = to_date(date)
+        if self.service_dates is None or date not in self.service_dates.columns:
+            return []
+        return self.service_dates.index[self.service_dates[date].values].tolist()
 
+    def get_active_trips(self, date):
+        '''
+        input:  date (see to_date)
+        output: the trips that run on the date
+        '''
+        return self.trips[self.trips['service_id'].isin(self.get_active_service_ids(date))]
+
+    @profiled('stops')
     def _get_used_stops(self):
-        used_stops = pd.DataFrame(self.stop_times,columns=['stop_id'])
+        if self._partitions != None:
+            used_stops = pd.DataFrame({'stop_id':self._partitions['ids']['stop_id']})
+        else:
+            used_stops = pd.DataFrame(self.stop_times,columns=['stop_id'])
         used_stops = used_stops.drop_duplicates()
         used_stops['used_flag'] = 1
         used_stops = used_stops.set_index('stop_id')
@@ -275,13 +2100,64 @@ class GTFSFeed(object):
         return stops
 
     def get_trip_departure_times(self, trips, stop_times):
-        first_stops = stop_times.groupby('trip_id')
-        for name, group in first_stops:
-            stop_time = group.loc[group['stop_sequence'].idxmin(),'arrival_time']
-            trips.loc[trips['trip_id']==name,'trip_departure_time'] = stop_time
-        trips['trip_departure_mpm'] = trips['trip_departure_time'].map(HHMMSS_to_MPM)
-        return trips
+        '''
+        input:  trips, stop_times
+        output: trips with the columns of _get_trip_times attached
+        '''
+        trip_times = self._get_trip_times(stop_times)
+        return self._attach_trip_times(trips, trip_times)
+
+    @profiled()
+    def _get_trip_times(self, stop_times):
+        '''
+        input:  stop_times
+        output: DataFrame with one row per trip_id and columns
+                    trip_departure_time, trip_departure_mpm:    departure from the first timed stop
+                    trip_arrival_time, trip_arrival_mpm:        arrival at the last timed stop
+                    trip_duration_minutes:                      trip_arrival_mpm - trip_departure_mpm
+                    trip_num_stops:                             number of stop_times
+                "first" and "last" are by stop_sequence.  A missing departure falls back to the arrival
+                time at the same stop and vice versa; stops with neither are skipped.
+        '''
+        trip_codes, trip_ids = pd.factorize(np.asarray(stop_times['trip_id']), sort=True)
+        arr_secs = HHMMSS_to_seconds(stop_times['arrival_time'])
+        dep_secs = HHMMSS_to_seconds(stop_times['departure_time'])
+        dep_secs_filled = np.where(dep_secs != MISSING_TIME, dep_secs, arr_secs)
+        arr_secs_filled = np.where(arr_secs != MISSING_TIME, arr_secs, dep_secs)
+
+        trip_times = pd.DataFrame({'trip_id':trip_ids})
+        trip_times['trip_num_stops'] = np.bincount(trip_codes[trip_codes >= 0], minlength=len(trip_ids))
+
+        # sort the timed stops once, then the first and last row of each trip are its ends
+        timed = np.flatnonzero((trip_codes >= 0) & (dep_secs_filled != MISSING_TIME))
+        timed = timed[np.lexsort((np.asarray(stop_times['stop_sequence'])[timed], trip_codes[timed]))]
+        sorted_codes = trip_codes[timed]
+        is_first = np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]
+        is_last = np.r_[sorted_codes[1:] != sorted_codes[:-1], True]
+        first, last = timed[is_first], timed[is_last]
+
+        dep_times = np.where(dep_secs[first] != MISSING_TIME, np.asarray(stop_times['departure_time'].iloc[first], dtype=object),
+                             np.asarray(stop_times['arrival_time'].iloc[first], dtype=object))
+        arr_times = np.where(arr_secs[last] != MISSING_TIME, np.asarray(stop_times['arrival_time'].iloc[last], dtype=object),
+                             np.asarray(stop_times['departure_time'].iloc[last], dtype=object))
+        trip_times['trip_departure_time'] = pd.Series(dep_times, index=trip_codes[first])
+        trip_times['trip_departure_mpm'] = pd.Series(seconds_to_MPM(dep_secs_filled[first]), index=trip_codes[first])
+        trip_times['trip_arrival_time'] = pd.Series(arr_times, index=trip_codes[last])
+        trip_times['trip_arrival_mpm'] = pd.Series(seconds_to_MPM(arr_secs_filled[last]), index=trip_codes[last])
+        trip_times['trip_duration_minutes'] = trip_times['trip_arrival_mpm'] - trip_times['trip_departure_mpm']
+        return pd.DataFrame(trip_times, columns=['trip_id','trip_departure_time','trip_departure_mpm','trip_arrival_time',
+                                                 'trip_arrival_mpm','trip_duration_minutes','trip_num_stops'])
+
+    @profiled()
+    def _attach_trip_times(self, df, trip_times):
+        # set the trip_times columns on df (which has a trip_id column), replacing any already there
+        trip_times = trip_times.set_index('trip_id')
+        df = df.set_index(['trip_id'])
+        for col in trip_times.columns:
+            df[col] = trip_times[col]
+        return df.reset_index()
     
+    @profiled('stop_times')
     def apply_time_periods(self, time_periods):
         '''
         input: time_periods: dict of timeperiod key to time range (in str format: hh:mm:ss-hh:mm:ss)
@@ -289,46 +2165,60 @@ class GTFSFeed(object):
             self._tp_idx_cols:      add 'trip_departure_tp'
             self.time_periods:      holds time_periods
             self.has_time_periods:  set to True
-            self.stop_times:        add columns arr_mpm, dep_mpm, arr_tp, dep_tp
-            self.trips:             add columns trip_departure_time, trip_departure_mpm, trip_departure_tp
+            self.stop_times:        add columns arr_mpm, dep_mpm, arr_tp, dep_tp (categorical)
+            self.trip_times:        per-trip first/last stop times (see _get_trip_times) plus trip_departure_tp
+            self.trips:             add the columns of self.trip_times
+        raises ValueError if the time periods are malformed or overlap
         '''
-        # update column collections
-        self._tp_idx_cols += ['trip_departure_tp']
-        self.time_periods = time_periods
-        self.has_time_periods = True        
         if time_periods != None and not isinstance(time_periods,list) and not isinstance(time_periods,dict):
             raise Exception("time_periods MUST be None-type OR list-type of HH:MM:SS-HH:MM:SS pairs")
-
-        self.stop_times['arr_mpm'] = self.stop_times['arrival_time'].map(HHMMSS_to_MPM)
-        self.stop_times['dep_mpm'] = self.stop_times['departure_time'].map(HHMMSS_to_MPM)
-        self.stop_times['arr_tp'] = 'other'
-        self.stop_times['dep_tp'] = 'other'
+        if time_periods is None:
+            time_periods = {}
         if isinstance(time_periods, list):
             ntp = {}
             for ctp in time_periods:
                 ntp['%s' % ctp] = ctp
             time_periods = ntp
+        # validate the period definitions before touching any state
+        get_time_period_breakpoints(time_periods)
+
+        # update column collections
+        self._tp_idx_cols += ['trip_departure_tp']
+        self.time_periods = time_periods
+        self.has_time_periods = True
+
+        if self._partitions is None:
+            # out of core partitions get them as they are read
+            self._add_stop_time_periods(self.stop_times)
 
-        for key, value in time_periods.iteritems():
-            tp_name = key
-            tp_start, tp_end = HHMMSSpair_to_MPMpair(value)
-            arr_idx = self.stop_times[(self.stop_times['arr_mpm'].between(tp_start,tp_end))
-                                      | (self.stop_times['arr_mpm'].between(tp_start-24*60,tp_end-24*60))
-                                      | (self.stop_times['arr_mpm'].between(tp_start+24*60,tp_end+24*60))].index
-            dep_idx = self.stop_times[(self.stop_times['dep_mpm'].between(tp_start,tp_end))
-                                      | (self.stop_times['dep_mpm'].between(tp_start-24*60,tp_end-24*60))
-                                      | (self.stop_times['dep_mpm'].between(tp_start+24*60,tp_end+24*60))].index
-            self.stop_times.loc[arr_idx,'arr_tp'] = key
-            self.stop_times.loc[dep_idx,'dep_tp'] = key
-
-        first_stop = self.stop_times.groupby(['trip_id']).first()
-        self.trips = self.trips.set_index(['trip_id'])
-        self.trips['trip_departure_time'] = first_stop['departure_time']
-        self.trips['trip_departure_mpm'] = first_stop['dep_mpm']
-        self.trips['trip_departure_tp'] = first_stop['dep_tp']
-        self.trips = self.trips.reset_index()
+        self.trip_times = self._get_all_trip_times()
+        # plain labels here, trips get grouped and filled with the route/pattern index columns
+        trip_departure_secs = HHMMSS_to_seconds(self.trip_times['trip_departure_time'])
+        self.trip_times['trip_departure_tp'] = np.asarray(assign_time_periods(trip_departure_secs, time_periods)).astype(object)
+        self.trips = self._attach_trip_times(self.trips, self.trip_times)
                 
-    def _get_route_statistics(self, pivot_timeperiods=True):
+    def _add_stop_time_periods(self, stop_times):
+        # the stop_times columns of apply_time_periods
+        arr_secs = HHMMSS_to_seconds(stop_times['arrival_time'])
+        dep_secs = HHMMSS_to_seconds(stop_times['departure_time'])
+        stop_times['arr_mpm'] = seconds_to_MPM(arr_secs)
+        stop_times['dep_mpm'] = seconds_to_MPM(dep_secs)
+        stop_times['arr_tp'] = assign_time_periods(arr_secs, self.time_periods)
+        stop_times['dep_tp'] = assign_time_periods(dep_secs, self.time_periods)
+
+    def _get_all_trip_times(self):
+        # _get_trip_times of all of stop_times, a trip partition at a time when out of core
+        trip_times = [self._get_trip_times(stop_times) for stop_times in self._iter_stop_times()]
+        if len(trip_times) == 1:
+            return trip_times[0]
+        return pd.concat(trip_times, ignore_index=True).sort_values('trip_id', kind='mergesort').reset_index(drop=True)
+
+    @profiled('route_trips')
+    def _get_route_statistics(self, pivot_timeperiods=True, outlier_rule='mean', **outlier_args):
+        if not callable(outlier_rule):
+            if outlier_rule not in HEADWAY_OUTLIER_RULES:
+                raise ValueError("outlier_rule must be a function or one of %s" % ', '.join(sorted(HEADWAY_OUTLIER_RULES.keys())))
+            outlier_rule = HEADWAY_OUTLIER_RULES[outlier_rule]
         grouped = self.route_trips.fillna(-1).groupby(self._route_dir_idx_cols+['service_id','pattern_id']+self._tp_idx_cols)
         rte_dir_pattern_tp_cols = self._route_dir_idx_cols+['service_id','pattern_id']+self._tp_idx_cols
         rte_dir_pattern_cols    = self._route_dir_idx_cols+['service_id','pattern_id']
@@ -350,67 +2240,82 @@ class GTFSFeed(object):
             if pivot_timeperiods:
                 route_statistics = route_statistics.reset_index()
                 pivot = route_statistics.pivot_table(index=self._route_dir_idx_cols+['service_id','pattern_id'],columns=self._tp_idx_cols,values=['trips','freq','avg_headway'])
+                # time periods without any trips are missing from the pivot
+                pivot = pivot.reindex(columns=pd.MultiIndex.from_product([['trips','freq','avg_headway'],sorted(self.time_periods.keys())]))
                 route_statistics = pd.DataFrame(self.route_patterns,columns=self._route_dir_idx_cols+['service_id','pattern_id']+self._route_pattern_info_cols)
                 for col in self._route_dir_idx_cols:
                     route_statistics[col] = route_statistics[col].fillna(-1)
                 route_statistics = route_statistics.set_index(self._route_dir_idx_cols+['service_id','pattern_id'])
                 for stat in ['trips','freq','avg_headway']:
-                    for tp in self.time_periods.iterkeys():
+                    for tp in sorted(self.time_periods.keys()):
                         route_statistics['%s_%s' % (tp, stat)] = pivot[stat][tp]
         else:
             route_statistics['freq'] = route_statistics['trips'] / 24
             route_statistics['avg_headway'] = 60 / route_statistics['freq']
 
-        # calculate average headways and headway variation from actual headways
-        sorted_trips = self.route_trips.sort(self._route_dir_idx_cols+['pattern_id','trip_departure_mpm'])
-        for col in self._route_dir_idx_cols:
-            sorted_trips[col] = sorted_trips[col].fillna(-1)
-        sorted_trips['next_departure'] = sorted_trips['trip_departure_mpm'].shift(-1)
-        sorted_trips['next_pattern'] = sorted_trips['pattern_id'].shift(-1)
-        sorted_trips = sorted_trips[sorted_trips['pattern_id'] == sorted_trips['next_pattern']]
-        sorted_trips['headway'] = sorted_trips['next_departure'] - sorted_trips['trip_departure_mpm']
-        sorted_trips['outlier'] = 0
-        
-        if sorted_trips['headway'].lt(0).sum() > 0:
-            print "sorted trips have negative headways"
-            print sorted_trips[sorted_trips['headway'].lt(0)]
-            #sys.exit()
-
-        # find outliers (ex. large gaps in service for routes that only run in peak)
-        grouped = sorted_trips.groupby(self._route_dir_idx_cols+['pattern_id']+self._tp_idx_cols)
-        minmax = []
-        for name, group in grouped:
-            # drop the min and max headways
-            idxmin = group['headway'].idxmin()
-            idxmax = group['headway'].idxmax()
-            minmax.append(idxmin)
-            minmax.append(idxmax)
-
-        no_min_max = sorted_trips[~sorted_trips.index.isin(minmax)]
-        test = no_min_max.groupby(self._route_dir_idx_cols+['service_id','pattern_id']+self._tp_idx_cols)['headway'].agg([np.mean,np.std])
-
-        for name, group in grouped:
-            if name not in test.index: continue
-            outliers = group[group['headway'] > (test.loc[name,'mean'] * 2)]
-            if len(outliers > 0):
-                sorted_trips.loc[outliers.index,'outlier'] = 1
-
-        #sorted_trips.to_csv('sorted_trips.csv')
-        sorted_trips = sorted_trips[sorted_trips['outlier'] == 0]
-
-        calc_headways = sorted_trips.groupby(self._route_dir_idx_cols+['service_id','pattern_id']+self._tp_idx_cols)
+        # calculate average headways and headway variation from actual headways, leaving out outliers
+        # (ex. large gaps in service for routes that only run in peak)
+        headways = self._get_headways()
+        headways = headways[~np.asarray(outlier_rule(headways, **outlier_args), dtype=bool)]
+
+        calc_headways = headways.groupby(self._route_dir_idx_cols+['service_id','pattern_id']+self._tp_idx_cols)
         calc_headways = calc_headways['headway'].agg([np.mean, np.std, np.median, np.min, np.max])
 
         if self.has_time_periods:
             if pivot_timeperiods:
                 pivot = calc_headways.reset_index().pivot_table(index=self._route_dir_idx_cols+['service_id','pattern_id'],columns=self._tp_idx_cols,values=['mean','std','median','amin','amax'])
+                pivot = pivot.reindex(columns=pd.MultiIndex.from_product([['mean','std','median','amin','amax'],sorted(self.time_periods.keys())]))
                 for stat in ['mean','std','median','amin','amax']:
-                    for tp in self.time_periods.iterkeys():
+                    for tp in sorted(self.time_periods.keys()):
                         route_statistics['%s_%s_headway' % (tp, stat)] = pivot[stat][tp]
-        route_statistics.to_csv('route_stats.csv')
         route_statistics = route_statistics.reset_index()
         return route_statistics
 
+    @profiled('route_trips')
+    def _get_headways(self):
+        '''
+        output: DataFrame with a row for each trip that is followed by another departure of the same
+                route, direction, service_id and pattern, with the grouping columns, trip_id, and
+                    headway:        minutes to the next departure
+                    group:          number of the route/direction/service_id/pattern/time period group
+                    group_position: rank of the headway within its group, from 0 for the smallest
+                    group_size:     number of headways in the group
+                    trimmed:        False for the smallest and largest headway of the group
+                sorted by group and headway.
+        '''
+        pattern_cols = self._route_dir_idx_cols+['service_id','pattern_id']
+        group_cols = pattern_cols+self._tp_idx_cols
+        sorted_trips = pd.DataFrame(self.route_trips, columns=group_cols+['trip_id','trip_departure_mpm'])
+        for col in self._route_dir_idx_cols:
+            sorted_trips[col] = sorted_trips[col].fillna(-1)
+        sorted_trips = sorted_trips.sort_values(pattern_cols+['trip_departure_mpm'])
+
+        # the headway is the time to the next departure, if the next trip is the same pattern
+        has_next = np.zeros(len(sorted_trips), dtype=bool)
+        has_next[:-1] = True
+        for col in pattern_cols:
+            values = sorted_trips[col].values
+            has_next[:-1] &= values[:-1] == values[1:]
+        sorted_trips['headway'] = sorted_trips['trip_departure_mpm'].shift(-1) - sorted_trips['trip_departure_mpm']
+        headways = sorted_trips[has_next & sorted_trips['headway'].notnull().values]
+
+        # rank the headways within each group
+        headways = headways.sort_values(group_cols+['headway'])
+        new_group = np.zeros(len(headways), dtype=bool)
+        new_group[:1] = True
+        for col in group_cols:
+            values = headways[col].values
+            new_group[1:] |= values[1:] != values[:-1]
+        group = np.cumsum(new_group) - 1
+        starts = np.flatnonzero(new_group)
+        sizes = np.diff(np.r_[starts, len(headways)])
+        headways['group'] = group
+        headways['group_position'] = np.arange(len(headways)) - starts[group]
+        headways['group_size'] = sizes[group]
+        headways['trimmed'] = (headways['group_position'] > 0) & (headways['group_position'] < headways['group_size'] - 1)
+        return headways
+
+    @profiled('stop_frequencies')
     def _get_stop_statistics(self):
         # number of routes serving stop
         stop_stats = pd.DataFrame(self.stops.set_index(['stop_id']))
@@ -420,100 +2325,443 @@ class GTFSFeed(object):
         stop_stats['num_routes_outbound'] = dir_size[0] if 0 in dir_size.columns.tolist() else 0
         stop_stats['num_routes_inbound'] = dir_size[1] if 1 in dir_size.columns.tolist() else 0
 
-##        # frequency of routes serving stop
-##        grouped = self.stop_times.groupby(['stop_id','route_id','direction_id'])
-##        stop_stats['avg_freq']
-##        stop_stats['avg_freq_outbound']
-##        stop_stats['avg_freq_inbound']
+        # departures per hour of all routes serving stop, over the day and by time period.  the
+        # service_ids of self.trips are added together (see drop_weekend).
+        stop_freqs = self.stop_frequencies
+        departures = stop_freqs.groupby(['stop_id','direction_id'])['trips'].sum().unstack('direction_id')
+        stop_stats['avg_freq'] = stop_freqs.groupby(['stop_id'])['trips'].sum() / 24.0
+        stop_stats['avg_freq_outbound'] = departures[0] / 24.0 if 0 in departures.columns.tolist() else 0
+        stop_stats['avg_freq_inbound'] = departures[1] / 24.0 if 1 in departures.columns.tolist() else 0
+        if self.has_time_periods:
+            by_tp = stop_freqs.groupby(['stop_id','dep_tp'])[['trips','freq']].sum().unstack('dep_tp')
+            for stat in ['trips','freq']:
+                for tp in sorted(self.time_periods.keys()):
+                    stop_stats['%s_%s' % (tp, stat)] = by_tp[stat][tp] if tp in by_tp[stat].columns else np.nan
         return stop_stats
+
+    @profiled('stop_times')
+    def get_stop_frequencies(self, pivot_timeperiods=False):
+        '''
+        input:  pivot_timeperiods:  one row per stop, route, direction and service_id with per-time period
+                                    columns (ex. AM_trips, AM_mean_headway), rather than one row per time
+                                    period
+        output: DataFrame of stop_id, route_id, direction_id, service_id, dep_tp (with time periods) and
+                    trips:              departures from the stop
+                    period_len_minutes: length of the time period
+                    freq:               trips per hour (per hour of the day without time periods)
+                    avg_headway:        minutes per trip, from freq
+                    mean_headway:       mean minutes to the next departure of the same route, direction
+                                        and service_id at the stop, counted in the period of the first
+                                        departure
+                    max_headway:        largest of those
+        Departures are labelled with stop_times dep_tp.  Every stop_time is reduced to an integer key
+        of stop, route/direction/service and time period, and the statistics are bincounts over the
+        keys, so stop_times is read once and never grouped or merged.  Out of core, each stop
+        partition is done on its own.
+        '''
+        stop_freqs = [self._get_stop_frequencies(stop_times, pivot_timeperiods) for stop_times in self._iter_stop_times('stop_id')]
+        return stop_freqs[0] if len(stop_freqs) == 1 else pd.concat(stop_freqs, ignore_index=True)
+
+    def _get_stop_frequencies(self, stop_times, pivot_timeperiods=False):
+        # get_stop_frequencies for the stops of stop_times, which has all their stop_times
+        stop_codes, stop_ids = category_codes(stop_times['stop_id'])
+        trip_codes, trip_ids = category_codes(stop_times['trip_id'])
+        services = group_codes(self.trips, ['route_id','direction_id','service_id'])
+        _, service_trips = np.unique(services, return_index=True)
+        n_services = len(service_trips)
+        # route/direction/service of each stop_time, -1 for trips that aren't in trips
+        trip_services = np.r_[services, -1][pd.Index(np.asarray(self.trips['trip_id'])).get_indexer(trip_ids)]
+        stop_time_services = np.r_[trip_services, -1][trip_codes]
+        if self.has_time_periods:
+            tp_codes = stop_times['dep_tp'].cat.codes.values.astype(np.int64)
+            tps = stop_times['dep_tp'].cat.categories
+            dep_mpm = stop_times['dep_mpm'].values
+        else:
+            tp_codes = np.zeros(len(stop_times), dtype=np.int64)
+            tps = [None]
+            dep_mpm = HHMMSS_to_MPM(stop_times['departure_time'])
+
+        valid = (stop_time_services >= 0) & (stop_codes >= 0) & (tp_codes >= 0)
+        stop_services = stop_codes[valid].astype(np.int64) * n_services + stop_time_services[valid]
+        keys, key_index = np.unique(stop_services * len(tps) + tp_codes[valid], return_inverse=True)
+        trips = np.bincount(key_index, minlength=len(keys))
+
+        # headways: sort each stop's departures of a route/direction/service by time, and take the
+        # difference to the next one
+        dep_mpm = dep_mpm[valid]
+        timed = np.flatnonzero(~np.isnan(dep_mpm))
+        order = timed[np.lexsort((dep_mpm[timed], stop_services[timed]))]
+        has_next = stop_services[order][1:] == stop_services[order][:-1]
+        headways = pd.Series((dep_mpm[order][1:] - dep_mpm[order][:-1])[has_next])
+        headways = headways.groupby(key_index[order][:-1][has_next]).agg(['mean','max']).reindex(np.arange(len(keys)))
+
+        rows = self.trips.iloc[service_trips[(keys // len(tps)) % n_services]]
+        stop_freqs = pd.DataFrame({'stop_id':np.asarray(stop_ids.take(keys // len(tps) // n_services)),
+                                   'route_id':rows['route_id'].values,
+                                   'direction_id':rows['direction_id'].values,
+                                   'service_id':rows['service_id'].values})
+        stop_freqs['trips'] = trips
+        if self.has_time_periods:
+            lengths = np.full(len(tps), np.nan)
+            for i, tp in enumerate(tps):
+                if tp in self.time_periods:
+                    start, stop = HHMMSSpair_to_MPMpair(self.time_periods[tp])
+                    lengths[i] = round(stop-start,0)
+            stop_freqs['dep_tp'] = pd.Categorical.from_codes(keys % len(tps), tps)
+            stop_freqs['period_len_minutes'] = lengths[keys % len(tps)]
+            stop_freqs['freq'] = 60 * stop_freqs['trips'] / stop_freqs['period_len_minutes']
+        else:
+            stop_freqs['period_len_minutes'] = 24 * 60.0
+            stop_freqs['freq'] = stop_freqs['trips'] / 24.0
+        stop_freqs['avg_headway'] = 60 / stop_freqs['freq']
+        stop_freqs['mean_headway'] = headways['mean'].values
+        stop_freqs['max_headway'] = headways['max'].values
+
+        if pivot_timeperiods and self.has_time_periods:
+            stop_freqs = self._pivot_stop_frequencies(stop_freqs, keys // len(tps), keys % len(tps), tps)
+        return stop_freqs
+
+    def _pivot_stop_frequencies(self, stop_freqs, row_keys, tp_codes, tps):
+        # one row per stop/route/direction/service key, filled in by (row, time period) position
+        idx_cols = ['stop_id','route_id','direction_id','service_id']
+        row_keys, first, rows = np.unique(row_keys, return_index=True, return_inverse=True)
+        pivot = stop_freqs[idx_cols].iloc[first].reset_index(drop=True)
+        for stat, name in [('trips','%s_trips'),('freq','%s_freq'),('avg_headway','%s_avg_headway'),
+                           ('mean_headway','%s_mean_headway'),('max_headway','%s_max_headway')]:
+            values = np.full((len(row_keys), len(tps)), np.nan)
+            values[rows, tp_codes] = stop_freqs[stat].values
+            for i, tp in enumerate(tps):
+                if tp in self.time_periods:
+                    pivot[name % tp] = values[:,i]
+        return pivot
         
-    def _get_route_patterns(self):
+    @profiled('stop_times')
+    def get_segments(self, route_ids=None):
+        '''
+        input:  route_ids:  optional routes to limit the segments to
+        output: DataFrame with a row for each pair of consecutive stops of a route, direction,
+                service_id and pattern (and time period, with time periods), of route_id, direction_id,
+                service_id, pattern_id, segment (1 for the first pair of the pattern), from_stop_id,
+                to_stop_id, dep_tp (the time period of the departure from from_stop_id) and
+                    trips:              trips that run the segment
+                    mean_run_minutes, min_run_minutes, max_run_minutes:
+                                        departure from from_stop_id to arrival at to_stop_id
+                    mean_dwell_minutes: arrival to departure at from_stop_id
+                sorted by route_id, direction_id, service_id, pattern_id, segment and dep_tp.
+        Needs route_trips with pattern_id (see build_common_dfs).  stop_times is sorted by trip and
+        stop_sequence once and each row is paired with the next one, so nothing is merged.  A missing
+        departure falls back to the arrival at the same stop and vice versa.  Out of core, each trip
+        partition is summed on its own and the sums are added up.
+        '''
+        route_trips = self.route_trips
+        if route_ids is not None:
+            route_trips = route_trips[route_trips['route_id'].isin(route_ids)]
+        group_cols = ['route_id','direction_id','service_id','pattern_id']
+        groups = group_codes(route_trips, group_cols)
+        _, group_trips = np.unique(groups, return_index=True)
+        trip_index = pd.Index(np.asarray(route_trips['trip_id']))
+        sums = [self._get_segment_sums(stop_times, trip_index, groups) for stop_times in self._iter_stop_times()]
+        key_cols = ['group','segment','tp']
+        if len(sums) > 1:
+            # the same segment can have trips in several partitions
+            sums = pd.concat(sums, ignore_index=True).groupby(key_cols)
+            sums = [sums.agg({'from_stop_id':'first','to_stop_id':'first','trips':'sum','run_sum':'sum','run_count':'sum',
+                              'run_min':'min','run_max':'max','dwell_sum':'sum','dwell_count':'sum'}).reset_index()]
+        sums = sums[0]
+
+        rows = route_trips.iloc[group_trips[sums['group'].values]]
+        segments = pd.DataFrame(dict((col, rows[col].values) for col in group_cols), columns=group_cols)
+        segments['segment'] = sums['segment'].values
+        segments['from_stop_id'] = sums['from_stop_id'].values
+        segments['to_stop_id'] = sums['to_stop_id'].values
+        if self.has_time_periods:
+            segments['dep_tp'] = pd.Categorical.from_codes(sums['tp'].values, self._get_time_period_categories())
+        segments['trips'] = sums['trips'].values
+        segments['mean_run_minutes'] = sums['run_sum'].values / sums['run_count'].values
+        segments['min_run_minutes'] = sums['run_min'].values
+        segments['max_run_minutes'] = sums['run_max'].values
+        segments['mean_dwell_minutes'] = sums['dwell_sum'].values / sums['dwell_count'].values
+        # groups are numbered in route_trips order, the output is sorted by the ids
+        sort_cols = group_cols + ['segment'] + (['dep_tp'] if self.has_time_periods else [])
+        return segments.sort_values(sort_cols, na_position='first').reset_index(drop=True)
+
+    def _get_segment_sums(self, stop_times, trip_index, groups):
+        # per segment and time period sums of get_segments for stop_times, which has all the
+        # stop_times of its trips.  groups numbers the route_trips patterns of trip_index.
+        trip_codes, trip_ids = category_codes(stop_times['trip_id'])
+        stop_time_groups = np.r_[np.r_[groups, -1][trip_index.get_indexer(trip_ids)], -1][trip_codes]
+        rows = np.flatnonzero(stop_time_groups >= 0)
+        rows = rows[np.lexsort((np.asarray(stop_times['stop_sequence'])[rows], trip_codes[rows]))]
+        if self.has_time_periods:
+            arr_mpm = stop_times['arr_mpm'].values[rows]
+            dep_mpm = stop_times['dep_mpm'].values[rows]
+            tp_codes = stop_times['dep_tp'].cat.codes.values[rows].astype(np.int64)
+        else:
+            arr_mpm = HHMMSS_to_MPM(stop_times['arrival_time'].iloc[rows])
+            dep_mpm = HHMMSS_to_MPM(stop_times['departure_time'].iloc[rows])
+            tp_codes = np.zeros(len(rows), dtype=np.int64)
+        stop_ids = np.asarray(stop_times['stop_id'])[rows]
+
+        # each stop_time is the start of a segment if the next one is the same trip
+        codes = trip_codes[rows]
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.zeros(0, dtype=np.int64)
+        positions = np.arange(len(codes)) - np.repeat(starts, np.diff(np.r_[starts, len(codes)]))
+        has_next = np.flatnonzero(codes[1:] == codes[:-1])
+        run = np.where(np.isnan(arr_mpm), dep_mpm, arr_mpm)[has_next + 1] - np.where(np.isnan(dep_mpm), arr_mpm, dep_mpm)[has_next]
+        dwell = (dep_mpm - arr_mpm)[has_next]
+        group = stop_time_groups[rows][has_next]
+        n_positions = positions.max() + 1 if len(positions) else 1
+        n_tps = tp_codes.max() + 1 if len(tp_codes) else 1
+        keys, first, key_index = np.unique((group * n_positions + positions[has_next]) * n_tps + tp_codes[has_next],
+                                           return_index=True, return_inverse=True)
+
+        sums = pd.DataFrame({'group':keys // n_tps // n_positions,
+                             'segment':(keys // n_tps) % n_positions + 1,
+                             'tp':keys % n_tps,
+                             'from_stop_id':stop_ids[has_next[first]],
+                             'to_stop_id':stop_ids[has_next[first] + 1],
+                             'trips':np.bincount(key_index, minlength=len(keys))})
+        for name, values in [('run', run), ('dwell', dwell)]:
+            timed = ~np.isnan(values)
+            sums[name + '_sum'] = np.bincount(key_index[timed], values[timed], minlength=len(keys))
+            sums[name + '_count'] = np.bincount(key_index[timed], minlength=len(keys))
+        extremes = pd.Series(run).groupby(key_index).agg(['min','max']).reindex(np.arange(len(keys)))
+        sums['run_min'] = extremes['min'].values
+        sums['run_max'] = extremes['max'].values
+        return sums
+
+    def _get_time_period_categories(self):
+        # the categories of the stop_times time period columns, see assign_time_periods
+        return pd.Categorical(assign_time_periods([], self.time_periods)).categories
+
+    @profiled('trips')
+    def _get_route_patterns(self, trip_pattern_ids=None):
+        if trip_pattern_ids is None:
+            trip_pattern_ids = self._get_trip_id_to_pattern_id()
         trip_route = pd.merge(self.routes,self.trips,on='route_id')
         trip_route = pd.DataFrame(trip_route,columns=self._route_trip_idx_cols)
-        patterns = self.stop_times.pivot(index='trip_id',columns='stop_sequence',values='stop_id')
-        patterns = patterns.reset_index()
-        if not self.stop_sequence_cols:
-            self.stop_sequence_cols = self._get_stop_sequence_cols()
-
-        for col in self.stop_sequence_cols:
-            match_cols = patterns.reset_index().columns.tolist()
-            if col not in match_cols:
-                patterns[col] = np.nan
-                
-        route_pattern = pd.merge(trip_route, patterns, on='trip_id')
+        route_pattern = pd.merge(trip_route, trip_pattern_ids[['trip_id','pattern_id']], on='trip_id')
         columns = route_pattern.columns.tolist()
         columns.remove('trip_id')
         columns.remove('shape_id')
 
-        # get the count of trips of this pattern for this route
+        # get the count of trips of this pattern for this route.  the same pattern can show up under
+        # multiple routes (prob out of service nonsense) and they all share the one pattern_id.
         route_pattern = route_pattern.fillna(-1)
         grouped_route_pattern = route_pattern.groupby(columns)
         route_pattern = grouped_route_pattern.count()
         route_pattern['count'] = route_pattern['trip_id']
         route_pattern['shape_id'] = grouped_route_pattern.first()['shape_id']
         route_pattern['trip_id'] = grouped_route_pattern.first()['trip_id']
-
-        # sometimes the same pattern shows up under multiple routes (why? prob out of service nonsense)
-        # so just keep one pattern that all those routes can use.
-        route_pattern = route_pattern.reset_index().set_index(self.stop_sequence_cols)
-        grouped_patterns = patterns.fillna(-1).groupby(self.stop_sequence_cols)
-        route_pattern['pattern_id'] = grouped_patterns.first()['trip_id']
         route_pattern = route_pattern.reset_index()
         route_pattern = route_pattern.replace(-1, np.nan)
+        columns.remove('pattern_id')
+        route_pattern = pd.DataFrame(route_pattern, columns=columns+['trip_id','shape_id','count','pattern_id'])
 
         return route_pattern
 
-    def _get_trip_id_to_pattern_id(self):
-        trip_stops = pd.merge(self.trips, self.stop_patterns, on=['trip_id'])
-        trip_stop_patterns = trip_stops.pivot(index='trip_id',columns='stop_sequence',values='stop_id')
-        pattern_stop_patterns = self.stop_patterns.pivot(index='trip_id',columns='stop_sequence',values='stop_id')
-
-        trip_stop_patterns = trip_stop_patterns.reset_index().set_index(self.stop_sequence_cols)
-        pattern_stop_patterns = pattern_stop_patterns.reset_index().set_index(self.stop_sequence_cols)
-        trip_stop_patterns['pattern_id'] = pattern_stop_patterns['trip_id']
-        trip_stop_patterns = trip_stop_patterns.reset_index()
-        trip_stop_patterns = pd.DataFrame(trip_stop_patterns,columns=self._route_trip_idx_cols+['pattern_id'])
-        return trip_to_pattern
-    
+    @profiled('stop_times')
+    def _get_trip_id_to_pattern_id(self, stop_times=None):
+        '''
+        input:  stop_times (defaults to all of stop_times, a trip partition at a time when out of core)
+        output: DataFrame of trip_id, num_stops, pattern_id.  see get_trip_patterns.
+        '''
+        if stop_times is not None:
+            return get_trip_patterns(stop_times['trip_id'], stop_times['stop_sequence'], stop_times['stop_id'])
+        patterns = [get_trip_pattern_hashes(stop_times['trip_id'], stop_times['stop_sequence'], stop_times['stop_id'])
+                    for stop_times in self._iter_stop_times()]
+        if len(patterns) > 1:
+            patterns = [pd.concat(patterns, ignore_index=True).sort_values('trip_id', kind='mergesort')]
+        return assign_pattern_ids(patterns[0])
+
+    @profiled('route_patterns')
+    def get_route_patterns_wide(self):
+        '''
+        output: route_patterns with one stop_id column per stop_sequence, for export.  Only the
+                pattern trips are pivoted, so this is patterns x stop_sequences.  Interned ids are
+                decoded.
+        '''
+        if not self.stop_sequence_cols:
+            self.stop_sequence_cols = self._get_stop_sequence_cols()
+        pattern_ids = self.route_patterns['pattern_id'].drop_duplicates()
+        stop_patterns = self.stop_times[self.stop_times['trip_id'].isin(pattern_ids)]
+        wide = self._pivot_stop_sequences(stop_patterns)
+        wide = wide.reindex(columns=self.stop_sequence_cols)
+        wide.columns = self.stop_sequence_cols
+        wide.index.name = 'pattern_id'
+        if self.ids != None:
+            for col in wide.columns:
+                wide[col] = decode_id_codes(self.ids['stop_id'], wide[col].values)
+        route_patterns = pd.DataFrame(self.route_patterns, columns=[x for x in self.route_patterns.columns if x not in self.stop_sequence_cols])
+        return self.decode_ids(pd.merge(route_patterns, wide.reset_index(), how='left', on='pattern_id'))
+
+    def _pivot_stop_sequences(self, stop_times):
+        # one row per trip and one stop_id column per stop_sequence.  ids are taken as plain
+        # values so the -1 fill used for grouping works on categorical columns too.
+        stop_ids = pd.DataFrame({'trip_id':np.asarray(stop_times['trip_id']),
+                                 'stop_sequence':np.asarray(stop_times['stop_sequence']),
+                                 'stop_id':np.asarray(stop_times['stop_id'])})
+        return stop_ids.pivot(index='trip_id',columns='stop_sequence',values='stop_id')
+
     def _get_stop_sequence_cols(self):
         stop_sequence_cols = list(set(self.stop_times['stop_sequence'].tolist()))
         return stop_sequence_cols
         
-    def _get_similarity_index(self, route_patterns, idx_cols=['route_id','direction_id']):
-        # figure out which pattern is the 'base' pattern
-        grouped = route_patterns.groupby(idx_cols)
-        route_patterns['total_base_stops'] = 0
-        route_patterns['similar_base_stops'] = 0
-        route_patterns['similarity_index'] = 0
-        route_patterns['is_base_pattern'] = 0
+    @profiled()
+    def _get_similarity_index(self, route_patterns, idx_cols=['route_id','direction_id'], method='lcs'):
+        '''
+        input:  route_patterns, idx_cols:   patterns are compared within groups of idx_cols
+                method:                     see count_common_stops
+        output: route_patterns with columns
+                    is_base_pattern:        1 for the pattern with the most trips in its group
+                    total_base_stops:       stops of the group's base pattern
+                    similar_base_stops:     stops the pattern shares with the base pattern
+                    similarity_index:       similar_base_stops / total_base_stops
+        '''
         self._route_pattern_info_cols = ['is_base_pattern','similarity_index']
-        
-        for name, group in grouped:
-            this_group = pd.DataFrame(group,columns=self.stop_sequence_cols+['count'])
-            # assume the pattern that shows up the most is the base route
-            maxrow = this_group[this_group.index == this_group['count'].idxmax()]
-            if len(maxrow) > 1:
-                print "maxrow contains multiple records, selecting first"
-                maxrow = maxrow[0]
-            route_patterns.loc[this_group['count'].idxmax(),'is_base_pattern'] = 1
-            route_patterns.loc[this_group.index,'total_base_stops'] = maxrow.loc[:,self.stop_sequence_cols].T.count().sum()
-            route_patterns.loc[this_group.index,'similar_base_stops'] = this_group.loc[:,self.stop_sequence_cols].eq(maxrow.loc[:,self.stop_sequence_cols].values.tolist()[0]).T.sum()
-        route_patterns['similarity_index'] = route_patterns['similar_base_stops'] / route_patterns['total_base_stops']
-        
+
+        # assume the pattern that shows up the most is the base route.  ties go to the first row.
+        group = group_codes(route_patterns, idx_cols)
+        order = np.lexsort((np.arange(len(route_patterns)), -route_patterns['count'].values, group))
+        is_first = np.r_[True, group[order][1:] != group[order][:-1]] if len(order) else np.zeros(0, dtype=bool)
+        base_row = np.empty(group.max()+1 if len(group) else 0, dtype=np.int64)
+        base_row[group[order][is_first]] = order[is_first]
+        base_row = base_row[group]
+
+        pattern_ids = route_patterns['pattern_id'].values
+        patterns, stop_matrix = self._get_pattern_stop_matrix(pd.unique(pattern_ids))
+        pattern_rows = patterns.get_indexer(pattern_ids)
+        base_rows = pattern_rows[base_row]
+        route_patterns['total_base_stops'] = count_stops(stop_matrix, method)[base_rows]
+        route_patterns['similar_base_stops'] = count_common_stops(stop_matrix[pattern_rows], stop_matrix[base_rows], method)
+        route_patterns['similarity_index'] = route_patterns['similar_base_stops'] / route_patterns['total_base_stops'].astype(float)
+        route_patterns['is_base_pattern'] = (np.arange(len(route_patterns)) == base_row).astype(np.int64)
+
         return route_patterns
+
+    def get_similarity_matrix(self, route_id, direction_id=None, method='lcs'):
+        '''
+        input:  route_id, direction_id (None for all directions), method: see count_common_stops
+        output: DataFrame of the route's patterns by the same patterns, where each value is the share
+                of the column pattern's stops that the row pattern also serves.  The diagonal is 1.
+                route_id and the pattern_ids are ids, also when they are interned.
+        '''
+        if self.ids != None:
+            route_id = self._encode_id_values('route_id', pd.Series([route_id]))[0]
+        patterns = self.route_patterns[self.route_patterns['route_id'] == route_id]
+        if direction_id != None:
+            patterns = patterns[patterns['direction_id'] == direction_id]
+        patterns, stop_matrix = self._get_pattern_stop_matrix(pd.unique(patterns['pattern_id'].values))
+        rows = np.repeat(np.arange(len(patterns)), len(patterns))
+        cols = np.tile(np.arange(len(patterns)), len(patterns))
+        common = count_common_stops(stop_matrix[rows], stop_matrix[cols], method)
+        similarity = common / count_stops(stop_matrix, method)[cols].astype(float)
+        if self.ids != None:
+            patterns = pd.Index(decode_id_codes(self.ids['trip_id'], patterns.values))
+        return pd.DataFrame(similarity.reshape(len(patterns), len(patterns)), index=patterns, columns=patterns)
+
+    def _get_pattern_stop_matrix(self, pattern_ids):
+        '''
+        input:  pattern_ids (trip_ids)
+        output: (Index of pattern_ids, int array with a row of stop codes per pattern in stop_sequence
+                order, padded on the right with -1).  Only the pattern trips are laid out, so this is
+                patterns x the longest pattern.
+        '''
+        stop_times = self.stop_times[self.stop_times['trip_id'].isin(pattern_ids)]
+        patterns = pd.Index(pattern_ids)
+        rows = patterns.get_indexer(np.asarray(stop_times['trip_id']))
+        stop_codes, _ = pd.factorize(np.asarray(stop_times['stop_id']))
+        order = np.lexsort((np.asarray(stop_times['stop_sequence']), rows))
+        rows, stop_codes = rows[order], stop_codes[order]
+        lengths = np.bincount(rows, minlength=len(patterns))
+        starts = np.r_[0, np.cumsum(lengths)[:-1]]
+        stop_matrix = -np.ones((len(patterns), lengths.max() if len(rows) else 0), dtype=np.int64)
+        stop_matrix[rows, np.arange(len(rows)) - starts[rows]] = stop_codes
+        return patterns, stop_matrix
         
+    def _profile_call(self, method, table, args, kwargs):
+        # run method, recording a row of PROFILE_COLUMNS
+        if self._profile_start is None:
+            self._profile_start = time.time()
+        stage = {'stage':method.__name__, 'depth':len(self._profile_stack),
+                 'parent':self._profile_stack[-1]['stage'] if self._profile_stack else None,
+                 'rows_in':self._profile_rows(table) if table != None else _count_rows(list(args) + kwargs.values())}
+        self._profile_stack.append(stage)
+        start, cpu, peak = time.time(), cpu_seconds(), peak_memory_mb()
+        result = None
+        try:
+            result = method(self, *args, **kwargs)
+            return result
+        finally:
+            self._profile_stack.pop()
+            stage['start'] = start - self._profile_start
+            stage['wall_seconds'] = time.time() - start
+            stage['cpu_seconds'] = cpu_seconds() - cpu
+            stage['peak_memory_delta_mb'] = peak_memory_mb() - peak if peak != None else None
+            stage['rows_out'] = _count_rows([result])
+            if stage['rows_out'] is None and table != None:
+                stage['rows_out'] = self._profile_rows(table)
+            self._profile.append(stage)
+
+    def _profile_rows(self, table):
+        # rows of self.<table>, without reading a table that lazy loading hasn't read yet
+        if table in self._pending:
+            return None
+        return _count_rows([getattr(self, table, None)])
+
+    def get_profile(self):
+        '''
+        output: DataFrame of PROFILE_COLUMNS with a row per profiled call made while self.profiling was
+                on, in the order the calls started
+                    stage:                  method name
+                    depth, parent:          nesting within other profiled calls
+                    start:                  seconds from the first profiled call
+                    wall_seconds, cpu_seconds
+                    peak_memory_delta_mb:   growth of the process peak memory during the call (None on
+                                            Windows).  Memory freed before the call ends isn't counted
+                                            again by later calls, so the outermost call has the total.
+                    rows_in, rows_out:      see profiled
+        Calls made in worker processes (processes=) are only counted in the call that starts them.
+        '''
+        profile = pd.DataFrame(self._profile, columns=PROFILE_COLUMNS)
+        return profile.sort_values(['start','depth']).reset_index(drop=True)
+
+    def reset_profile(self):
+        self._profile = []
+        self._profile_start = None
+
+    def write_profile(self, filename, format='json'):
+        '''
+        input:  filename
+                format: 'json' for a list of get_profile rows, or 'chrome' for the Trace Event format read
+                        by chrome://tracing and Perfetto, with one complete event per call
+        '''
+        profile = self.get_profile()
+        records = [dict((k, None if pd.isnull(v) else v) for k, v in row.iteritems())
+                   for _, row in profile.astype(object).iterrows()]
+        if format == 'chrome':
+            pid = os.getpid()
+            records = {'traceEvents':[{'name':r['stage'], 'cat':'gtfs_utils', 'ph':'X', 'pid':pid, 'tid':0,
+                                       'ts':r['start'] * 1e6, 'dur':r['wall_seconds'] * 1e6,
+                                       'args':dict((k, r[k]) for k in ['cpu_seconds','peak_memory_delta_mb','rows_in','rows_out'])}
+                                      for r in records],
+                       'displayTimeUnit':'ms'}
+        elif format != 'json':
+            raise ValueError("format must be 'json' or 'chrome'")
+        with open(filename, 'w') as f:
+            json.dump(records, f, indent=1)
+
     def __str__(self):
         ret = 'GTFS Feed at %s containing:' % self.path
-        i = 0
-        for key, value in self.__dict__.items():
-            if not key.startswith('__'):
-                if not isinstance(value, pd.DataFrame):
-                    continue
-                if i == 0:
-                    ret = ret + '\n%s' % (key)
-                    i += 1
-                else:
-                    ret = ret + ', %s' % (key)
+        # look at the storage directly, so printing doesn't trigger any pending loads
+        items = [(name, self._tables.get(name)) for name in self._gtfs_names + self._derived_names] + self.__dict__.items()
+        loaded = [key for key, value in items if not key.startswith('__') and key != 'load_stats'
+                  and isinstance(value, pd.DataFrame)]
+        if len(loaded) > 0:
+            ret = ret + '\n%s' % ', '.join(loaded)
+        pending = self.get_pending_tables()
+        if len(pending) > 0:
+            ret = ret + '\nnot yet loaded:\n%s' % ', '.join(pending)
         return ret
 
 
@@ -537,6 +2785,283 @@ class GTFSFeed(object):
 ##            pass
 ##        
 
+def _route_partition_job(args):
+    # similarity index and route statistics for the routes in a GTFSFeed._get_route_state
+    state, similarity_method, stats_args = args
+    feed = _feed_from_route_state(state)
+    feed._set_route_tables(similarity_method, stats_args)
+    return feed.route_patterns, feed.route_statistics, feed._route_pattern_info_cols
+
+def _feed_from_route_state(state):
+    # a GTFSFeed holding just a GTFSFeed._get_route_state
+    feed = GTFSFeed()
+    for name, value in state.iteritems():
+        setattr(feed, name, value)
+    return feed
+
+def feed_name(path):
+    '''
+    name of a feed for output directories and summaries: the directory or zip file name
+    '''
+    return os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+
+def _id_strings(ids):
+    # ids as strings, with whole floats (ids read from a column with missing values) as ints
+    values = np.asarray(ids)
+    if values.dtype.kind == 'f' and (np.mod(values, 1) == 0).all():
+        values = values.astype(np.int64)
+    return [value if isinstance(value, basestring) else str(value) for value in values]
+
+def _concat_columns(parts):
+    # one Series from the parts of a column, categorical if any part is, with the union of their categories
+    if any(str(part.dtype) == 'category' for part in parts):
+        parts = [part if str(part.dtype) == 'category' else pd.Series(pd.Categorical(part)) for part in parts]
+        categories = None
+        for part in parts:
+            # skipping the empty categories of all-missing parts, which would make them float
+            if len(part.cat.categories) > 0:
+                categories = part.cat.categories if categories is None else categories.union(part.cat.categories)
+        if categories is not None:
+            parts = [part.cat.set_categories(categories) for part in parts]
+    return pd.concat(parts, ignore_index=True)
+
+def merge_feeds(feeds, prefixes=None, offsets=None, stop_tolerance=None, projection=None):
+    '''
+    input:  feeds:          list of loaded GTFSFeeds, or dict of feed name to GTFSFeed.  either all or
+                            none of them have interned ids (see GTFSFeed.intern_ids), and none has had
+                            apply_time_periods yet or out of core stop_times.
+            prefixes:       list of strings, one per feed, put in front of each of the feed's ids so ids
+                            of different feeds can't collide.  defaults to the feed names (see feed_name)
+                            followed by ':'.
+            offsets:        instead of prefixes, number each feed's ids (in sorted order) from an int
+                            offset: True to start each feed after the ids of the one before, or a list of
+                            offsets, one per feed
+            stop_tolerance: if given, a stop within this distance of a stop of an earlier feed is merged
+                            into the nearest one, so stops shared by agencies become one stop.  stops of
+                            the same feed are never merged.
+            projection:     see project_lonlat; the default measures stop_tolerance in meters
+    output: GTFSFeed of the feeds' tables, interned if they are, with merged_stops a DataFrame of feed,
+            stop_id, merged_stop_id and distance for the stops merged away.  the later steps
+            (apply_time_periods, standardize, build_common_dfs) run on it as on a loaded feed.
+    Each table is put together a column at a time from the feeds' columns with their ids replaced, so
+    the merged table is the only copy made.
+    '''
+    if isinstance(feeds, dict):
+        names = sorted(feeds.keys())
+        feeds = [feeds[name] for name in names]
+    else:
+        feeds = list(feeds)
+        names = [feed_name(feed.path) for feed in feeds]
+    if len(set(feed.ids is None for feed in feeds)) > 1:
+        raise ValueError("either all or none of the feeds must have interned ids")
+    if any(feed.has_time_periods or feed._partitions != None for feed in feeds):
+        raise ValueError("feeds must be merged before apply_time_periods, and can't have out of core stop_times")
+    if prefixes != None and offsets != None:
+        raise ValueError("give prefixes or offsets, not both")
+    if offsets is None and prefixes is None:
+        prefixes = ['%s:' % name for name in names]
+    for option in [prefixes, offsets]:
+        if isinstance(option, list) and len(option) != len(feeds):
+            raise ValueError("give one prefix or offset per feed")
+    interned = feeds[0].ids != None
+
+    # the ids of each feed (positions in feed_ids are interned codes), and what they become
+    feed_ids = []
+    for feed in feeds:
+        feed._materialize_all()
+        feed_ids.append(feed.ids if interned else
+                        feed._collect_ids([name for name in feed._gtfs_names if isinstance(getattr(feed, name), pd.DataFrame)]))
+    kinds = sorted(set(kind for ids in feed_ids for kind in ids))
+    new_ids = [{} for feed in feeds]
+    for kind in kinds:
+        start = 0
+        for i, ids in enumerate(feed_ids):
+            values = ids.get(kind, pd.Index([]))
+            if offsets is None:
+                new_ids[i][kind] = np.array([prefixes[i] + value for value in _id_strings(values)], dtype=object)
+            else:
+                offset = start if offsets is True else offsets[i]
+                new_ids[i][kind] = offset + np.arange(len(values), dtype=np.int64)
+                start = offset + len(values)
+        if offsets not in [None, True]:
+            values = np.concatenate([new[kind] for new in new_ids])
+            if len(np.unique(values)) < len(values):
+                raise ValueError("offsets %s give %s that overlap" % (offsets, kind))
+
+    merged_stops = []
+    dropped_stops = [None] * len(feeds)
+    if stop_tolerance != None:
+        stops = [feed.stops if isinstance(feed.stops, pd.DataFrame) else pd.DataFrame(columns=['stop_id','stop_lat','stop_lon'])
+                 for feed in feeds]
+        # one projection call for all the feeds, so they share the same reference latitude
+        xy = np.column_stack(project_lonlat(np.concatenate([df['stop_lon'].values for df in stops]),
+                                            np.concatenate([df['stop_lat'].values for df in stops]), projection))
+        bounds = np.cumsum([0] + [len(df) for df in stops])
+        kept_xy, kept_ids = [], []
+        for i, df in enumerate(stops):
+            positions = (np.asarray(df['stop_id'], dtype=np.int64) if interned
+                         else feed_ids[i]['stop_id'].get_indexer(df['stop_id'].values)) if 'stop_id' in feed_ids[i] else np.full(len(df), -1)
+            stop_xy = xy[bounds[i]:bounds[i+1]]
+            matchable = (positions >= 0) & ~np.isnan(stop_xy).any(axis=1)
+            if kept_xy:
+                left_idx, right_idx, _, distance = match_points(stop_xy[matchable], np.concatenate(kept_xy), 1, stop_tolerance)
+                rows = np.flatnonzero(matchable)[left_idx]
+                target_ids = np.concatenate(kept_ids)[right_idx]
+                merged_stops.append(pd.DataFrame({'feed':names[i], 'stop_id':new_ids[i]['stop_id'][positions[rows]],
+                                                  'merged_stop_id':target_ids, 'distance':distance},
+                                                 columns=['feed','stop_id','merged_stop_id','distance']))
+                new_ids[i]['stop_id'][positions[rows]] = target_ids
+                matchable[rows] = False
+                dropped_stops[i] = np.zeros(len(df), dtype=bool)
+                dropped_stops[i][rows] = True
+            kept_xy.append(stop_xy[matchable])
+            kept_ids.append(new_ids[i]['stop_id'][positions[matchable]])
+
+    if interned:
+        ids = dict((kind, pd.Index(np.unique(np.concatenate([new[kind] for new in new_ids])))) for kind in kinds)
+        code_maps = [dict((kind, np.r_[ids[kind].get_indexer(new[kind]), -1].astype(np.int32)) for kind in new) for new in new_ids]
+    # codes of each feed's ids in the unique new ids, which the stop merges can make fewer
+    new_codes = [dict((kind, pd.factorize(new[kind])) for kind in new) for new in new_ids]
+
+    def map_ids(i, col, values):
+        # a feed's column with its ids replaced
+        kind = MERGE_ID_COLUMNS.get(col)
+        if kind is None or kind not in new_ids[i]:
+            return values
+        if interned and col in ID_COLUMNS:
+            return pd.Series(code_maps[i][kind][np.asarray(values, dtype=np.int64)])
+        codes, uniques = category_codes(values)
+        unique_codes, categories = new_codes[i][kind]
+        codes = np.r_[np.r_[unique_codes, -1][feed_ids[i][kind].get_indexer(uniques)], -1][codes]
+        if str(values.dtype) == 'category':
+            return pd.Series(pd.Categorical.from_codes(codes, categories))
+        return pd.Series(decode_id_codes(categories, codes))
+
+    merged = GTFSFeed()
+    merged.weekday_only = all(feed.weekday_only for feed in feeds)
+    merged.segment_by_service_id = feeds[0].segment_by_service_id
+    for name in merged._gtfs_names:
+        frames = [(i, getattr(feed, name)) for i, feed in enumerate(feeds) if isinstance(getattr(feed, name), pd.DataFrame)]
+        if not frames:
+            continue
+        if name == 'stops':
+            frames = [(i, df[~dropped_stops[i]] if dropped_stops[i] is not None else df) for i, df in frames]
+        columns = []
+        for i, df in frames:
+            columns += [col for col in df.columns if col not in columns]
+        data = {}
+        for col in columns:
+            data[col] = _concat_columns([map_ids(i, col, df[col]) if col in df.columns else pd.Series(np.nan, index=np.arange(len(df)))
+                                         for i, df in frames])
+        setattr(merged, name, pd.DataFrame(data, columns=columns))
+
+    if interned:
+        merged.ids = ids
+    merged.service_dates = get_service_dates(merged.calendar, merged.calendar_dates)
+    weekday_service_ids = [map_ids(i, 'service_id', pd.Series(feed.weekday_service_ids)).tolist()
+                           for i, feed in enumerate(feeds) if feed.weekday_service_ids != None]
+    merged.weekday_service_ids = sorted(set(itertools.chain(*weekday_service_ids))) if weekday_service_ids else None
+    if isinstance(merged.stop_times, pd.DataFrame):
+        merged.stop_sequence_cols = merged._get_stop_sequence_cols()
+        if isinstance(merged.stops, pd.DataFrame):
+            merged.used_stops = merged._get_used_stops()
+    merged.merged_stops = (pd.concat(merged_stops, ignore_index=True) if merged_stops
+                           else pd.DataFrame(columns=['feed','stop_id','merged_stop_id','distance']))
+    return merged
+
+def process_feed(path, outpath, time_periods, cache_dir=None, memory_limit=None, name=None):
+    '''
+    input:  path:           GTFS directory or zip
+            outpath:        directory for route_trips.csv, route_patterns.csv, route_statistics.csv
+                            and stop_statistics.csv
+            time_periods:   see GTFSFeed.apply_time_periods
+            cache_dir:      see GTFSFeed.load.  route_patterns and route_statistics are also kept in
+                            cache_dir/build, so a later version of the feed only recomputes the routes
+                            that changed (see GTFSFeed.build_common_dfs), and the changes are written
+                            to build_changes.csv.
+            memory_limit:   address space limit for this process in MB, where the OS supports it (not
+                            on Windows).  Meant for process_feeds workers, as the limit can't be raised
+                            again.  A feed that hits it fails with a MemoryError.
+            name:           feed name for the summary, defaults to feed_name(path)
+    output: dict of FEED_SUMMARY_COLUMNS.  Errors are reported in the summary rather than raised.
+    '''
+    summary = dict.fromkeys(FEED_SUMMARY_COLUMNS)
+    summary.update(feed=name if name != None else feed_name(path), path=path, outpath=outpath)
+    start = time.time()
+    try:
+        if memory_limit != None and resource != None:
+            limit = int(memory_limit * 2**20)
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        if not os.path.exists(path):
+            raise IOError("no GTFS directory or zip at %s" % path)
+        gtfs = GTFSFeed(path)
+        gtfs.load(columns=PIPELINE_COLUMNS, tables=PIPELINE_TABLES, cache_dir=cache_dir, intern_ids=True)
+        gtfs.apply_time_periods(time_periods)
+        gtfs.standardize() # uses trip_headsign if direction_id is missing in trips.txt
+        gtfs.build_common_dfs(build_cache=os.path.join(cache_dir, 'build') if cache_dir != None else None,
+                              keep=['route_trips','route_patterns','route_statistics','stop_statistics'])
+
+        if not os.path.exists(outpath):
+            os.makedirs(outpath)
+        if gtfs.build_changes is not None:
+            gtfs.build_changes.to_csv(os.path.join(outpath,'build_changes.csv'), index=False)
+        gtfs.decode_ids(gtfs.route_trips).to_csv(os.path.join(outpath,'route_trips.csv'))
+        gtfs.get_route_patterns_wide().to_csv(os.path.join(outpath,'route_patterns.csv'))
+        gtfs.decode_ids(gtfs.route_statistics).to_csv(os.path.join(outpath,'route_statistics.csv'))
+        gtfs.decode_ids(gtfs.stop_statistics).to_csv(os.path.join(outpath,'stop_statistics.csv'))
+        summary.update(status='ok', routes=len(gtfs.routes), trips=len(gtfs.route_trips),
+                       patterns=len(gtfs.route_patterns), stops=len(gtfs.used_stops))
+    except Exception as e:
+        summary.update(status='failed', error='%s: %s' % (type(e).__name__, e))
+    summary['seconds'] = time.time() - start
+    # a worker process handles a single feed, so this is that feed's peak
+    summary['peak_memory_mb'] = peak_memory_mb()
+    return summary
+
+def _process_feed_job(args):
+    # Pool.imap takes one argument
+    return process_feed(*args)
+
+def process_feeds(feeds, outpath, time_periods, processes=None, cache_dir=None, memory_limit=None):
+    '''
+    input:  feeds:          list of GTFS directories/zips, or dict of feed name to path
+            outpath:        each feed's outputs are written to outpath/<feed name> (see process_feed)
+            time_periods:   see GTFSFeed.apply_time_periods
+            processes:      number of feeds processed at once, defaults to the number of cores
+            cache_dir:      each feed is cached in cache_dir/<feed name> (see GTFSFeed.load)
+            memory_limit:   per-feed memory limit in MB (see process_feed)
+    output: DataFrame of FEED_SUMMARY_COLUMNS with a row per feed, in the order of feeds
+    Each feed runs in its own worker process, which exits when the feed is done, so memory is
+    returned between feeds.
+    '''
+    if isinstance(feeds, dict):
+        names = sorted(feeds.keys())
+        paths = [feeds[name] for name in names]
+    else:
+        names, paths = [], list(feeds)
+        for path in paths:
+            name = feed_name(path)
+            if name in names:
+                name = '%s_%d' % (name, len(names))
+            names.append(name)
+
+    jobs = []
+    for name, path in itertools.izip(names, paths):
+        feed_cache_dir = os.path.join(cache_dir, name) if cache_dir != None else None
+        jobs.append((path, os.path.join(outpath, name), time_periods, feed_cache_dir, memory_limit, name))
+
+    summaries = []
+    pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+    try:
+        for summary in pool.imap_unordered(_process_feed_job, jobs):
+            print "%-30s %-6s %8.1f s  %s" % (summary['feed'], summary['status'], summary['seconds'], summary['error'] or '')
+            summaries.append(summary)
+    finally:
+        pool.close()
+        pool.join()
+    summaries = pd.DataFrame(summaries, columns=FEED_SUMMARY_COLUMNS)
+    return summaries.set_index('feed').reindex(names).reset_index()
+
 if __name__=='__main__':
     gtfs = GTFSFeed('..\SFMTA_20120319')
     print gtfs
@@ -544,7 +3069,7 @@ if __name__=='__main__':
                     'AM':"06:00:00-08:59:59",
                     'MD':"09:00:00-15:29:59",
                     'PM':"15:30:00-18:29:59",
-                    'EV':"18:30:00-27:00:00"}
+                    'EV':"18:30:00-26:59:59"}
     
     gtfs.apply_time_periods(time_periods)
     gtfs.set_route_patterns()
@@ -0,0 +1,169 @@
+'''
+time and memory-profile each GTFSFeed stage on synthetic feeds of increasing size (see
+synthetic_gtfs.py), and write the results to a JSON report.  Given the report of an earlier run
+(ex. of the previous version) the stage times are compared with it.
+
+Each tier runs in its own process so peak memory is the tier's own.  That process isn't a daemon,
+so with -p it can start its own pool.  Feeds are generated once into the work directory and reused
+by later runs.
+
+usage: benchmark_pipeline.py [-t tiers] [-w work_directory] [-b baseline_report] [-p processes] report.json
+    tiers: comma separated TIERS keys, defaults to 10k,100k,1m
+'''
+
+import sys, os, getopt
+import time
+import json
+import platform
+import subprocess
+import multiprocessing
+import traceback
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+import gtfs_utils
+import synthetic_gtfs
+
+# stop_times rows of each tier
+TIERS = OrderedDict([('10k',10**4),('100k',10**5),('1m',10**6),('10m',10**7),('50m',5*10**7)])
+DEFAULT_TIERS = ['10k','100k','1m']
+# synthetic_gtfs arguments other than routes, which is set by the tier
+FEED_ARGS = {'patterns_per_route':4,'trips_per_pattern':10,'stops_per_trip':30,'service_ids':3,
+             'shape_points_per_stop':2,'seed':0}
+TIME_PERIODS = {'EA':"03:00:00-05:59:59",
+                'AM':"06:00:00-08:59:59",
+                'MD':"09:00:00-15:29:59",
+                'PM':"15:30:00-18:29:59",
+                'EV':"18:30:00-26:59:59"}
+
+def get_feed(work_dir, tier):
+    '''
+    path of the synthetic feed for tier, written unless it's already there with the same arguments,
+    and the rows of each of its files
+    '''
+    routes = max(1, int(round(TIERS[tier] / float(synthetic_gtfs.stop_times_per_route(
+        FEED_ARGS['patterns_per_route'], FEED_ARGS['trips_per_pattern'], FEED_ARGS['stops_per_trip'], FEED_ARGS['service_ids'])))))
+    args = dict(FEED_ARGS, routes=routes)
+    path = os.path.join(work_dir, tier)
+    manifest = os.path.join(path, 'synthetic.json')
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            written = json.load(f)
+        if written['args'] == args:
+            return path, written['rows']
+    print "writing %s feed to %s" % (tier, path)
+    counts = synthetic_gtfs.write_synthetic_feed(path, **args)
+    with open(manifest, 'w') as f:
+        json.dump({'args':args, 'rows':counts}, f, indent=1)
+    return path, counts
+
+def run_pipeline(args):
+    # in a worker process: the process_gtfs.py steps with profiling on.  stop_times and trips are
+    # the rows left after weekday_only drops the weekend services.
+    path, processes = args
+    start = time.time()
+    gtfs = gtfs_utils.GTFSFeed(path, profiling=True)
+    gtfs.load(columns=gtfs_utils.PIPELINE_COLUMNS, tables=gtfs_utils.PIPELINE_TABLES)
+    gtfs.apply_time_periods(TIME_PERIODS)
+    gtfs.standardize()
+    gtfs.build_common_dfs(processes=processes)
+    # once more on its own, as it's the step most often rerun with other outlier rules
+    gtfs.get_route_statistics(processes=processes)
+    profile = gtfs.get_profile().astype(object)
+    stages = [dict((k, None if pd.isnull(v) else v) for k, v in row.iteritems()) for _, row in profile.iterrows()]
+    return {'stop_times':len(gtfs.stop_times), 'trips':len(gtfs.trips), 'routes':len(gtfs.routes),
+            'seconds':time.time() - start, 'peak_memory_mb':gtfs_utils.peak_memory_mb(), 'stages':stages}
+
+def run_tier(args, queue):
+    # process target: run_pipeline's result, or the traceback if it failed, is put on queue
+    try:
+        queue.put((True, run_pipeline(args)))
+    except Exception:
+        queue.put((False, traceback.format_exc()))
+
+def git_commit():
+    # commit of the checkout being benchmarked, if it is one
+    try:
+        return subprocess.check_output(['git','rev-parse','HEAD'], cwd=os.path.dirname(os.path.abspath(gtfs_utils.__file__))).strip()
+    except Exception:
+        return None
+
+def stage_seconds(result):
+    # total wall seconds of each stage of a tier
+    seconds = OrderedDict()
+    for stage in result['stages']:
+        seconds[stage['stage']] = seconds.get(stage['stage'], 0) + stage['wall_seconds']
+    return seconds
+
+def compare(report, baseline):
+    '''
+    output: DataFrame of tier, stage, baseline_s, current_s and ratio (current over baseline)
+    '''
+    rows = []
+    baseline_results = dict((result['tier'], result) for result in baseline['results'])
+    for result in report['results']:
+        if result['tier'] not in baseline_results:
+            continue
+        before = stage_seconds(baseline_results[result['tier']])
+        for stage, seconds in stage_seconds(result).iteritems():
+            rows.append({'tier':result['tier'], 'stage':stage, 'baseline_s':before.get(stage), 'current_s':seconds})
+    comparison = pd.DataFrame(rows, columns=['tier','stage','baseline_s','current_s'])
+    comparison['ratio'] = comparison['current_s'] / comparison['baseline_s']
+    return comparison
+
+if __name__=='__main__':
+    opts, args = getopt.getopt(sys.argv[1:], 't:w:b:p:')
+    if len(args) < 1:
+        print __doc__
+        sys.exit(2)
+    report_file = args[0]
+    tiers, work_dir, baseline_file, processes = DEFAULT_TIERS, 'benchmark_feeds', None, None
+    for o, a in opts:
+        if o == '-t':
+            tiers = a.split(',')
+        if o == '-w':
+            work_dir = a
+        if o == '-b':
+            baseline_file = a
+        if o == '-p':
+            processes = int(a)
+    unknown = [tier for tier in tiers if tier not in TIERS]
+    if unknown:
+        print "unknown tiers %s, use %s" % (', '.join(unknown), ', '.join(TIERS.keys()))
+        sys.exit(2)
+
+    report = {'created':time.strftime('%Y-%m-%dT%H:%M:%S'), 'git_commit':git_commit(),
+              'python':platform.python_version(), 'pandas':pd.__version__, 'numpy':np.__version__,
+              'platform':platform.platform(), 'processes':processes, 'feed_args':FEED_ARGS, 'results':[]}
+    for tier in tiers:
+        path, feed_rows = get_feed(work_dir, tier)
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_tier, args=((path, processes), queue))
+        process.start()
+        try:
+            # get before join, a full queue keeps the process from exiting
+            ok, result = queue.get()
+        finally:
+            process.join()
+        if not ok:
+            raise RuntimeError("%s tier failed:\n%s" % (tier, result))
+        result['tier'] = tier
+        result['feed_rows'] = feed_rows
+        report['results'].append(result)
+        peak = '%.1f' % result['peak_memory_mb'] if result['peak_memory_mb'] != None else 'unknown'
+        print "%-5s %10d stop_times (%d weekday) %8.2f s %10s MB peak" % (tier, feed_rows['stop_times'], result['stop_times'],
+                                                                          result['seconds'], peak)
+        top = pd.DataFrame([stage for stage in result['stages'] if stage['depth'] <= 1],
+                           columns=['stage','depth','wall_seconds','cpu_seconds','peak_memory_delta_mb','rows_in','rows_out'])
+        print top.to_string(index=False)
+
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=1)
+    print "wrote %s" % report_file
+
+    if baseline_file != None:
+        with open(baseline_file) as f:
+            comparison = compare(report, json.load(f))
+        print comparison.to_string(index=False)
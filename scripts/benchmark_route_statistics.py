@@ -0,0 +1,58 @@
+'''
+time build_common_dfs and get_route_statistics serially and split by route across 1, 2, 4, ...
+worker processes, and check that every split gives the same tables as the serial run
+
+usage: benchmark_route_statistics.py gtfs_directory_or_zip [max_processes]
+'''
+
+import sys, os
+import time
+import multiprocessing
+import pandas as pd
+from pandas.util.testing import assert_frame_equal
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import gtfs_utils
+
+def timed_build(gtfs, processes):
+    start = time.time()
+    gtfs.build_common_dfs(processes=processes)
+    build_seconds = time.time() - start
+    start = time.time()
+    gtfs.get_route_statistics(processes=processes)
+    stats_seconds = time.time() - start
+    return build_seconds, stats_seconds, gtfs.route_patterns.copy(), gtfs.route_statistics.copy()
+
+if __name__=='__main__':
+    args = sys.argv[1:]
+    path = args[0]
+    max_processes = int(args[1]) if len(args) > 1 else multiprocessing.cpu_count()
+    time_periods = {'EA':"03:00:00-05:59:59",
+                    'AM':"06:00:00-08:59:59",
+                    'MD':"09:00:00-15:29:59",
+                    'PM':"15:30:00-18:29:59",
+                    'EV':"18:30:00-26:59:59"}
+
+    gtfs = gtfs_utils.GTFSFeed(path)
+    gtfs.load(columns=gtfs_utils.PIPELINE_COLUMNS, tables=gtfs_utils.PIPELINE_TABLES)
+    gtfs.apply_time_periods(time_periods)
+    gtfs.standardize()
+    print "%d routes, %d trips, %d stop_times" % (len(gtfs.routes), len(gtfs.trips), len(gtfs.stop_times))
+
+    process_counts = [None]
+    n = 1
+    while n <= max_processes:
+        process_counts.append(n)
+        n *= 2
+
+    rows = []
+    for processes in process_counts:
+        build_seconds, stats_seconds, route_patterns, route_statistics = timed_build(gtfs, processes)
+        if processes is None:
+            serial = route_patterns, route_statistics
+        else:
+            assert_frame_equal(serial[0], route_patterns, check_exact=True)
+            assert_frame_equal(serial[1], route_statistics, check_exact=True)
+        rows.append({'processes':processes if processes != None else 'serial',
+                     'build_common_dfs_s':build_seconds, 'get_route_statistics_s':stats_seconds})
+    print pd.DataFrame(rows, columns=['processes','build_common_dfs_s','get_route_statistics_s']).to_string(index=False)
+    print "all partitioned results match the serial ones"
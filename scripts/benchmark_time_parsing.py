@@ -0,0 +1,42 @@
+'''
+compare the bulk HHMMSS parser against the old per-row Series.map path
+
+usage: benchmark_time_parsing.py [nrows] [stop_times.txt]
+'''
+
+import sys, os
+import timeit
+import numpy as np
+import pandas as pd
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import gtfs_utils
+
+def rowwise_HHMMSS_to_MPM(hhmmss):
+    # the pre-vectorization implementation, kept here as the reference
+    hh, mm, ss = hhmmss.split(':')
+    return 60 * int(hh) + int(mm) + float(ss)/60
+
+def random_times(nrows, seed=0):
+    rs = np.random.RandomState(seed)
+    secs = rs.randint(3*3600, 28*3600, nrows)
+    return pd.Series(['%02d:%02d:%02d' % (s // 3600, (s % 3600) // 60, s % 60) for s in secs])
+
+if __name__=='__main__':
+    args = sys.argv[1:]
+    nrows = int(args[0]) if len(args) > 0 else 1000000
+    if len(args) > 1:
+        times = pd.read_csv(args[1], usecols=['arrival_time'], nrows=nrows)['arrival_time'].dropna()
+    else:
+        times = random_times(nrows)
+
+    print "parsing %d times" % len(times)
+    rowwise = times.map(rowwise_HHMMSS_to_MPM).values
+    bulk = gtfs_utils.HHMMSS_to_MPM(times)
+    if not np.allclose(rowwise, bulk):
+        print "WARNING: bulk and per-row results differ"
+
+    t_row = min(timeit.repeat(lambda: times.map(rowwise_HHMMSS_to_MPM), number=1, repeat=3))
+    t_bulk = min(timeit.repeat(lambda: gtfs_utils.HHMMSS_to_MPM(times), number=1, repeat=3))
+    print "per-row Series.map:   %8.3f s" % t_row
+    print "bulk HHMMSS_to_MPM:   %8.3f s" % t_bulk
+    print "speedup:              %8.1fx" % (t_row / t_bulk)
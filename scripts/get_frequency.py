@@ -8,13 +8,14 @@ if __name__=='__main__':
     args = sys.argv[1:]
     path = args[0]
     outpath = args[1]
+    cache_dir = args[2] if len(args) > 2 else None
     gtfs = gtfs_utils.GTFSFeed(path)
     time_periods = {'EA':"03:00:00-05:59:59",
                     'AM':"06:00:00-08:59:59",
                     'MD':"09:00:00-15:29:59",
                     'PM':"15:30:00-18:29:59",
-                    'EV':"18:30:00-27:00:00"}
-    gtfs.load()
+                    'EV':"18:30:00-26:59:59"}
+    gtfs.load(columns=gtfs_utils.PIPELINE_COLUMNS, tables=gtfs_utils.PIPELINE_TABLES, cache_dir=cache_dir)
     gtfs.apply_time_periods(time_periods)
     gtfs.standardize() # added this to use trip_headsign if direction_id is missing in trips.txt (Ex. 2012 AC Transit GTFS)
     gtfs.build_common_dfs()
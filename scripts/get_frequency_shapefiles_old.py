@@ -56,78 +56,5 @@ if __name__=='__main__':
     print "writing route statistics"
 ##    late_night_routes = gtfs.route_statistics[(gtfs.route_statistics['freq'] > 0) & (gtfs.route_statistics['trip_departure_tp'] != 'other')]
 ##    late_night_routes.to_csv('%s_late_night_route_stats.csv' % tag)
-    shape_ids = gtfs.route_trips['shape_id'].drop_duplicates().tolist()
-    shapes = gtfs.shapes[gtfs.shapes['shape_id'].isin(shape_ids)]
-
     print "writing shapes"
-##    shapes.to_csv('%s_late_night_shapes.csv' % tag)
-    shape_freq = pd.merge(shapes, gtfs.route_patterns, how='left', on='shape_id')
-    shape_freq = pd.DataFrame(shape_freq, columns=shapes.columns.tolist()+['pattern_id'])
-    shape_freq = pd.merge(shape_freq, gtfs.route_statistics, how='left', on='pattern_id')
-    #ln_freq = late_night_routes.fillna(-1)
-    #ln_freq = ln_freq.set_index(['route_id','route_short_name','route_long_name','shape_id','direction_id'])
-##    ln_freq = late_night_routes.pivot_table(index=['route_id','route_short_name','route_long_name','shape_id','direction_id'],
-##                                            columns='trip_departure_tp',values='freq')
-##    ln_freq.to_csv('%s_late_night_route_freqs.csv' % tag)
-##    ln_freq = ln_freq.reset_index()
-    #print ln_freq[ln_freq['shape_id'] == '40151']
-##    shape_freq = pd.merge(shapes, ln_freq, how='left',on='shape_id')
-##    shape_freq.to_csv('sfreq.csv')
-    # write shapefile
-    shape_writer = shapefile.Writer(shapeType=shapefile.POLYLINE)
-    shape_writer.field('route_id',          'N',    10, 0)
-    shape_writer.field('route_short_name',  'C',    10, 0)
-    shape_writer.field('route_long_name',   'C',    50, 0)
-    shape_writer.field('direction_id',      'C',    15,  0)
-    shape_writer.field('shape_id',          'N',    10, 0)        
-    for tp in tp_list:
-        shape_writer.field(tp, 'N', 10, 0)
-
-    for tp in tp_list:
-        if tp not in shape_freq.columns.tolist():
-            shape_freq[tp] = 0
-            
-    shape_id = None
-    #print shape_freq[shape_freq['shape_id'] == '40182']
-    #print shape_freq[shape_freq['shape_id'] == '40151']
-    for i, shape in shape_freq.iterrows():
-        if shape_id == None:
-            route_id = shape['route_id']
-            route_short_name =  shape['route_short_name']
-            route_long_name = shape['route_long_name']
-            direction_id = shape['direction_id']
-            shape_id = shape['shape_id']
-            tp_freqs = []
-            for tp in tp_list:
-                tp_freqs.append(shape['%s_freq' % tp])
-            points = []
-            
-        if shape_id != shape['shape_id']:
-            shape_writer.line([points])
-            shape_writer.record(route_id, route_short_name, route_long_name, direction_id, shape_id, *tp_freqs)
-            route_id = shape['route_id']
-            route_short_name =  shape['route_short_name']
-            route_long_name = shape['route_long_name']
-            direction_id = shape['direction_id']
-            shape_id = shape['shape_id']
-            tp_freqs = []
-            for tp in tp_list:
-                tp_freqs.append(shape['%s_freq' % tp])
-            points = []
-            
-        point = [shape['shape_pt_lon'],shape['shape_pt_lat']]
-        points.append(point)
-    # write the last one
-    tp_freqs = []
-    for tp in tp_list:
-        tp_freqs.append(shape['%s_freq' % tp])
-    shape_writer.line([points])
-    shape_writer.record(shape['route_id'], shape['route_short_name'],
-                        shape['route_long_name'], shape['direction_id'], shape['shape_id'], *tp_freqs)
-    shape_writer.save('%s_route_freq.shp' % tag)
-
-    # write projection
-    prj = open('%s_route_freq.prj' % tag, "w")
-    epsg = 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]]'
-    prj.write(epsg)
-    prj.close()
\ No newline at end of file
+    gtfs.export_shapefiles(tag='%s_route_freq' % tag, time_periods=tp_list, tp_attributes=[('%s','%s_freq',0)])
@@ -0,0 +1,40 @@
+'''
+run process_gtfs.py over many feeds at once, one worker process per feed, and write a summary
+of the run to output_directory/summary.csv
+'''
+
+import sys, os, getopt
+sys.path.insert(0,r'Y:\champ\util\pythonlib-migration\master_versions\gtfs_utils')
+import gtfs_utils
+
+USAGE = '''
+process_feeds.py [-p processes] [-m memory_limit_mb] [-c cache_directory] output_directory gtfs_directory_or_zip [...]
+'''
+if __name__=='__main__':
+    opts, args = getopt.getopt(sys.argv[1:], 'p:m:c:')
+    if len(args) < 2:
+        print USAGE
+        sys.exit(2)
+    outpath = args[0]
+    feeds = args[1:]
+
+    processes, memory_limit, cache_dir = None, None, None
+    for o, a in opts:
+        if o == '-p':
+            processes = int(a)
+        if o == '-m':
+            memory_limit = float(a)
+        if o == '-c':
+            cache_dir = a
+
+    time_periods = {'EA':"03:00:00-05:59:59",
+                    'AM':"06:00:00-08:59:59",
+                    'MD':"09:00:00-15:29:59",
+                    'PM':"15:30:00-18:29:59",
+                    'EV':"18:30:00-26:59:59"}
+    summary = gtfs_utils.process_feeds(feeds, outpath, time_periods, processes=processes,
+                                       cache_dir=cache_dir, memory_limit=memory_limit)
+    summary.to_csv(os.path.join(outpath,'summary.csv'), index=False)
+    print summary
+    if (summary['status'] != 'ok').any():
+        sys.exit(1)
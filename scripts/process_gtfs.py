@@ -10,23 +10,29 @@ if __name__=='__main__':
     args = sys.argv[1:]
     path = args[0]
     outpath = args[1]
+    cache_dir = args[2] if len(args) > 2 else None
     gtfs = gtfs_utils.GTFSFeed(path)
     time_periods = {'EA':"03:00:00-05:59:59",
                     'AM':"06:00:00-08:59:59",
                     'MD':"09:00:00-15:29:59",
                     'PM':"15:30:00-18:29:59",
-                    'EV':"18:30:00-27:00:00"}
-    gtfs.load()
+                    'EV':"18:30:00-26:59:59"}
+    gtfs.load(columns=gtfs_utils.PIPELINE_COLUMNS, tables=gtfs_utils.PIPELINE_TABLES, cache_dir=cache_dir, intern_ids=True)
     gtfs.apply_time_periods(time_periods)
     gtfs.standardize() # added this to use trip_headsign if direction_id is missing in trips.txt (Ex. 2012 AC Transit GTFS)
-    gtfs.build_common_dfs()
+    # with a cache, only the routes that changed since the last run are recomputed
+    gtfs.build_common_dfs(build_cache=os.path.join(cache_dir,'build') if cache_dir != None else None,
+                          keep=['route_trips','route_patterns','route_statistics','stop_statistics'])
 
     if not os.path.exists(outpath):
         os.mkdir(outpath)
         print outpath
     print "writing..."
-    gtfs.route_trips.to_csv(os.path.join(outpath,'route_trips.csv'))
-    gtfs.route_patterns.to_csv(os.path.join(outpath,'route_patterns.csv'))
+    # ids are interned as int codes, decode them on the way out
+    gtfs.decode_ids(gtfs.route_trips).to_csv(os.path.join(outpath,'route_trips.csv'))
+    gtfs.get_route_patterns_wide().to_csv(os.path.join(outpath,'route_patterns.csv'))
     #gtfs.patterns.to_csv(os.path.join(outpath,'patterns.csv'))
-    gtfs.route_statistics.to_csv(os.path.join(outpath,'route_statistics.csv'))
-    gtfs.stop_statistics.to_csv(os.path.join(outpath,'stop_statistics.csv'))
\ No newline at end of file
+    gtfs.decode_ids(gtfs.route_statistics).to_csv(os.path.join(outpath,'route_statistics.csv'))
+    gtfs.decode_ids(gtfs.stop_statistics).to_csv(os.path.join(outpath,'stop_statistics.csv'))
+    if gtfs.build_changes is not None:
+        gtfs.build_changes.to_csv(os.path.join(outpath,'build_changes.csv'), index=False)
\ No newline at end of file
@@ -0,0 +1,161 @@
+'''
+write a synthetic GTFS feed of a given size.  The same arguments always give the same feed, so it
+can stand in for customer feeds in benchmarks (see benchmark_pipeline.py).
+
+Every route has patterns_per_route patterns, alternating direction 0 and 1, each shorter than the
+one before by a stop at either end.  Each pattern runs trips_per_pattern trips spread over
+05:00-23:00 on each service_id.  stop_times is written a batch of routes at a time, so large feeds
+don't have to fit in memory.
+
+usage: synthetic_gtfs.py [-r routes] [-p patterns_per_route] [-t trips_per_pattern] [-s stops_per_trip]
+                         [-v service_ids] [-d shape_points_per_stop] [-n seed] output_directory
+'''
+
+import sys, os, getopt
+import numpy as np
+import pandas as pd
+
+WEEKDAYS = ['monday','tuesday','wednesday','thursday','friday']
+DAYS = WEEKDAYS + ['saturday','sunday']
+# stop_times rows written at a time
+BATCH_ROWS = 1000000
+
+def stop_times_per_route(patterns_per_route=4, trips_per_pattern=10, stops_per_trip=30, service_ids=3):
+    '''
+    number of stop_times rows of one route with these arguments (see write_synthetic_feed)
+    '''
+    stops = sum(stops_per_trip - 2 * (p // 2) for p in range(patterns_per_route))
+    return stops * trips_per_pattern * service_ids
+
+def format_times(seconds):
+    '''
+    HH:MM:SS strings for an int array of seconds past midnight, by lookup rather than per value
+    '''
+    seconds = np.asarray(seconds, dtype=np.int64)
+    hours = np.arange(seconds.max() // 3600 + 1 if len(seconds) else 1)
+    table = np.array(['%02d:%02d:%02d' % (h, m, s) for h in hours for m in range(60) for s in range(60)], dtype=object)
+    return table[seconds]
+
+def get_calendar(service_ids):
+    # service 1 runs on weekdays, 2 on saturday, 3 on sunday, and any others on weekdays
+    calendar = pd.DataFrame({'service_id':np.arange(1, service_ids + 1)})
+    for day in DAYS:
+        calendar[day] = 0
+    days = [WEEKDAYS, ['saturday'], ['sunday']]
+    for i in range(service_ids):
+        calendar.loc[i, days[i] if i < len(days) else WEEKDAYS] = 1
+    calendar['start_date'] = 20160101
+    calendar['end_date'] = 20161231
+    return pd.DataFrame(calendar, columns=['service_id'] + DAYS + ['start_date','end_date'])
+
+def get_route_patterns(rs, routes, patterns_per_route, stops_per_trip, stops):
+    # list of (route_id, direction_id, pattern number, stop index array) for every pattern
+    patterns = []
+    for route in range(routes):
+        base = rs.choice(stops, stops_per_trip, replace=False)
+        for p in range(patterns_per_route):
+            trim = p // 2
+            sequence = base[trim:stops_per_trip - trim]
+            patterns.append((route + 1, p % 2, p, sequence[::-1] if p % 2 else sequence))
+    return patterns
+
+def write_synthetic_feed(path, routes=10, patterns_per_route=4, trips_per_pattern=10, stops_per_trip=30, service_ids=3,
+                         shape_points_per_stop=2, seed=0):
+    '''
+    input:  path:                   output directory
+            routes, patterns_per_route, trips_per_pattern (per service_id), stops_per_trip (of the
+            longest pattern), service_ids
+            shape_points_per_stop:  shapes.txt points per stop to stop link (0 for no shapes.txt)
+            seed:                   random seed
+    output: dict of the number of rows written to each file
+    '''
+    if stops_per_trip < patterns_per_route:
+        raise ValueError("stops_per_trip must be at least patterns_per_route")
+    rs = np.random.RandomState(seed)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    counts = {}
+
+    def write(name, df, append=False):
+        df.to_csv(os.path.join(path, name + '.txt'), index=False, mode='a' if append else 'w', header=not append)
+        counts[name] = counts.get(name, 0) + len(df)
+
+    write('agency', pd.DataFrame({'agency_id':['SYN'],'agency_name':['Synthetic Transit'],'agency_url':['http://example.com'],
+                                  'agency_timezone':['America/Los_Angeles']},
+                                 columns=['agency_id','agency_name','agency_url','agency_timezone']))
+    write('calendar', get_calendar(service_ids))
+    write('calendar_dates', pd.DataFrame({'service_id':[1],'date':[20160704],'exception_type':[2]},
+                                         columns=['service_id','date','exception_type']))
+
+    # stops on a grid about 20 km across, shared by about two routes each
+    n_stops = max(stops_per_trip, routes * stops_per_trip // 2)
+    stop_lat = 37.7 + rs.rand(n_stops) * 0.18
+    stop_lon = -122.5 + rs.rand(n_stops) * 0.22
+    write('stops', pd.DataFrame({'stop_id':np.arange(n_stops) + 10000,'stop_name':['Stop %d' % i for i in range(n_stops)],
+                                 'stop_lat':stop_lat,'stop_lon':stop_lon},
+                                columns=['stop_id','stop_name','stop_lat','stop_lon']))
+    write('routes', pd.DataFrame({'route_id':np.arange(1, routes + 1),'agency_id':'SYN',
+                                  'route_short_name':[str(r) for r in range(1, routes + 1)],
+                                  'route_long_name':['Route %d' % r for r in range(1, routes + 1)],
+                                  'route_desc':'','route_type':3},
+                                 columns=['route_id','agency_id','route_short_name','route_long_name','route_desc','route_type']))
+
+    patterns = get_route_patterns(rs, routes, patterns_per_route, stops_per_trip, n_stops)
+    span = 18 * 3600
+    trip_id = 0
+    trips, stop_times, batch_rows = [], [], 0
+    for i, (route_id, direction_id, p, sequence) in enumerate(patterns):
+        shape_id = route_id * 100 + p
+        if shape_points_per_stop > 0:
+            # points along the straight lines between stops
+            steps = np.arange(shape_points_per_stop) / float(shape_points_per_stop)
+            lat = (stop_lat[sequence[:-1]][:,None] * (1 - steps) + stop_lat[sequence[1:]][:,None] * steps).ravel()
+            lon = (stop_lon[sequence[:-1]][:,None] * (1 - steps) + stop_lon[sequence[1:]][:,None] * steps).ravel()
+            lat, lon = np.r_[lat, stop_lat[sequence[-1]]], np.r_[lon, stop_lon[sequence[-1]]]
+            write('shapes', pd.DataFrame({'shape_id':shape_id,'shape_pt_lat':lat,'shape_pt_lon':lon,
+                                          'shape_pt_sequence':np.arange(1, len(lat) + 1)},
+                                         columns=['shape_id','shape_pt_lat','shape_pt_lon','shape_pt_sequence']),
+                  append='shapes' in counts)
+
+        # every trip of the pattern has the same run times, with a 30 second dwell at every third stop
+        run = np.r_[0, rs.randint(60, 180, len(sequence) - 1)]
+        dwell = np.where(np.arange(len(sequence)) % 3 == 0, 30, 0)
+        arrive = np.cumsum(run + np.r_[0, dwell[:-1]])
+        for service_id in range(1, service_ids + 1):
+            starts = 5 * 3600 + np.arange(trips_per_pattern) * span // trips_per_pattern + rs.randint(0, 300, trips_per_pattern)
+            trip_ids = trip_id + 1 + np.arange(trips_per_pattern)
+            trip_id += trips_per_pattern
+            trips.append(pd.DataFrame({'route_id':route_id,'service_id':service_id,'trip_id':trip_ids,
+                                       'trip_headsign':'Route %d %s' % (route_id, 'Inbound' if direction_id else 'Outbound'),
+                                       'direction_id':direction_id,'shape_id':shape_id}))
+            arrivals = (starts[:,None] + arrive).ravel()
+            stop_times.append(pd.DataFrame({'trip_id':np.repeat(trip_ids, len(sequence)),
+                                            'arrival_time':arrivals,
+                                            'departure_time':arrivals + np.tile(dwell, trips_per_pattern),
+                                            'stop_id':np.tile(sequence + 10000, trips_per_pattern),
+                                            'stop_sequence':np.tile(np.arange(1, len(sequence) + 1), trips_per_pattern)}))
+            batch_rows += len(stop_times[-1])
+
+        if batch_rows >= BATCH_ROWS or i == len(patterns) - 1:
+            batch = pd.concat(stop_times, ignore_index=True)
+            batch['arrival_time'] = format_times(batch['arrival_time'].values)
+            batch['departure_time'] = format_times(batch['departure_time'].values)
+            write('stop_times', pd.DataFrame(batch, columns=['trip_id','arrival_time','departure_time','stop_id','stop_sequence']),
+                  append='stop_times' in counts)
+            write('trips', pd.DataFrame(pd.concat(trips, ignore_index=True),
+                                        columns=['route_id','service_id','trip_id','trip_headsign','direction_id','shape_id']),
+                  append='trips' in counts)
+            trips, stop_times, batch_rows = [], [], 0
+    return counts
+
+if __name__=='__main__':
+    opts, args = getopt.getopt(sys.argv[1:], 'r:p:t:s:v:d:n:')
+    if len(args) < 1:
+        print __doc__
+        sys.exit(2)
+    names = {'-r':'routes','-p':'patterns_per_route','-t':'trips_per_pattern','-s':'stops_per_trip',
+             '-v':'service_ids','-d':'shape_points_per_stop','-n':'seed'}
+    kwargs = dict((names[o], int(a)) for o, a in opts)
+    counts = write_synthetic_feed(args[0], **kwargs)
+    for name in sorted(counts.keys()):
+        print "%-16s %12d rows" % (name, counts[name])
@@ -0,0 +1,250 @@
+'''
+tests for gtfs_utils on small feeds written to a temporary directory
+
+usage: python -m unittest discover -s tests
+'''
+
+import sys, os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+import pandas as pd
+from pandas.util.testing import assert_frame_equal
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','scripts'))
+import gtfs_utils
+import synthetic_gtfs
+
+TIME_PERIODS = {'AM':'06:00:00-08:59:59','MD':'09:00:00-15:29:59','PM':'15:30:00-18:29:59'}
+
+def write_feed(path, calendar, calendar_dates, trips):
+    '''
+    write a feed with two stops, a route and a two stop trip per trips row
+    input:  calendar:       list of (service_id, days ('1111100' from monday), start_date, end_date)
+            calendar_dates: list of (service_id, date, exception_type)
+            trips:          list of (trip_id, service_id)
+    '''
+    pd.DataFrame({'agency_id':['A'],'agency_name':['Agency'],'agency_url':['http://example.com'],
+                  'agency_timezone':['America/Los_Angeles']}).to_csv(os.path.join(path,'agency.txt'), index=False)
+    rows = [dict([('service_id',service_id),('start_date',start),('end_date',end)] +
+                 [(day, int(flag)) for day, flag in zip(gtfs_utils.DAYS, days)]) for service_id, days, start, end in calendar]
+    pd.DataFrame(rows, columns=['service_id']+gtfs_utils.DAYS+['start_date','end_date']).to_csv(os.path.join(path,'calendar.txt'), index=False)
+    pd.DataFrame(calendar_dates, columns=['service_id','date','exception_type']).to_csv(os.path.join(path,'calendar_dates.txt'), index=False)
+    pd.DataFrame({'stop_id':['S1','S2'],'stop_name':['One','Two'],'stop_lat':[37.70,37.71],
+                  'stop_lon':[-122.40,-122.41]}).to_csv(os.path.join(path,'stops.txt'), index=False)
+    pd.DataFrame({'route_id':['R1'],'agency_id':['A'],'route_short_name':['1'],'route_long_name':['Route 1'],
+                  'route_desc':[''],'route_type':[3]}).to_csv(os.path.join(path,'routes.txt'), index=False)
+    pd.DataFrame([{'route_id':'R1','service_id':service_id,'trip_id':trip_id,'trip_headsign':'Two',
+                   'direction_id':0,'shape_id':''} for trip_id, service_id in trips],
+                 columns=['route_id','service_id','trip_id','trip_headsign','direction_id','shape_id']).to_csv(os.path.join(path,'trips.txt'), index=False)
+    stop_times = []
+    for i, (trip_id, service_id) in enumerate(trips):
+        stop_times += [{'trip_id':trip_id,'arrival_time':'07:%02d:00' % i,'departure_time':'07:%02d:00' % i,'stop_id':'S1','stop_sequence':1},
+                       {'trip_id':trip_id,'arrival_time':'07:%02d:00' % (i+5),'departure_time':'07:%02d:00' % (i+5),'stop_id':'S2','stop_sequence':2}]
+    pd.DataFrame(stop_times, columns=['trip_id','arrival_time','departure_time','stop_id','stop_sequence']).to_csv(os.path.join(path,'stop_times.txt'), index=False)
+
+def build_feed(path, **load_args):
+    '''
+    load, apply_time_periods, standardize and build_common_dfs as process_gtfs.py does
+    input:  load_args:  passed on to GTFSFeed.load, besides the PIPELINE_COLUMNS and PIPELINE_TABLES
+    '''
+    build_args = dict((k, load_args.pop(k)) for k in ['processes','keep'] if k in load_args)
+    gtfs = gtfs_utils.GTFSFeed(path)
+    gtfs.load(columns=gtfs_utils.PIPELINE_COLUMNS, tables=gtfs_utils.PIPELINE_TABLES, **load_args)
+    gtfs.apply_time_periods(TIME_PERIODS)
+    gtfs.standardize()
+    gtfs.build_common_dfs(**build_args)
+    return gtfs
+
+def get_table(gtfs, name, sort=False):
+    # name with the ids decoded and categoricals as objects, so builds can be compared
+    df = getattr(gtfs, name)
+    df = gtfs.decode_ids(df).reset_index(drop=all(x is None for x in df.index.names))
+    for col in df.columns:
+        if str(df[col].dtype) == 'category':
+            df[col] = df[col].astype(object)
+    if sort:
+        df = df.sort_values(list(df.columns))
+    return df.reset_index(drop=True)
+
+class TimeParsingTest(unittest.TestCase):
+    def test_HHMMSS_to_seconds(self):
+        missing = gtfs_utils.MISSING_TIME
+        values = ['07:05:09', '7:05:09', ' 7:05:09', '25:30:00', '120:00:01', '', None, float('nan'),
+                  '07:5:09', '07:60:00', '07:05:60', '07-05-09', 'abc', '07:05', u'07:05:09', u'07:05:09\xe9', u'\u0661:05:09']
+        expected = [25509, 25509, 25509, 91800, 432001, missing, missing, missing,
+                    missing, missing, missing, missing, missing, missing, 25509, missing, missing]
+        self.assertEqual(gtfs_utils.HHMMSS_to_seconds(values).tolist(), expected)
+        self.assertEqual(gtfs_utils.HHMMSS_to_seconds(pd.Series(values, dtype='category')).tolist(), expected)
+
+class ServiceDatesTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_sequential_service_periods(self):
+        # a weekday service per season, a weekend service and a holiday-only service
+        write_feed(self.path,
+                   calendar=[('SPRING','1111100',20160101,20160430),
+                             ('SUMMER','1111100',20160501,20160831),
+                             ('FALL','1111100',20160901,20161231),
+                             ('WEEKEND','0000011',20160101,20161231)],
+                   calendar_dates=[('HOLIDAY',20160704,1)],
+                   trips=[('T1','SPRING'),('T2','SUMMER'),('T3','FALL'),('T4','WEEKEND'),('T5','HOLIDAY')])
+        gtfs = gtfs_utils.GTFSFeed(self.path)
+        gtfs.load(columns=gtfs_utils.PIPELINE_COLUMNS, tables=gtfs_utils.PIPELINE_TABLES)
+        self.assertEqual(sorted(gtfs.weekday_service_ids), ['FALL','SPRING','SUMMER'])
+        self.assertEqual(sorted(gtfs.trips['trip_id'].tolist()), ['T1','T2','T3'])
+        self.assertEqual(len(gtfs.used_stops), 2)
+
+@unittest.skipIf(gtfs_utils.pyarrow == None, 'the cache needs pyarrow')
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        write_feed(self.path,
+                   calendar=[('WKDY','1111100',20160101,20161231)],
+                   calendar_dates=[],
+                   trips=[(100+i,'WKDY') for i in range(8)])
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_build_from_cache(self):
+        # the second load of each format reads the cache, whose arrow buffers are read-only.  the
+        # trip_ids are numbers as pandas' int hashtables are the ones that can't take those
+        for cache_format in gtfs_utils.CACHE_FORMATS.keys():
+            cache_dir = os.path.join(self.path, 'cache_' + cache_format)
+            for cached in [False, True]:
+                gtfs = gtfs_utils.GTFSFeed(self.path)
+                gtfs.load(cache_dir=cache_dir, cache_format=cache_format)
+                self.assertEqual(gtfs.load_stats['cached'].all(), cached)
+                gtfs.standardize()
+                gtfs.build_common_dfs()
+                self.assertEqual(len(gtfs.route_statistics), 1)
+                self.assertEqual(len(gtfs.stop_routes), 2)
+
+class ProcessFeedsTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.feeds = {}
+        for name in ['north','south']:
+            self.feeds[name] = os.path.join(self.path, name)
+            os.makedirs(self.feeds[name])
+            write_feed(self.feeds[name],
+                       calendar=[('WKDY','1111100',20160101,20161231)],
+                       calendar_dates=[],
+                       trips=[(100+i,'WKDY') for i in range(8)])
+        self.time_periods = {'AM':'06:00:00-08:59:59','PM':'15:30:00-18:29:59'}
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    @unittest.skipIf(gtfs_utils.pyarrow == None, 'the cache needs pyarrow')
+    def test_rerun_on_cache(self):
+        # the second run reads every feed from the cache
+        cache_dir = os.path.join(self.path, 'cache')
+        for run in range(2):
+            summaries = gtfs_utils.process_feeds(self.feeds, os.path.join(self.path, 'out'), self.time_periods,
+                                                 processes=2, cache_dir=cache_dir)
+            self.assertEqual(summaries['status'].tolist(), ['ok','ok'], summaries['error'].tolist())
+            self.assertEqual(summaries['feed'].tolist(), ['north','south'])
+
+    def test_missing_feed(self):
+        summary = gtfs_utils.process_feed(os.path.join(self.path, 'missing'), os.path.join(self.path, 'out'), self.time_periods)
+        self.assertEqual(summary['status'], 'failed')
+        self.assertTrue(summary['error'].startswith('IOError: no GTFS directory or zip at'), summary['error'])
+
+class ParallelRouteTablesTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        synthetic_gtfs.write_synthetic_feed(self.path, routes=6, trips_per_pattern=3, stops_per_trip=8)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_same_as_serial(self):
+        expected = build_feed(self.path)
+        for processes in [1, 2]:
+            gtfs = build_feed(self.path, processes=processes)
+            for name in ['route_statistics','route_patterns','stop_routes']:
+                assert_frame_equal(get_table(gtfs, name), get_table(expected, name))
+
+class InternIdsTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_same_as_raw_ids(self):
+        synthetic_gtfs.write_synthetic_feed(self.path, routes=4, trips_per_pattern=3, stops_per_trip=8)
+        expected = build_feed(self.path)
+        gtfs = build_feed(self.path, intern_ids=True)
+        self.assertNotEqual(gtfs.ids, None)
+        for name in ['route_trips','route_statistics','stop_statistics']:
+            assert_frame_equal(get_table(gtfs, name), get_table(expected, name))
+        # stop_frequencies rows come in another order
+        assert_frame_equal(get_table(gtfs, 'stop_frequencies', sort=True), get_table(expected, 'stop_frequencies', sort=True))
+
+    def test_feed_without_shapes(self):
+        # no shape_ids to intern, so they all decode as missing
+        write_feed(self.path,
+                   calendar=[('WKDY','1111100',20160101,20161231)],
+                   calendar_dates=[],
+                   trips=[('T%d' % i,'WKDY') for i in range(4)])
+        expected = build_feed(self.path).get_route_patterns_wide()
+        assert_frame_equal(build_feed(self.path, intern_ids=True).get_route_patterns_wide(), expected)
+
+class OutOfCoreTest(unittest.TestCase):
+    def setUp(self):
+        # numeric trip_ids, as pandas' int hashtables are the ones that can't take read-only buffers
+        self.path = tempfile.mkdtemp()
+        write_feed(self.path,
+                   calendar=[('WKDY','1111100',20160101,20161231)],
+                   calendar_dates=[],
+                   trips=[(100+i,'WKDY') for i in range(8)])
+        self.cache_dir = os.path.join(self.path, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def assertSameBuild(self, gtfs, expected):
+        # feather reads the column names back as unicode
+        for name in ['route_statistics','segments']:
+            assert_frame_equal(get_table(gtfs, name), get_table(expected, name), check_dtype=False, check_column_type=False)
+        # out of core stop_routes rows may come in another order
+        assert_frame_equal(get_table(gtfs, 'stop_routes', sort=True), get_table(expected, 'stop_routes', sort=True),
+                           check_dtype=False, check_column_type=False)
+
+    @unittest.skipIf(gtfs_utils.pyarrow == None, 'the cache needs pyarrow')
+    def test_cache_hit(self):
+        expected = build_feed(self.path)
+        build_feed(self.path, cache_dir=self.cache_dir)
+        for intern_ids in [False, True]:
+            gtfs = build_feed(self.path, cache_dir=self.cache_dir, intern_ids=intern_ids)
+            self.assertTrue(gtfs.load_stats['cached'].all())
+            self.assertSameBuild(gtfs, expected)
+        with self.assertRaises(ValueError):
+            build_feed(self.path, cache_dir=self.cache_dir, partition_rows=4)
+
+    def test_partitions_with_interned_ids(self):
+        if gtfs_utils.pyarrow != None:
+            # compared with a build from the cache, as partitions can't be read from it
+            build_feed(self.path, cache_dir=self.cache_dir)
+            expected = build_feed(self.path, cache_dir=self.cache_dir)
+        else:
+            expected = build_feed(self.path)
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            gtfs = build_feed(self.path, intern_ids=True, partition_rows=4, work_dir=os.path.join(self.path,'work'))
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertNotIn('could not convert', printed)
+        self.assertSameBuild(gtfs, expected)
+
+if __name__=='__main__':
+    unittest.main()